@@ -20,6 +20,12 @@ from . import bones as bones
 from . import spread_fingers as spread_fingers
 from . import align as align
 from . import bones as bones
+from . import weights as weights
+from . import instrument as instrument
+from . import common as common
+from . import snapshot as snapshot
+from . import reference as reference
+from . import sliced as sliced
 
 # from .operations import ops_register
 # from .operations import ops_unregister
@@ -39,6 +45,12 @@ bl_info = {
 
 def register():
     print(__name__)
+    importlib.reload(instrument)
+    importlib.reload(weights)
+    importlib.reload(common)
+    importlib.reload(snapshot)
+    importlib.reload(reference)
+    importlib.reload(sliced)
     importlib.reload(imui)
     importlib.reload(imops)
     importlib.reload(bones)
@@ -49,10 +61,15 @@ def register():
     spread_fingers.ops_register()
     align.ops_register()
     bones.ops_register()
+    snapshot.ops_register()
+    common.register_handlers()
 
 
 def unregister():
+    common.unregister_handlers()
     imui.ui_unregister()
     imops.ops_unregister()
     spread_fingers.ops_unregister()
     align.ops_unregister()
+    bones.ops_unregister()
+    snapshot.ops_unregister()
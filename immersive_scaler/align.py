@@ -1,38 +1,65 @@
 import bpy
 import mathutils
 import importlib
+import numpy as np
 import statistics
 
+from typing import List
+
 from . import common
+from . import instrument
 from . import posemode
 from . import bones
+from . import reference
+from . import skeleton
+from . import snapshot
 from . import spread_fingers
 
 importlib.reload(common)
+importlib.reload(instrument)
 importlib.reload(posemode)
 importlib.reload(bones)
+importlib.reload(reference)
+importlib.reload(skeleton)
+importlib.reload(snapshot)
 importlib.reload(spread_fingers)
 
 from .common import (
+    add_app_handlers,
     get_all_armatures,
     get_body_meshes,
+    remove_app_handlers,
     ArmatureOperator,
     temp_ensure_enabled,
 )
-from .posemode import start_pose_mode_with_reset, apply_pose_to_rest
-from .bones import get_bone, bone_lookup, check_bone
+from .posemode import reset_pose, DeferredPoseBake
+from .bones import get_bone, check_bone
+from .reference import (
+    CORRESPONDENCE_HANDLERS,
+    BoneCorrespondence,
+    ReferenceBone,
+    ReferenceSkeleton,
+    invalidate_scene_correspondence,
+    read_reference,
+    save_template,
+)
+from .snapshot import no_undo_variant
+from .skeleton import Skeleton
 from .spread_fingers import point_bone
+from .instrument import log, span, traced, view_layer_update
 
 
-def scale_torso(context, ref_arm, scale_arm):
+@traced("align scale_torso")
+def scale_torso(context, ref, scale_arm, baker=None):
     # Match scale to ref's neck and upper legs
 
+    if baker is None:
+        baker = DeferredPoseBake(scale_arm, deferred=False)
+
     scale_leg_center = (
         get_bone("left_leg", scale_arm).head + get_bone("right_leg", scale_arm).head
     ) / 2
-    ref_leg_center = (
-        get_bone("left_leg", ref_arm).head + get_bone("right_leg", ref_arm).head
-    ) / 2
+    ref_leg_center = (ref.head("left_leg") + ref.head("right_leg")) / 2
 
     translation = ref_leg_center - scale_leg_center
     hips = get_bone("hips", scale_arm)
@@ -41,30 +68,25 @@ def scale_torso(context, ref_arm, scale_arm):
 
     # Translations aren't reflected in coordinates unless the pose
     # mode is applied
-    apply_pose_to_rest(arm=scale_arm)
-    start_pose_mode_with_reset(scale_arm)
+    baker.apply_pose_to_rest()
+    reset_pose(scale_arm)
 
     # get the bones again since the pose bone objects only last as
     # long as pose mode does
     scale_leg_center = (
         get_bone("left_leg", scale_arm).head + get_bone("right_leg", scale_arm).head
     ) / 2
-    ref_leg_center = (
-        get_bone("left_leg", ref_arm).head + get_bone("right_leg", ref_arm).head
-    ) / 2
+    ref_leg_center = (ref.head("left_leg") + ref.head("right_leg")) / 2
 
     scale_shoulder_center = (
         get_bone("left_shoulder", scale_arm).head
         + get_bone("right_shoulder", scale_arm).head
     ) / 2
 
-    ref_shoulder_center = (
-        get_bone("left_shoulder", ref_arm).head
-        + get_bone("right_shoulder", ref_arm).head
-    ) / 2
+    ref_shoulder_center = (ref.head("left_shoulder") + ref.head("right_shoulder")) / 2
 
     # scale_neck = get_bone("neck", scale_arm)
-    # ref_neck = get_bone("neck", ref_arm)
+    # ref_neck = ref.bone("neck")
 
     scale_torso = (scale_shoulder_center - ref_leg_center).length
     ref_torso = (ref_shoulder_center - ref_leg_center).length
@@ -77,15 +99,13 @@ def scale_torso(context, ref_arm, scale_arm):
 
     # The scaling is reletive to the hips but the movement made the
     # bones line up. Easier to just line it up again
-    apply_pose_to_rest(arm=scale_arm)
-    start_pose_mode_with_reset(scale_arm)
+    baker.apply_pose_to_rest()
+    reset_pose(scale_arm)
 
     scale_leg_center = (
         get_bone("left_leg", scale_arm).head + get_bone("right_leg", scale_arm).head
     ) / 2
-    ref_leg_center = (
-        get_bone("left_leg", ref_arm).head + get_bone("right_leg", ref_arm).head
-    ) / 2
+    ref_leg_center = (ref.head("left_leg") + ref.head("right_leg")) / 2
 
     translation = ref_leg_center - scale_leg_center
     hips = get_bone("hips", scale_arm)
@@ -94,18 +114,13 @@ def scale_torso(context, ref_arm, scale_arm):
 
     # Correction for lining up the knees and shoulders. If the base is
     # the same it should be a no-op
-    hip_scale = (
-        get_bone("left_leg", ref_arm).head - get_bone("right_leg", ref_arm).head
-    ).length / (
+    hip_scale = (ref.head("left_leg") - ref.head("right_leg")).length / (
         get_bone("left_leg", scale_arm).head - get_bone("right_leg", scale_arm).head
     ).length
     get_bone("hips", scale_arm).scale = (hip_scale, 1.0, 1.0)
-    bpy.context.view_layer.update()
+    view_layer_update()
 
-    chest_scale = (
-        get_bone("left_shoulder", ref_arm).head
-        - get_bone("right_shoulder", ref_arm).head
-    ).length / (
+    chest_scale = (ref.head("left_shoulder") - ref.head("right_shoulder")).length / (
         get_bone("left_shoulder", scale_arm).head
         - get_bone("right_shoulder", scale_arm).head
     ).length
@@ -115,8 +130,8 @@ def scale_torso(context, ref_arm, scale_arm):
     if check_bone("neck", scale_arm):
         get_bone("neck", scale_arm).scale = (1 / (hip_scale * chest_scale), 1.0, 1.0)
 
-    apply_pose_to_rest(arm=scale_arm)
-    start_pose_mode_with_reset(scale_arm)
+    baker.apply_pose_to_rest()
+    reset_pose(scale_arm)
 
     # Attempt to move the shoulders back a little bit by rotating the
     # whole model, counter rotating the neck so the head is still
@@ -127,10 +142,7 @@ def scale_torso(context, ref_arm, scale_arm):
         + get_bone("right_shoulder", scale_arm).head
     ) / 2
 
-    ref_shoulder_center = (
-        get_bone("left_shoulder", ref_arm).head
-        + get_bone("right_shoulder", ref_arm).head
-    ) / 2
+    ref_shoulder_center = (ref.head("left_shoulder") + ref.head("right_shoulder")) / 2
 
     spine = get_bone("hips", scale_arm)
     v1 = (ref_shoulder_center - spine.head).normalized()
@@ -148,84 +160,82 @@ def scale_torso(context, ref_arm, scale_arm):
         nq.rotate(v1.rotation_difference(v2))
         neck.rotation_quaternion = nq
 
-    apply_pose_to_rest(arm=scale_arm)
-    start_pose_mode_with_reset(scale_arm)
+    baker.apply_pose_to_rest()
+    reset_pose(scale_arm)
 
     return base_scaling
 
 
-def get_scaling_rotations(ref_bone, scale_bone):
-    # Scaling should prioritize having children line up. For every set
-    # of matching children, find the transform needed to the parent to
-    # get the children to line up, then perform the one that makes the
-    # most line up.
+def _scaling_rotations(scale_key, scale_head, ref_head, child_pairs):
+    """get_scaling_rotations() for bones given as heads. scale_key is the humanoid bone name of the bone and child_pairs
+    is every (s_child humanoid bone name, s_child head, r_child head) of the matching children."""
     child_target_scales = []
     child_target_rotations = []
-    for s_child in scale_bone.children:
-        for r_child in ref_bone.children:
-            if s_child.name == r_child.name or (
-                bone_lookup(s_child.name) == bone_lookup(r_child.name)
-                and bone_lookup(r_child.name) != None
-            ):
-
-                # Find ideal scale
-                scale = (r_child.head - ref_bone.head).length / (
-                    s_child.head - scale_bone.head
-                ).length
-                child_target_scales.append(scale)
-
-                # I'm not sure if it's possible to get a vector scale
-                # *and* rotation, there are too many degrees of
-                # freedom and they will overlap if calculated separately.
-
-                # find rotation difference between s_child.head -> scale_bone.head -> r_child.head
-                # Vectors should be in the space of scale_bone
-                v1 = (s_child.head - scale_bone.head).normalized()
-                v2 = (r_child.head - scale_bone.head).normalized()
-                child_target_rotations.append(v1.rotation_difference(v2))
-
-                # For the wrist bone, always scale to the middle
-                # finger if it's available
-                if "wrist" in bone_lookup(scale_bone.name) and "middle" in bone_lookup(
-                    s_child.name
-                ):
-                    starting_rotation = v1.rotation_difference(v2)
-                    return [scale], [starting_rotation]
+    for s_child_key, s_child_head, r_child_head in child_pairs:
+        # Find ideal scale
+        scale = (r_child_head - ref_head).length / (s_child_head - scale_head).length
+        child_target_scales.append(scale)
+
+        # I'm not sure if it's possible to get a vector scale
+        # *and* rotation, there are too many degrees of
+        # freedom and they will overlap if calculated separately.
+
+        # find rotation difference between s_child.head -> scale_bone.head -> r_child.head
+        # Vectors should be in the space of scale_bone
+        v1 = (s_child_head - scale_head).normalized()
+        v2 = (r_child_head - scale_head).normalized()
+        child_target_rotations.append(v1.rotation_difference(v2))
+
+        # For the wrist bone, always scale to the middle
+        # finger if it's available
+        if (
+            scale_key
+            and "wrist" in scale_key
+            and s_child_key
+            and "middle" in s_child_key
+        ):
+            starting_rotation = v1.rotation_difference(v2)
+            return [scale], [starting_rotation]
 
     return child_target_scales, child_target_rotations
 
 
-def align_bones(ref_bone, scale_bone, arm_thickness, leg_thickness, parent_scale):
-    # Special case - for now don't scale the hands. There's too much
-    # variation in finger finger bone positions. Maybe something to
-    # make into a toglge?
-    # if (
-    #     bone_lookup(scale_bone.name) == "right_wrist"
-    #     or bone_lookup(scale_bone.name) == "left_wrist"
-    # ):
-    #     pass
-
-    # Check that the starting position is the same, partially as a
-    # sanity check. Continuing to align when it's off to start will
-    # throw off every child way more
-    ref_oloc = ref_bone.matrix.decompose()[0]
-    scale_oloc = (
-        scale_bone.matrix @ mathutils.Matrix.Translation(scale_bone.location)
-    ).decompose()[0]
-    if (ref_oloc - scale_oloc).length > 0.01:
-        print(
-            "Bone {} is off by {}, skipping".format(
-                scale_bone.name, ref_oloc - scale_oloc
-            )
+def get_scaling_rotations(ref_bone, scale_bone, correspondence):
+    # Scaling should prioritize having children line up. For every set
+    # of matching children, find the transform needed to the parent to
+    # get the children to line up, then perform the one that makes the
+    # most line up.
+    s_children = {s_child.name: s_child for s_child in scale_bone.children}
+    ref = ref_bone.skeleton
+    child_pairs = (
+        (
+            correspondence.keys[s_child_name],
+            s_children[s_child_name].head,
+            mathutils.Vector(ref.heads[r_child]),
         )
-        return
-
-    child_target_scales, child_target_rotations = get_scaling_rotations(
-        ref_bone, scale_bone
+        for s_child_name, r_child in correspondence.matching_children(
+            s_children, ref_bone.index
+        )
+    )
+    return _scaling_rotations(
+        correspondence.keys[scale_bone.name],
+        scale_bone.head,
+        ref_bone.head,
+        child_pairs,
     )
 
+
+def _scale_vector(
+    scale_key,
+    current_scale,
+    child_target_scales,
+    arm_thickness,
+    leg_thickness,
+    parent_scale,
+):
+    """The scale to give a bone being aligned"""
     # Default to not changing scaling if there are no children
-    scale_vector = scale_bone.scale
+    scale_vector = current_scale
 
     if len(child_target_scales) > 0:
         sf = statistics.median(child_target_scales)
@@ -236,61 +246,267 @@ def align_bones(ref_bone, scale_bone, arm_thickness, leg_thickness, parent_scale
     def lerp(a, b, f):
         return (1 - f) * a + f * b
 
-    if bone_lookup(scale_bone.name) in ["left_leg", "right_leg"]:
+    if scale_key in ["left_leg", "right_leg"]:
         scale_vector = (
-            lerp(scale_bone.scale[0], scale_vector[0], leg_thickness),
+            lerp(current_scale[0], scale_vector[0], leg_thickness),
             scale_vector[1],
-            lerp(scale_bone.scale[2], scale_vector[2], leg_thickness),
+            lerp(current_scale[2], scale_vector[2], leg_thickness),
         )
 
-    if bone_lookup(scale_bone.name) in ["left_arm", "right_arm"]:
+    if scale_key in ["left_arm", "right_arm"]:
         scale_vector = (
-            lerp(scale_bone.scale[0], scale_vector[0], arm_thickness),
+            lerp(current_scale[0], scale_vector[0], arm_thickness),
             scale_vector[1],
-            lerp(scale_bone.scale[2], scale_vector[2], arm_thickness),
+            lerp(current_scale[2], scale_vector[2], arm_thickness),
         )
 
-    if bone_lookup(scale_bone.name) in ["left_wrist", "right_wrist"]:
+    if scale_key in ["left_wrist", "right_wrist"]:
         scale_vector = tuple(1.0 / ps for ps in parent_scale)
 
-    print("Scaling bone {} by factor {}".format(scale_bone.name, scale_vector))
-    scale_bone.scale = scale_vector
-    bpy.context.view_layer.update()
-
-    if len(child_target_rotations) > 0:
-        bq = scale_bone.matrix.to_quaternion()
-        bq.rotate(child_target_rotations[-1])
-        bq.rotate(scale_bone.matrix.inverted())
-        scale_bone.rotation_quaternion = bq
-
-    bpy.context.view_layer.update()
-
-    # Recurse to children with matchinng ames
-    for s_child in scale_bone.children:
-        for r_child in ref_bone.children:
-            if s_child.name == r_child.name or (
-                bone_lookup(s_child.name) != None
-                and bone_lookup(s_child.name) == bone_lookup(r_child.name)
-            ):
-                if not bone_lookup(s_child.name):
-                    print(
-                        "bone {} not a main human armature bone, skipping".format(
-                            s_child.name
-                        )
-                    )
-                    continue
-                align_bones(
-                    r_child,
-                    s_child,
-                    arm_thickness,
-                    leg_thickness,
-                    tuple(
-                        scale_vector[i] * parent_scale[i]
-                        for i in range(len(scale_vector))
-                    ),
+    return scale_vector
+
+
+def _rotated_basis(matrix, rotation):
+    """The rotation_quaternion that rotates a bone posed with matrix by rotation in armature space"""
+    bq = matrix.to_quaternion()
+    bq.rotate(rotation)
+    bq.rotate(matrix.inverted())
+    return bq
+
+
+def align_bones(
+    ref_bone,
+    scale_bone,
+    correspondence,
+    arm_thickness,
+    leg_thickness,
+    parent_scale,
+):
+    """Align scale_bone and its descendants to the ReferenceBone ref_bone, matching bones with the BoneCorrespondence
+    correspondence"""
+    with span("align_bones", bone=scale_bone.name):
+        # Special case - for now don't scale the hands. There's too much
+        # variation in finger finger bone positions. Maybe something to
+        # make into a toglge?
+        # if (
+        #     bone_lookup(scale_bone.name) == "right_wrist"
+        #     or bone_lookup(scale_bone.name) == "left_wrist"
+        # ):
+        #     pass
+
+        # Check that the starting position is the same, partially as a
+        # sanity check. Continuing to align when it's off to start will
+        # throw off every child way more
+        ref_oloc = ref_bone.head
+        scale_oloc = (
+            scale_bone.matrix @ mathutils.Matrix.Translation(scale_bone.location)
+        ).decompose()[0]
+        if (ref_oloc - scale_oloc).length > 0.01:
+            log(
+                "Bone {} is off by {}, skipping",
+                scale_bone.name,
+                ref_oloc - scale_oloc,
+            )
+            return
+
+        child_target_scales, child_target_rotations = get_scaling_rotations(
+            ref_bone, scale_bone, correspondence
+        )
+
+        scale_vector = _scale_vector(
+            correspondence.keys[scale_bone.name],
+            scale_bone.scale,
+            child_target_scales,
+            arm_thickness,
+            leg_thickness,
+            parent_scale,
+        )
+
+        log("Scaling bone {} by factor {}", scale_bone.name, scale_vector)
+        scale_bone.scale = scale_vector
+        view_layer_update()
+
+        if len(child_target_rotations) > 0:
+            scale_bone.rotation_quaternion = _rotated_basis(
+                scale_bone.matrix, child_target_rotations[-1]
+            )
+
+        view_layer_update()
+
+        # Recurse to children with matchinng ames
+        s_children = {s_child.name: s_child for s_child in scale_bone.children}
+        for s_child_name, r_child in correspondence.matching_children(
+            s_children, ref_bone.index
+        ):
+            if not correspondence.keys[s_child_name]:
+                log(
+                    "bone {} not a main human armature bone, skipping",
+                    s_child_name,
+                )
+                continue
+            align_bones(
+                ReferenceBone(ref_bone.skeleton, r_child),
+                s_children[s_child_name],
+                correspondence,
+                arm_thickness,
+                leg_thickness,
+                tuple(
+                    scale_vector[i] * parent_scale[i] for i in range(len(scale_vector))
+                ),
+            )
+
+
+def _head(matrix):
+    return mathutils.Vector(matrix[:3, 3])
+
+
+def align_bones_fk(
+    ref,
+    skeleton,
+    correspondence,
+    matrices,
+    ref_i,
+    scale_i,
+    arm_thickness,
+    leg_thickness,
+    parent_scale,
+):
+    """align_bones() on a Skeleton, changing the pose of skeleton and its pose matrices in matrices instead of the pose
+    of the armature, aligning to the ReferenceSkeleton ref with the bones matched by the BoneCorrespondence
+    correspondence. Every pose matrix needed is solved by forward kinematics, so the depsgraph is never updated."""
+    scale_name = skeleton.names[scale_i]
+    with span("align_bones", bone=scale_name):
+        # Check that the starting position is the same, partially as a
+        # sanity check. Continuing to align when it's off to start will
+        # throw off every child way more
+        ref_oloc = mathutils.Vector(ref.heads[ref_i])
+        scale_translation = np.identity(4)
+        scale_translation[:3, 3] = skeleton.location[scale_i]
+        scale_oloc = _head(matrices[scale_i] @ scale_translation)
+        if (ref_oloc - scale_oloc).length > 0.01:
+            log("Bone {} is off by {}, skipping", scale_name, ref_oloc - scale_oloc)
+            return
+
+        # Pairs of the indices of matching children
+        matching_children = [
+            (skeleton.index[s_child_name], r_child)
+            for s_child_name, r_child in correspondence.matching_children(
+                (skeleton.names[s_child] for s_child in skeleton.children[scale_i]),
+                ref_i,
+            )
+        ]
+        # Where the children currently are, given the current pose of this bone
+        s_children = [s_child for s_child, _r_child in matching_children]
+        skeleton.solve(matrices, s_children)
+        scale_key = correspondence.keys[scale_name]
+        child_target_scales, child_target_rotations = _scaling_rotations(
+            scale_key,
+            _head(matrices[scale_i]),
+            ref_oloc,
+            (
+                (
+                    correspondence.keys[skeleton.names[s_child]],
+                    _head(matrices[s_child]),
+                    mathutils.Vector(ref.heads[r_child]),
                 )
+                for s_child, r_child in matching_children
+            ),
+        )
+
+        scale_vector = _scale_vector(
+            scale_key,
+            tuple(skeleton.scale[scale_i]),
+            child_target_scales,
+            arm_thickness,
+            leg_thickness,
+            parent_scale,
+        )
+
+        log("Scaling bone {} by factor {}", scale_name, scale_vector)
+        skeleton.scale[scale_i] = scale_vector
+        skeleton.solve(matrices, [scale_i])
 
+        if len(child_target_rotations) > 0:
+            skeleton.rotation[scale_i] = _rotated_basis(
+                mathutils.Matrix(matrices[scale_i].tolist()),
+                child_target_rotations[-1],
+            )
+            skeleton.solve(matrices, [scale_i])
+
+        # Recurse to children with matchinng ames
+        for s_child, r_child in matching_children:
+            if not correspondence.keys[skeleton.names[s_child]]:
+                log(
+                    "bone {} not a main human armature bone, skipping",
+                    skeleton.names[s_child],
+                )
+                continue
+            # The pose of this bone is final, so the children can be solved from it
+            skeleton.solve(matrices, [s_child])
+            align_bones_fk(
+                ref,
+                skeleton,
+                correspondence,
+                matrices,
+                r_child,
+                s_child,
+                arm_thickness,
+                leg_thickness,
+                tuple(
+                    scale_vector[i] * parent_scale[i] for i in range(len(scale_vector))
+                ),
+            )
 
+
+_LIMB_STARTS = ["right_leg", "left_leg", "right_shoulder", "left_shoulder"]
+
+
+def align_limbs(ref, scale_arm, arm_thickness, leg_thickness):
+    """Align every limb of scale_arm to the ReferenceSkeleton ref with align_bones_fk(), writing the whole pose in one
+    go at the end.
+    Falls back to align_bones() if scale_arm has bones that the forward kinematics can't pose the same as Blender."""
+    # The pose must be up-to-date to read the pose matrices
+    view_layer_update()
+    skeleton = Skeleton(scale_arm)
+    limb_starts = [
+        skeleton.index[get_bone(name, scale_arm).name] for name in _LIMB_STARTS
+    ]
+    limb_bones = [i for start in limb_starts for i in skeleton.subtree(start)]
+    # Match every bone up front, rather than comparing every pair of children at each level of the recursion
+    correspondence = BoneCorrespondence.between(ref, skeleton.names)
+    reason = skeleton.unsupported_reason(limb_bones)
+    if reason is not None:
+        log("Aligning bone by bone, because {}", reason)
+        for limb_start in _LIMB_STARTS:
+            align_bones(
+                ref.bone(limb_start),
+                get_bone(limb_start, scale_arm),
+                correspondence,
+                arm_thickness,
+                leg_thickness,
+                (1.0, 1.0, 1.0),
+            )
+        return
+
+    matrices = skeleton.read_pose_matrices(scale_arm)
+    for limb_start, scale_i in zip(_LIMB_STARTS, limb_starts):
+        align_bones_fk(
+            ref,
+            skeleton,
+            correspondence,
+            matrices,
+            ref.bone_index(limb_start),
+            scale_i,
+            arm_thickness,
+            leg_thickness,
+            (1.0, 1.0, 1.0),
+        )
+    with span("write pose"):
+        skeleton.write_pose(scale_arm)
+        view_layer_update()
+
+
+@traced()
 def align_armatures(
     context, arm_ref_name, arm_scaling_name, arm_thickness, leg_thickness
 ):
@@ -302,35 +518,71 @@ def align_armatures(
         # Should probably be an error
         return
 
-    start_pose_mode_with_reset(scale_arm)
+    ref = ReferenceSkeleton.from_armature(ref_arm)
+    align_to_reference(context, ref, scale_arm, arm_thickness, leg_thickness)
+
 
-    base_scale = scale_torso(context, ref_arm, scale_arm)
+@traced()
+def align_to_reference(context, ref, scale_arm, arm_thickness, leg_thickness):
+    """Align scale_arm to the ReferenceSkeleton ref"""
+    reset_pose(scale_arm)
+
+    # Only the bones are needed by each step, so with Single Bake When Aligning the meshes are baked once at the end,
+    # rather than every time the pose is applied, at the cost of moving blended vertices, see DeferredPoseBake
+    baker = DeferredPoseBake(
+        scale_arm, deferred=getattr(context.scene, "imscale_align_single_bake", False)
+    )
+
+    base_scale = scale_torso(context, ref, scale_arm, baker)
 
     # Special case for Hips, optional?
     # Leave out for now, it would break spine weighting
     # For now, better to stretch?
 
     # Base case set the hip position
-    # get_bone("hips", scale_arm).matrix = get_bone("hips", ref_arm).matrix
+    # get_bone("hips", scale_arm).matrix = ref.bone("hips").matrix
 
     # A view layer update doesn't cut it for matching hip position,
     # fortunately this is the only time we need to apply and reset in
     # the middle
-    apply_pose_to_rest(arm=scale_arm)
-    start_pose_mode_with_reset(scale_arm)
-
-    # Recursive call to scale each of the limbs
-    for limb_start in ["right_leg", "left_leg", "right_shoulder", "left_shoulder"]:
-        pass
-        align_bones(
-            get_bone(limb_start, ref_arm),
-            get_bone(limb_start, scale_arm),
-            arm_thickness,
-            leg_thickness,
-            (1.0, 1.0, 1.0),
-        )
-
-    apply_pose_to_rest(arm=scale_arm)
+    baker.apply_pose_to_rest()
+    reset_pose(scale_arm)
+
+    # Scale and rotate each bone of each of the limbs
+    align_limbs(ref, scale_arm, arm_thickness, leg_thickness)
+
+    baker.apply_pose_to_rest()
+    baker.bake()
+
+
+# Bones align_to_reference() can't do without
+_REQUIRED_BONES = ["hips", *_LIMB_STARTS]
+
+
+@traced()
+def align_many(context, ref, scale_arms, arm_thickness, leg_thickness) -> List[str]:
+    """Align every armature in scale_arms to the ReferenceSkeleton ref, one after another. The reference is only read
+    once, when ref is created, no matter how many armatures are aligned to it.
+
+    The armature ref was read from is skipped, as are armatures missing any of the bones aligning needs, e.g. props,
+    rather than failing partway through. Returns the names of the armatures skipped for missing bones."""
+    skipped = []
+    for scale_arm in scale_arms:
+        if scale_arm.name == ref.name:
+            # E.g. the armature a template was exported from
+            log("Skipping {}, it is the reference", scale_arm.name)
+            continue
+        missing = [name for name in _REQUIRED_BONES if not check_bone(name, scale_arm)]
+        if missing:
+            log("Skipping {}, it has no {} bones", scale_arm.name, ", ".join(missing))
+            skipped.append(scale_arm.name)
+            continue
+        meshes = get_body_meshes(scale_arm)
+        with span("align", armature=scale_arm.name), temp_ensure_enabled(
+            scale_arm, *meshes
+        ):
+            align_to_reference(context, ref, scale_arm, arm_thickness, leg_thickness)
+    return skipped
 
 
 class ArmatureAlign(ArmatureOperator):
@@ -341,30 +593,148 @@ class ArmatureAlign(ArmatureOperator):
     bl_options = {"REGISTER", "UNDO"}
 
     def execute_main(self, context, arm, meshes):
-        ra = context.scene.objects.get(self.scale_armature_ref)
         sa = context.scene.objects.get(self.scale_armature_arm)
+        if sa is None or sa.type != "ARMATURE":
+            self.report({"ERROR"}, "Select the Scaling Armature to align")
+            return {"CANCELLED"}
+        if not self.reference_template:
+            ra = context.scene.objects.get(self.scale_armature_ref)
+            meshes = get_body_meshes(sa)
+            with temp_ensure_enabled(sa, ra, *meshes):
+                align_armatures(
+                    context,
+                    self.scale_armature_ref,
+                    self.scale_armature_arm,
+                    self.arm_thickness / 100.0,
+                    self.leg_thickness / 100.0,
+                )
+            return {"FINISHED"}
+
+        # Aligning to a template doesn't need the reference armature at all
+        try:
+            ref = read_reference(None, self.reference_template)
+        except (KeyError, OSError, ValueError) as e:
+            self.report({"ERROR"}, str(e))
+            return {"CANCELLED"}
         meshes = get_body_meshes(sa)
-        with temp_ensure_enabled(sa, ra, *meshes):
-            align_armatures(
+        with temp_ensure_enabled(sa, *meshes):
+            align_to_reference(
                 context,
-                self.scale_armature_ref,
-                self.scale_armature_arm,
+                ref,
+                sa,
                 self.arm_thickness / 100.0,
                 self.leg_thickness / 100.0,
             )
-
         return {"FINISHED"}
 
+    def snapshot_armature(self, context):
+        # The Scaling Armature is the one changed, which may not be the armature found by get_armature()
+        return context.scene.objects.get(self.scale_armature_arm)
+
     def invoke(self, context, event):
         s = context.scene
 
         self.scale_armature_ref = s.imscale_scale_armature_ref
         self.scale_armature_arm = s.imscale_scale_armature_arm
+        self.reference_template = s.imscale_reference_template
         self.arm_thickness = s.arm_thickness
         self.leg_thickness = s.leg_thickness
         return self.execute(context)
 
 
+class ArmatureAlignBatch(ArmatureOperator):
+    """Aligns every selected armature to the reference armature"""
+
+    bl_idname = "armature.imscale_align_batch"
+    bl_label = "Align Selected Armatures"
+    bl_options = {"REGISTER", "UNDO"}
+
+    def execute_main(self, context, arm, meshes):
+        objects = context.scene.objects
+        ref_arm = objects.get(self.scale_armature_ref)
+        # The reference armature is never aligned, even when a template is used instead of it
+        targets = [
+            objects[name]
+            for name in self.scale_armature_names
+            if name in objects and objects[name] != ref_arm
+        ]
+        ra = None if self.reference_template else ref_arm
+        if not targets:
+            self.report({"ERROR"}, "Select the armatures to align to the reference")
+            return {"CANCELLED"}
+        try:
+            ref = read_reference(ra, self.reference_template)
+        except (KeyError, OSError, ValueError) as e:
+            self.report({"ERROR"}, str(e))
+            return {"CANCELLED"}
+        skipped = align_many(
+            context,
+            ref,
+            targets,
+            self.arm_thickness / 100.0,
+            self.leg_thickness / 100.0,
+        )
+        log("Aligned {} armatures to {}", len(targets) - len(skipped), ref.name)
+        if skipped:
+            self.report(
+                {"WARNING"},
+                "Skipped armatures without humanoid bones: {}".format(
+                    ", ".join(skipped)
+                ),
+            )
+        return {"FINISHED"}
+
+    def invoke(self, context, event):
+        s = context.scene
+
+        self.scale_armature_ref = s.imscale_scale_armature_ref
+        self.reference_template = s.imscale_reference_template
+        self.scale_armature_names = [
+            obj.name for obj in context.selected_objects if obj.type == "ARMATURE"
+        ]
+        self.arm_thickness = s.arm_thickness
+        self.leg_thickness = s.leg_thickness
+        return self.execute(context)
+
+
+class ExportReferenceTemplate(bpy.types.Operator):
+    """Save the humanoid skeleton of the reference armature to a file that armatures can be aligned to without the
+    reference armature"""
+
+    bl_idname = "armature.imscale_export_reference"
+    bl_label = "Export Reference Template"
+    bl_options = {"REGISTER"}
+
+    filepath: bpy.props.StringProperty(subtype="FILE_PATH")
+    filter_glob: bpy.props.StringProperty(default="*.json", options={"HIDDEN"})
+
+    @classmethod
+    def poll(cls, context):
+        return (
+            context.scene.objects.get(context.scene.imscale_scale_armature_ref)
+            is not None
+        )
+
+    def execute(self, context):
+        ra = context.scene.objects.get(context.scene.imscale_scale_armature_ref)
+        path = bpy.path.ensure_ext(bpy.path.abspath(self.filepath), ".json")
+        try:
+            save_template(read_reference(ra), path)
+        except (KeyError, OSError, ValueError) as e:
+            self.report({"ERROR"}, str(e))
+            return {"CANCELLED"}
+        # Use the template straight away
+        context.scene.imscale_reference_template = path
+        self.report({"INFO"}, "Saved {}".format(path))
+        return {"FINISHED"}
+
+    def invoke(self, context, event):
+        if not self.filepath:
+            self.filepath = context.scene.imscale_scale_armature_ref + ".json"
+        context.window_manager.fileselect_add(self)
+        return {"RUNNING_MODAL"}
+
+
 ## Ui operators
 class SearchMenuOperator_scale_armature_ref(bpy.types.Operator):
     bl_description = "Select the armature to use as a reference for scaling"
@@ -410,9 +780,15 @@ class SearchMenuOperator_scale_armature_arm(bpy.types.Operator):
         return {"FINISHED"}
 
 
+ArmatureAlignNoUndo = no_undo_variant(ArmatureAlign)
+
+
 _register, _unregister = bpy.utils.register_classes_factory(
     [
         ArmatureAlign,
+        ArmatureAlignNoUndo,
+        ArmatureAlignBatch,
+        ExportReferenceTemplate,
         SearchMenuOperator_scale_armature_ref,
         SearchMenuOperator_scale_armature_arm,
     ]
@@ -422,10 +798,13 @@ _register, _unregister = bpy.utils.register_classes_factory(
 def ops_register():
     print("Registering Armature Aligning add-on")
     _register()
+    add_app_handlers(CORRESPONDENCE_HANDLERS)
 
 
 def ops_unregister():
     print("Deregistering Armature Aligning add-on")
+    remove_app_handlers(CORRESPONDENCE_HANDLERS)
+    invalidate_scene_correspondence()
     _unregister()
 
 
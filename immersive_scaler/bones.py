@@ -2,12 +2,13 @@ import bpy
 import importlib
 
 from sys import intern
+from typing import Dict, List, Tuple
 
 from . import common
 
 importlib.reload(common)
 
-from .common import get_armature
+from .common import add_app_handlers, get_armature, remove_app_handlers
 
 bone_names = {
     "right_shoulder": ["rightshoulder", "shoulderr", "rshoulder"],
@@ -122,65 +123,188 @@ bone_names = {
 }
 
 
+# Characters that are ignored when comparing bone names against the names in bone_names
+_NAME_STRIP_TABLE = dict.fromkeys(map(ord, " _.-"))
+
+
+def _normalize_bone_name(name):
+    return name.lower().translate(_NAME_STRIP_TABLE)
+
+
+# Normalized bone name -> humanoid bone name. Some names are listed for more than one humanoid bone, in which case the
+# humanoid bone that comes first in bone_names is used.
+_ALIAS_TABLE = {}
+for _token, _names in bone_names.items():
+    for _name in _names:
+        _ALIAS_TABLE.setdefault(_name, _token)
+del _token, _names, _name
+
+# Scene -> {overriding bone name: humanoid bone name}
+_OVERRIDE_INDEX: Dict[int, Dict[str, str]] = {}
+
+
+def _get_override_index():
+    scene = bpy.context.scene
+    key = scene.as_pointer()
+    override_index = _OVERRIDE_INDEX.get(key)
+    if override_index is None:
+        override_index = {}
+        for bone in bone_names:
+            override = getattr(scene, "override_" + bone)
+            if override != "_None":
+                # If a bone overrides more than one humanoid bone, the first one wins
+                override_index.setdefault(override, bone)
+        _OVERRIDE_INDEX[key] = override_index
+    return override_index
+
+
 def bone_lookup(name):
-    # Now using overrides
-
-    # Need to scan through every override and test if they reference
-    # the bone in qeustion.
-    for bone in bone_names:
-        # Hopefully using the right context here. Is there a way you
-        # could be using a different scene somehow?
-        override = getattr(bpy.context.scene, "override_" + bone)
-        if override == name:
-            return bone
-
-    lower_name = (
-        name.lower().replace("_", "").replace("-", "").replace(" ", "").replace(".", "")
-    )
-    for token in bone_names:
-        if lower_name in bone_names[token]:
-            return token
-    return None
+    # Overrides take priority. Rather than reading every override scene property, look the bone up in the reverse
+    # index, which is only rebuilt after an override has changed.
+    bone = _get_override_index().get(name)
+    if bone is not None:
+        return bone
+    return _ALIAS_TABLE.get(_normalize_bone_name(name))
+
+
+class _ResolvedBones:
+    """Humanoid bone names resolved to the names of the bones of one armature"""
+
+    __slots__ = ("num_bones", "normalized", "resolved")
+
+    def __init__(self, arm):
+        pose_bones = arm.pose.bones
+        self.num_bones = len(pose_bones)
+        # If multiple bones normalize to the same name, the last one wins, same as building a dict from a list of pairs
+        self.normalized = {_normalize_bone_name(b.name): b.name for b in pose_bones}
+        # humanoid bone name -> bone name, or None when the armature has no such bone
+        self.resolved = {}
+
+
+# Overrides are scene properties, so the same armature can resolve differently in different scenes
+_RESOLVED_BONES_CACHE: Dict[Tuple[int, int], _ResolvedBones] = {}
+
+
+def invalidate_bone_cache():
+    """Forget all resolved bones and overrides. Called whenever an override_* scene property changes."""
+    _RESOLVED_BONES_CACHE.clear()
+    _OVERRIDE_INDEX.clear()
+
+
+def _get_resolved_bones(arm, rebuild=False):
+    key = (bpy.context.scene.as_pointer(), arm.as_pointer())
+    resolved_bones = _RESOLVED_BONES_CACHE.get(key)
+    # Bones being added or removed changes the number of bones, in which case everything has to be resolved again
+    if (
+        rebuild
+        or resolved_bones is None
+        or resolved_bones.num_bones != len(arm.pose.bones)
+    ):
+        resolved_bones = _ResolvedBones(arm)
+        _RESOLVED_BONES_CACHE[key] = resolved_bones
+    return resolved_bones
+
+
+def _resolve_bone_name(name, arm):
+    """Get the name of the bone of arm that is used for the humanoid bone name, or None if there isn't one"""
+    resolved_bones = _get_resolved_bones(arm)
+    resolved = resolved_bones.resolved
+    if name in resolved:
+        bone_name = resolved[name]
+        if bone_name is None or bone_name in arm.pose.bones:
+            return bone_name
+        # The bone has been renamed since it was resolved
+        resolved_bones = _get_resolved_bones(arm, rebuild=True)
+        resolved = resolved_bones.resolved
+
+    bone_name = None
+    # First check that there's no override
+    override = getattr(bpy.context.scene, "override_" + name)
+    if override != "_None" and override in arm.pose.bones:
+        bone_name = override
+    else:
+        normalized = resolved_bones.normalized
+        for n in bone_names[name]:
+            if n in normalized:
+                bone_name = normalized[n]
+                break
+    resolved[name] = bone_name
+    return bone_name
 
 
 def check_bone(name, arm):
     """To be used to check optional features that don't requrie a core bone to be present
 
     Returns True if the bone is present, otherwise False"""
-    s = bpy.context.scene
-    override = getattr(s, "override_" + name)
-    if override != "_None" and name in arm.pose.bones:
-        return True
-    name_list = bone_names[name]
-    bone_lookup = dict(
-        [
-            (bone.name.lower().translate(dict.fromkeys(map(ord, " _.-"))), bone)
-            for bone in arm.pose.bones
-        ]
-    )
-    for n in name_list:
-        if n in bone_lookup:
-            return True
-    return False
+    return _resolve_bone_name(name, arm) is not None
 
 
 def get_bone(name, arm):
-    # First check that there's no override
-    s = bpy.context.scene
-    override = getattr(s, "override_" + name)
-    if override != "_None":
-        return arm.pose.bones[override]
-    name_list = bone_names[name]
-    bone_lookup = dict(
-        [
-            (bone.name.lower().translate(dict.fromkeys(map(ord, " _.-"))), bone)
-            for bone in arm.pose.bones
-        ]
-    )
-    for n in name_list:
-        if n in bone_lookup:
-            return bone_lookup[n]
-    return arm.pose.bones[name]
+    bone_name = _resolve_bone_name(name, arm)
+    if bone_name is None:
+        return arm.pose.bones[name]
+    return arm.pose.bones[bone_name]
+
+
+_NO_BONE_ITEMS = [("_None",) * 3]
+
+# (armature Object, armature data) -> (bone set fingerprint, enum items)
+_BONE_ENUM_CACHE: Dict[Tuple[int, int], Tuple[tuple, List[Tuple[str, str, str]]]] = {}
+
+
+def _bone_set_fingerprint(bones) -> tuple:
+    # Cheap enough to check every time the items are asked for, unlike hashing every name. Renames of the other bones
+    # are caught by the depsgraph handler.
+    num_bones = len(bones)
+    if num_bones == 0:
+        return (0,)
+    return num_bones, bones[0].name, bones[-1].name
+
+
+def get_bone_enum_items(arm) -> List[Tuple[str, str, str]]:
+    """Items for an EnumProperty choosing a bone of arm, starting with "_None".
+
+    The items callback of every override_* property calls this, which happens every time one of them is drawn or read,
+    so the list is only rebuilt when the bones of arm have changed."""
+    if arm is None:
+        return _NO_BONE_ITEMS
+    bones = arm.data.bones
+    key = (arm.as_pointer(), arm.data.as_pointer())
+    fingerprint = _bone_set_fingerprint(bones)
+    cached = _BONE_ENUM_CACHE.get(key)
+    if cached is not None and cached[0] == fingerprint:
+        return cached[1]
+    # intern each string in the enum items to ensure Python has its own reference to it. Storing the list of choices in
+    # bpy.types.Object.Enum doesn't seem to work properly for some reason, but keeping it in our own cache works fine
+    items = _NO_BONE_ITEMS + [(intern(b.name),) * 3 for b in bones]
+    _BONE_ENUM_CACHE[key] = (fingerprint, items)
+    return items
+
+
+@bpy.app.handlers.persistent
+def _bone_enum_depsgraph_handler(scene, depsgraph=None):
+    # depsgraph only gets passed to handlers in Blender 2.91+. Bones being renamed, added or removed updates the armature
+    # data.
+    if depsgraph is None or depsgraph.id_type_updated("ARMATURE"):
+        _BONE_ENUM_CACHE.clear()
+        # A bone that wasn't found is cached as None, so it must be looked up again once a bone could have been renamed
+        # to match
+        _RESOLVED_BONES_CACHE.clear()
+
+
+@bpy.app.handlers.persistent
+def _bone_cache_reset_handler(*args):
+    # Loading a file or undoing/redoing frees every armature, so their pointers could be reused by different armatures
+    _BONE_ENUM_CACHE.clear()
+    invalidate_bone_cache()
+
+
+_BONE_CACHE_HANDLERS = (
+    ("depsgraph_update_post", _bone_enum_depsgraph_handler),
+    ("load_post", _bone_cache_reset_handler),
+    ("undo_post", _bone_cache_reset_handler),
+    ("redo_post", _bone_cache_reset_handler),
+)
 
 
 class SearchMenuOperator_bone_selection(bpy.types.Operator):
@@ -192,16 +316,7 @@ class SearchMenuOperator_bone_selection(bpy.types.Operator):
     bone_name: bpy.props.StringProperty()
 
     def getbones(self, context):
-        global _ENUM_CACHE
-        choices = [("_None",) * 3]
-        arm = get_armature()
-        if arm is not None:
-            # intern each string in the enum items to ensure Python has its own reference to it
-            choices = choices + list((intern(b.name),) * 3 for b in arm.data.bones)
-        # Storing the list of choices in bpy.types.Object.Enum doesn't seem to work properly for some reason, but we can
-        # use our own cache fine
-        _ENUM_CACHE = choices
-        return choices
+        return get_bone_enum_items(get_armature())
 
     my_enum: bpy.props.EnumProperty(
         name="Scaling Active Armature",
@@ -228,10 +343,13 @@ _register, _unregister = bpy.utils.register_classes_factory(
 def ops_register():
     print("Registering imscale bone selection")
     _register()
+    add_app_handlers(_BONE_CACHE_HANDLERS)
 
 
 def ops_unregister():
     print("Deregistering imscale bone selection")
+    remove_app_handlers(_BONE_CACHE_HANDLERS)
+    _BONE_ENUM_CACHE.clear()
     _unregister()
 
 
@@ -0,0 +1,344 @@
+"""Command line entry point for running Immersive Scaler on .blend files without the UI.
+
+Run with Blender in background mode, arguments for this script go after '--':
+
+    blender --background --factory-startup --python immersive_scaler/cli.py -- \\
+        --input avatar.blend --output avatar_rescaled.blend --params params.json --result result.json
+
+The parameter file is a JSON object. "armature" picks the armature to work on and "steps" lists what to run, in order,
+out of "rescale", "spread_fingers", "shrink_hips", "align", "align_all" and "export_reference" (default ["rescale"]).
+"align_all" aligns every armature in the file with humanoid bones other than the reference, reading the reference only
+once.
+"export_reference" saves the reference armature as a reference template to "imscale_reference_template", which "align"
+and "align_all" then align to instead of the reference armature, without needing the reference in the file at all.
+"reference_file" is a .blend file to append the reference armature from, when it isn't in the input file. Every other
+key sets the scene property of the same name, using the same values as the UI, e.g.
+
+    {"target_height": 1.65, "upper_body_percentage": 44, "custom_scale_ratio": 0.43, "arm_thickness": 50}
+
+The result is written as JSON to --result, or printed on a line starting with RESULT_PREFIX when --result isn't given.
+"""
+import os
+import sys
+
+if __name__ == "__main__" and not __package__:
+    # Run as a script by Blender, so the relative imports below won't work. Import the add-on as a package instead and
+    # run the package's copy of this module.
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from immersive_scaler import cli as _cli
+
+    sys.exit(_cli.main())
+
+import argparse
+import bpy
+import importlib
+import json
+import time
+import traceback
+
+from typing import Any, Dict, List, Optional
+
+from . import align
+from . import common
+from . import instrument
+from . import operations
+from . import reference
+from . import spread_fingers
+from . import weights
+
+importlib.reload(align)
+importlib.reload(common)
+importlib.reload(instrument)
+importlib.reload(operations)
+importlib.reload(reference)
+importlib.reload(spread_fingers)
+importlib.reload(weights)
+
+from .common import get_armature, get_body_meshes, temp_ensure_enabled
+
+
+RESULT_PREFIX = "IMSCALE_RESULT "
+
+# Keys of the parameter file that aren't scene properties
+_RESERVED_PARAMS = {"armature", "steps", "reference_file"}
+
+
+def _rescale(scene):
+    operations.rescale_main_from_scene(scene)
+
+
+def _spread_fingers(scene):
+    spread_fingers.spread_fingers(scene.spare_thumb, scene.spread_factor)
+
+
+def _shrink_hips(scene):
+    operations.shrink_hips()
+
+
+def _reference_arm(scene):
+    if scene.imscale_reference_template:
+        return None
+    ref_arm = scene.objects.get(scene.imscale_scale_armature_ref)
+    if ref_arm is None:
+        raise KeyError(
+            "'imscale_scale_armature_ref' or 'imscale_reference_template' must be set"
+            " to align armatures"
+        )
+    return ref_arm
+
+
+def _align(scene):
+    ref_arm = _reference_arm(scene)
+    scale_arm = scene.objects.get(scene.imscale_scale_armature_arm)
+    if scale_arm is None or scale_arm.type != "ARMATURE":
+        raise KeyError(
+            "'imscale_scale_armature_arm' must be set to an armature to align"
+        )
+    if scale_arm == ref_arm:
+        return
+    ref = reference.read_reference(ref_arm, scene.imscale_reference_template)
+    with temp_ensure_enabled(scale_arm, *get_body_meshes(scale_arm)):
+        align.align_to_reference(
+            bpy.context,
+            ref,
+            scale_arm,
+            scene.arm_thickness / 100.0,
+            scene.leg_thickness / 100.0,
+        )
+
+
+def _align_all(scene):
+    ref = reference.read_reference(
+        _reference_arm(scene), scene.imscale_reference_template
+    )
+    # The reference armature isn't aligned even when a template is used, armatures without humanoid bones are skipped
+    # by align_many()
+    ref_arm = scene.objects.get(scene.imscale_scale_armature_ref)
+    targets = [
+        obj for obj in scene.objects if obj.type == "ARMATURE" and obj != ref_arm
+    ]
+    skipped = align.align_many(
+        bpy.context,
+        ref,
+        targets,
+        scene.arm_thickness / 100.0,
+        scene.leg_thickness / 100.0,
+    )
+    if skipped:
+        instrument.log(
+            "Skipped armatures without humanoid bones: {}", ", ".join(skipped)
+        )
+
+
+def _export_reference(scene):
+    ref_arm = scene.objects.get(scene.imscale_scale_armature_ref)
+    if ref_arm is None or not scene.imscale_reference_template:
+        raise KeyError(
+            "'export_reference' needs 'imscale_scale_armature_ref' and"
+            " 'imscale_reference_template' to be set"
+        )
+    reference.save_template(
+        reference.read_reference(ref_arm),
+        bpy.path.abspath(scene.imscale_reference_template),
+    )
+
+
+STEPS = {
+    "rescale": _rescale,
+    "spread_fingers": _spread_fingers,
+    "shrink_hips": _shrink_hips,
+    "align": _align,
+    "align_all": _align_all,
+    "export_reference": _export_reference,
+}
+
+
+def parse_args(argv: Optional[List[str]] = None):
+    if argv is None:
+        # Blender ignores everything after '--', leaving it for scripts
+        argv = sys.argv[sys.argv.index("--") + 1 :] if "--" in sys.argv else []
+    parser = argparse.ArgumentParser(
+        prog="blender --background --python cli.py --",
+        description="Run Immersive Scaler on a .blend file without the UI",
+    )
+    parser.add_argument(
+        "--input", help=".blend file to open, defaults to the file already open"
+    )
+    parser.add_argument("--output", help=".blend file to save the result to")
+    parser.add_argument("--params", help="JSON parameter file")
+    parser.add_argument("--result", help="JSON file to write the result to")
+    return parser.parse_args(argv)
+
+
+def load_params(path: Optional[str]) -> Dict[str, Any]:
+    if not path:
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        params = json.load(f)
+    if not isinstance(params, dict):
+        raise ValueError("The parameter file must contain a JSON object")
+    return params
+
+
+def append_armature(scene: bpy.types.Scene, filepath: str, name: str):
+    """Append the armature Object called name from the .blend file at filepath and link it into scene"""
+    with bpy.data.libraries.load(filepath, link=False) as (data_from, data_to):
+        if name not in data_from.objects:
+            raise KeyError(f"No object named '{name}' in {filepath}")
+        data_to.objects = [name]
+    obj = data_to.objects[0]
+    if obj.type != "ARMATURE":
+        raise TypeError(f"'{name}' in {filepath} is not an armature")
+    scene.collection.objects.link(obj)
+    return obj
+
+
+def apply_params(scene: bpy.types.Scene, params: Dict[str, Any]):
+    """Set the scene properties in params, checking that they exist first, so typos don't go unnoticed"""
+    properties = scene.bl_rna.properties
+    for key, value in params.items():
+        if key in _RESERVED_PARAMS:
+            continue
+        if key not in properties:
+            raise KeyError(f"Unknown parameter '{key}'")
+        setattr(scene, key, value)
+
+
+def measure_proportions(arm) -> Dict[str, float]:
+    """Measure the proportions the UI lets you get from the current avatar, in the same units as the UI"""
+    measurements = operations.AvatarMeasurements(arm)
+    lowest_point = measurements.lowest_point
+    eye_height = measurements.eye_height - lowest_point
+    leg_proportions, _total_length = measurements.leg_proportions
+    return {
+        "height": measurements.highest_point - lowest_point,
+        "eye_height": eye_height,
+        "upper_body_percentage": measurements.upper_body_portion * 100,
+        "thigh_percentage": leg_proportions[1] / leg_proportions[2] * 100,
+        # Same as the Get Current Avatar Scale Ratio button
+        "custom_scale_ratio": measurements.head_to_hand / (eye_height - 0.005),
+    }
+
+
+def _try_measure_proportions(arm):
+    try:
+        return measure_proportions(arm)
+    except Exception as e:
+        return {"error": str(e)}
+
+
+def run(args) -> Dict[str, Any]:
+    """Run the steps in the parameter file, returning the result"""
+    timings = {}
+    result = {
+        "status": "error",
+        "input": args.input,
+        "output": args.output,
+        "timings": timings,
+    }
+    start = time.perf_counter()
+    try:
+        params = load_params(args.params)
+        steps = params.get("steps", ["rescale"])
+        result["steps"] = steps
+        for step in steps:
+            if step not in STEPS:
+                raise KeyError(f"Unknown step '{step}', expected one of {list(STEPS)}")
+
+        if args.input:
+            phase_start = time.perf_counter()
+            bpy.ops.wm.open_mainfile(filepath=args.input)
+            timings["load"] = time.perf_counter() - phase_start
+
+        context = bpy.context
+        scene = context.scene
+        reference_file = params.get("reference_file")
+        if reference_file:
+            # Appended before setting the scene properties, because the reference armature can only be picked once
+            # it's in the scene
+            ref_name = params.get("imscale_scale_armature_ref")
+            if not ref_name:
+                raise KeyError(
+                    "'reference_file' needs 'imscale_scale_armature_ref' to be set"
+                )
+            ref_arm = append_armature(scene, reference_file, ref_name)
+            # The appended armature gets renamed if the input file already has an Object with the same name
+            params = dict(params, imscale_scale_armature_ref=ref_arm.name)
+        apply_params(scene, params)
+
+        armature_name = params.get("armature")
+        if armature_name:
+            arm = scene.objects.get(armature_name)
+            if arm is None or arm.type != "ARMATURE":
+                raise KeyError(f"No armature named '{armature_name}' in the scene")
+            context.view_layer.objects.active = arm
+        arm = get_armature()
+        if arm is None:
+            raise RuntimeError(
+                "Armature not found. Set 'armature' in the parameter file when"
+                " there is more than one"
+            )
+        result["armature"] = arm.name
+        result["before"] = _try_measure_proportions(arm)
+
+        # Counts of the expensive Blender API calls made by each step
+        api_calls = result["api_calls"] = {}
+        # Traced and memory profiled when the IMSCALE_TRACE and IMSCALE_MEMORY environment variables or the imscale_trace
+        # and imscale_profile_memory parameters are set
+        instrument.last_memory_report = None
+        with instrument.memory_run("cli"), instrument.trace_run(
+            "cli", input=args.input
+        ):
+            for step in steps:
+                phase_start = time.perf_counter()
+                with instrument.count_calls() as counts:
+                    # Same preparation as common.ArmatureOperator
+                    weights.clear_weights_cache()
+                    if context.mode != "OBJECT":
+                        instrument.mode_set(mode="OBJECT")
+                    with instrument.span(step), temp_ensure_enabled(
+                        arm, *get_body_meshes(arm)
+                    ):
+                        STEPS[step](scene)
+                timings[step] = time.perf_counter() - phase_start
+                api_calls[step] = counts
+                instrument.log("{}: {}", step, instrument.format_counts(counts))
+        if instrument.last_trace_path:
+            result["trace"] = instrument.last_trace_path
+        if instrument.last_memory_report:
+            result["memory"] = instrument.last_memory_report
+
+        weights.clear_weights_cache()
+        result["after"] = _try_measure_proportions(arm)
+
+        if args.output:
+            phase_start = time.perf_counter()
+            bpy.ops.wm.save_as_mainfile(filepath=os.path.abspath(args.output))
+            timings["save"] = time.perf_counter() - phase_start
+        result["status"] = "ok"
+    except Exception as e:
+        result["error"] = "{}: {}".format(type(e).__name__, e)
+        result["traceback"] = traceback.format_exc()
+    timings["total"] = time.perf_counter() - start
+    return result
+
+
+def write_result(result: Dict[str, Any], path: Optional[str]):
+    if path:
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2)
+    else:
+        print(RESULT_PREFIX + json.dumps(result))
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+
+    # The scene properties and operators only exist once the add-on is registered
+    package = sys.modules[__package__]
+    if not hasattr(bpy.types.Scene, "target_height"):
+        package.register()
+
+    result = run(args)
+    write_result(result, args.result)
+    return 0 if result["status"] == "ok" else 1
@@ -1,9 +1,177 @@
 import bpy
+import importlib
 from contextlib import contextmanager
 
-from typing import Optional, Any, Set, Dict, List
+from typing import Optional, Any, Set, Dict, Generator, List, Tuple
 from itertools import chain
 
+from . import instrument
+from . import weights
+
+importlib.reload(instrument)
+importlib.reload(weights)
+
+
+class SceneIndex:
+    """Lookups that would otherwise need a scan through every Object in the scene, view layer or blend file each time.
+
+    Built lazily by get_scene_index() and thrown away by a depsgraph_update_post handler whenever Objects have been
+    moved, or Collections or Scenes have been updated, outside of a frozen_scene_index() block, so looking up the
+    children of an Object or checking that an Object is in the view layer takes O(1) or O(k) time instead of
+    O(len(bpy.data.objects))."""
+
+    __slots__ = (
+        "key",
+        "scene_armatures",
+        "view_layer_objects",
+        "view_layer_armatures",
+        "armature_items",
+        "children",
+        "child_of",
+    )
+
+    def __init__(self, key, scene: bpy.types.Scene, view_layer: bpy.types.ViewLayer):
+        self.key = key
+        self.scene_armatures = [o for o in scene.objects if o.type == "ARMATURE"]
+        vl_objects = view_layer.objects
+        # bpy_struct hashes and compares by pointer, so Objects can be used in sets and as dict keys
+        self.view_layer_objects = set(vl_objects)
+        self.view_layer_armatures = [o for o in vl_objects if o.type == "ARMATURE"]
+        # Items for EnumProperties listing the armatures. Blender doesn't keep its own reference to strings returned by
+        # an items callback, so keeping the list here also keeps the strings alive.
+        self.armature_items = [(o.name,) * 3 for o in self.view_layer_armatures]
+
+        # Object -> its direct children and 'Child Of' constraint target -> constrained Objects, from every Object in the
+        # blend file, the same as Object.children
+        children: Dict[bpy.types.Object, List[bpy.types.Object]] = {}
+        child_of: Dict[bpy.types.Object, List[bpy.types.Object]] = {}
+        for o in bpy.data.objects:
+            parent = o.parent
+            if parent is not None:
+                children.setdefault(parent, []).append(o)
+            constraint = o.constraints.get("Child Of")
+            if constraint is not None and constraint.target is not None:
+                child_of.setdefault(constraint.target, []).append(o)
+        self.children = children
+        self.child_of = child_of
+
+
+_SCENE_INDEX: Optional[SceneIndex] = None
+
+
+def _scene_index_key(scene, view_layer) -> Tuple[int, int, int]:
+    # The number of Objects is a cheap check that catches Objects being added or removed by a script before the
+    # depsgraph has been updated
+    return scene.as_pointer(), view_layer.as_pointer(), len(bpy.data.objects)
+
+
+def get_scene_index(context: Optional[bpy.types.Context] = None) -> SceneIndex:
+    """Get the SceneIndex of the current scene and view layer, building it if it doesn't exist or is out of date"""
+    global _SCENE_INDEX
+    if context is None:
+        context = bpy.context
+    scene = context.scene
+    view_layer = context.view_layer
+    key = _scene_index_key(scene, view_layer)
+    index = _SCENE_INDEX
+    if index is None or index.key != key:
+        with instrument.span("build scene index"):
+            index = _SCENE_INDEX = SceneIndex(key, scene, view_layer)
+    return index
+
+
+def invalidate_scene_index():
+    """Forget the SceneIndex. Must be called after changing which Objects are in the scene or what they are parented or
+    constrained to, when the depsgraph won't be updated before the index is used again."""
+    global _SCENE_INDEX
+    _SCENE_INDEX = None
+
+
+# Number of frozen_scene_index() blocks currently running
+_SCENE_INDEX_FREEZES = 0
+
+
+@contextmanager
+def frozen_scene_index():
+    """Keep the SceneIndex through depsgraph updates while running. The operators pose, move and bake Objects, which
+    updates the depsgraph again and again, but never reparent them or change which are in the scene, except through
+    temp_ensure_enabled(), which invalidates the index itself."""
+    global _SCENE_INDEX_FREEZES
+    _SCENE_INDEX_FREEZES += 1
+    try:
+        yield
+    finally:
+        _SCENE_INDEX_FREEZES -= 1
+
+
+def _objects_moved(depsgraph) -> bool:
+    """Whether any Object has had its transform updated, which is how parenting and constraint changes show up. Posing
+    an armature only updates its geometry."""
+    for update in depsgraph.updates:
+        if update.is_updated_transform and isinstance(update.id, bpy.types.Object):
+            return True
+    return False
+
+
+@bpy.app.handlers.persistent
+def _scene_index_depsgraph_handler(scene, depsgraph=None):
+    if _SCENE_INDEX_FREEZES:
+        return
+    # depsgraph only gets passed to handlers in Blender 2.91+
+    if depsgraph is not None and not (
+        depsgraph.id_type_updated("COLLECTION")
+        or depsgraph.id_type_updated("SCENE")
+        or depsgraph.id_type_updated("OBJECT")
+        and _objects_moved(depsgraph)
+    ):
+        # e.g. only materials or meshes were changed, or an armature was posed
+        return
+    invalidate_scene_index()
+
+
+@bpy.app.handlers.persistent
+def _scene_index_reset_handler(*args):
+    # Loading a file or undoing/redoing replaces every Object, so the Objects in the index are no longer valid
+    invalidate_scene_index()
+
+
+_SCENE_INDEX_HANDLERS = (
+    ("depsgraph_update_post", _scene_index_depsgraph_handler),
+    ("load_post", _scene_index_reset_handler),
+    ("undo_post", _scene_index_reset_handler),
+    ("redo_post", _scene_index_reset_handler),
+)
+
+
+def add_app_handlers(handlers):
+    """Add each (handler list name, function) pair in handlers to bpy.app.handlers, replacing any earlier version of the
+    function"""
+    remove_app_handlers(handlers)
+    for handler_list_name, handler in handlers:
+        getattr(bpy.app.handlers, handler_list_name).append(handler)
+
+
+def remove_app_handlers(handlers):
+    # Compare by module and name, because reloading a module creates new functions, while the old functions are still in
+    # the handler lists
+    for handler_list_name, handler in handlers:
+        handler_list = getattr(bpy.app.handlers, handler_list_name)
+        for h in list(handler_list):
+            if (
+                getattr(h, "__module__", None) == handler.__module__
+                and getattr(h, "__name__", None) == handler.__name__
+            ):
+                handler_list.remove(h)
+
+
+def register_handlers():
+    add_app_handlers(_SCENE_INDEX_HANDLERS)
+
+
+def unregister_handlers():
+    invalidate_scene_index()
+    remove_app_handlers(_SCENE_INDEX_HANDLERS)
+
 
 def get_armature() -> Optional[bpy.types.Object]:
     context = bpy.context
@@ -32,23 +200,15 @@ def get_armature() -> Optional[bpy.types.Object]:
         return obj
 
     # Look through all armature objects, if there's only one, use that
-    obj = None
-    for o in scene.objects:
-        if o.type == "ARMATURE":
-            if obj is None:
-                obj = o
-            else:
-                # There's more than one, we don't know which to use, so return None
-                return None
-    return obj
+    scene_armatures = get_scene_index(context).scene_armatures
+    if len(scene_armatures) == 1:
+        return scene_armatures[0]
+    # Either there are none or there's more than one and we don't know which to use
+    return None
 
 
 def get_all_armatures(self, context):
-    return [
-        (o.name, o.name, o.name)
-        for o in context.view_layer.objects
-        if o.type == "ARMATURE"
-    ]
+    return get_scene_index(context).armature_items
 
 
 if bpy.app.version >= (3, 2):
@@ -71,6 +231,7 @@ if bpy.app.version >= (3, 2):
 
         if context is None:
             context = bpy.context
+        instrument.count_operator(operator)
         with context.temp_override(**context_override):
             return operator(*args, **operator_args)
 
@@ -95,6 +256,7 @@ else:
         if undo is not None:
             args.append(undo)
 
+        instrument.count_operator(operator)
         return operator(*args, **operator_args)
 
 
@@ -127,8 +289,13 @@ def temp_ensure_enabled(*objs: bpy.types.Object):
                 added_to_collections.append(True)
             else:
                 added_to_collections.append(False)
+        if any(added_to_collections):
+            # The objects are in the view layer now, but the depsgraph may not get updated before the index is next used
+            invalidate_scene_index()
         yield
     finally:
+        if any(added_to_collections):
+            invalidate_scene_index()
         for obj, old_hide_viewport, added_to_collection in zip(
             unique_objs, old_hide_viewports, added_to_collections
         ):
@@ -150,61 +317,67 @@ def temp_ensure_enabled(*objs: bpy.types.Object):
                 pass
 
 
+def run_iter(iterator: Generator[Any, None, Any]):
+    """Run one of the *_iter generators to completion, returning what it returns.
+
+    The generators yield whenever they are at a point where the work can be paused, which lets a modal operator spread
+    the work over multiple events, see sliced.SlicedArmatureOperator. Running them straight through does the same as
+    the blocking versions always did."""
+    while True:
+        try:
+            next(iterator)
+        except StopIteration as e:
+            return e.value
+
+
 def obj_in_scene(obj):
-    for o in bpy.context.view_layer.objects:
-        if o is obj:
-            return True
-    return False
+    return obj in get_scene_index().view_layer_objects
+
+
+def deselect_all():
+    """Same as bpy.ops.object.select_all(action="DESELECT"), but through the data API, so it works in any mode and
+    doesn't need an operator call and the undo push and full update that come with it"""
+    for o in bpy.context.selected_objects:
+        o.select_set(False)
 
 
 def get_body_meshes(arm=None):
     if not arm:
         arm = get_armature()
+    index = get_scene_index()
+    view_layer_objects = index.view_layer_objects
     meshes = []
-    for c in arm.children:
-        if not obj_in_scene(c):
-            continue
-        if len(c.users_scene) == 0:
-            continue
-        if c.type == "MESH":
+    # Object.children iterates through every Object, so use the index instead. Being in the view layer also means being
+    # in the scene, so there's no need to check Object.users_scene, which is another scan.
+    for c in index.children.get(arm, ()):
+        if c.type == "MESH" and c in view_layer_objects:
             meshes.append(c)
     return meshes
 
 
 def child_constraints(objects: List[bpy.types.Object]):
-    """Takes O(len(bpy.data.objects)) time, returns any objects that
-    are childed to something in `objects`, along with the object or
-    bone it is childed to"""
+    """Returns any objects that are childed to something in `objects`, along with the object or bone it is childed to.
+    Takes O(len(objects) + k) time once the SceneIndex has been built."""
+    child_of = get_scene_index().child_of
     constrained_objects = []
-    for o in bpy.data.objects:
-        if "Child Of" in o.constraints:
+    for target in dict.fromkeys(objects):
+        for o in child_of.get(target, ()):
             constraint = o.constraints["Child Of"]
-
-            if constraint.target in objects:
-                target = constraint.target
-                if constraint.subtarget == "":
-                    constrained_objects.append((o, target))
-                else:
-                    # As far as I can tell the subtarget needs to be
-                    # either a bone or vertex group which should both
-                    # be valid
-                    target_bone = target.pose.bones[constraint.subtarget]
-                    constrained_objects.append((o, target_bone))
+            if constraint.subtarget == "":
+                constrained_objects.append((o, target))
+            else:
+                # As far as I can tell the subtarget needs to be
+                # either a bone or vertex group which should both
+                # be valid
+                target_bone = target.pose.bones[constraint.subtarget]
+                constrained_objects.append((o, target_bone))
     return constrained_objects
 
 
 def _children_recursive(obj: bpy.types.Object):
-    """Takes O(len(bpy.data.objects)) time, just like Blender's implementation in 3.1+ (also in Python code, but can't
-    just copy it due to it being GPLv2+)"""
-    # Create dict from obj to its children
-    obj_to_children = {}
-    for o in bpy.data.objects:
-        parent = o.parent
-        if parent is not None:
-            if parent in obj_to_children:
-                obj_to_children[parent].append(o)
-            else:
-                obj_to_children[parent] = [o]
+    """Takes O(k) time once the SceneIndex has been built, unlike Blender's implementation in 3.1+ which always takes
+    O(len(bpy.data.objects)) time (also in Python code, but can't just copy it due to it being GPLv2+)"""
+    obj_to_children = get_scene_index().children
     children = []
     if obj in obj_to_children:
         # Iterate to find all the children instead of recursively calling a function
@@ -225,12 +398,9 @@ def _children_recursive(obj: bpy.types.Object):
 
 
 def children_recursive(obj: bpy.types.Object) -> List[bpy.types.Object]:
-    # children_recursive seems to have been added in Blender 3.1, it has the same performance cost as Object.children
-    # because they both have to iterate through every Object.
-    if hasattr(bpy.types.Object, "children_recursive"):
-        return obj.children_recursive
-    else:
-        return _children_recursive(obj)
+    # Object.children_recursive, added in Blender 3.1, has the same performance cost as Object.children because they
+    # both have to iterate through every Object, so the SceneIndex is used in all versions.
+    return _children_recursive(obj)
 
 
 class ArmatureOperator(bpy.types.Operator):
@@ -251,6 +421,10 @@ class ArmatureOperator(bpy.types.Operator):
             return False
         return True
 
+    # Set by snapshot.no_undo_variant(), for operators that remember a snapshot of the avatar instead of having Blender
+    # push an undo step
+    remember_snapshot = False
+
     def execute_main(
         self,
         context: bpy.types.Context,
@@ -260,13 +434,51 @@ class ArmatureOperator(bpy.types.Operator):
         # To be overridden in subclasses
         return {"FINISHED"}
 
-    def execute(self, context: bpy.types.Context):
+    def snapshot_armature(
+        self, context: bpy.types.Context
+    ) -> Optional[bpy.types.Object]:
+        """The armature this operator changes, along with the Objects parented to it"""
+        return get_armature()
+
+    def prepare(self) -> Tuple[bpy.types.Object, List[bpy.types.Object]]:
+        """Forget cached data that could be out of date, returning the armature and meshes to run on"""
+        # Weights may have been painted since the last run, so they must be read again
+        weights.clear_weights_cache()
+        # Scripts may have changed the scene without the depsgraph being updated since
+        invalidate_scene_index()
+
         arm = get_armature()
         meshes = get_body_meshes()
+        return arm, meshes
 
-        if context.mode != "OBJECT":
-            # Make sure we leave any EDIT modes so that data from edit modes is up-to-date.
-            bpy.ops.object.mode_set(mode="OBJECT")
+    @contextmanager
+    def run_context(
+        self,
+        context: bpy.types.Context,
+        arm: bpy.types.Object,
+        meshes: List[bpy.types.Object],
+    ):
+        """Everything execute_main() is run within, yields the counts of expensive Blender API calls made"""
+        # Count the expensive Blender API calls made by this run, so that a change that adds e.g. an extra depsgraph
+        # update per bone shows up straight away
+        with instrument.count_calls() as counts:
+            if context.mode != "OBJECT":
+                # Make sure we leave any EDIT modes so that data from edit modes is up-to-date.
+                instrument.mode_set(mode="OBJECT")
+
+            with instrument.memory_run(self.bl_idname):
+                with instrument.trace_run(self.bl_idname):
+                    with temp_ensure_enabled(arm, *meshes), frozen_scene_index():
+                        yield counts
+
+    def report_counts(self, counts: Dict[str, int]):
+        summary = instrument.format_counts(counts)
+        instrument.log("{}: {}", self.bl_idname, summary)
+        self.report({"INFO"}, summary)
 
-        with temp_ensure_enabled(arm, *meshes):
-            return self.execute_main(context, arm, meshes)
+    def execute(self, context: bpy.types.Context):
+        arm, meshes = self.prepare()
+        with self.run_context(context, arm, meshes) as counts:
+            result = self.execute_main(context, arm, meshes)
+        self.report_counts(counts)
+        return result
@@ -0,0 +1,526 @@
+import bpy
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+from contextlib import contextmanager
+from functools import wraps
+from typing import Any, Dict, List, Optional
+
+# Set to a non-empty value other than "0" to trace every operator run, regardless of the scene's imscale_trace. If the
+# value ends in .json, it is used as the path of the trace file.
+TRACE_ENV_VAR = "IMSCALE_TRACE"
+# Set to "0" to disable the verbose log messages printed while rescaling, regardless of the scene's imscale_verbose
+VERBOSE_ENV_VAR = "IMSCALE_VERBOSE"
+# Set to a non-empty value other than "0" to profile the memory of every operator run, regardless of the scene's
+# imscale_profile_memory
+MEMORY_ENV_VAR = "IMSCALE_MEMORY"
+
+
+class _Trace:
+    """Trace events of a single traced run, in the Chrome trace event format"""
+
+    __slots__ = ("events", "start", "pid")
+
+    def __init__(self):
+        self.events: List[Dict[str, Any]] = []
+        self.start = time.perf_counter()
+        self.pid = os.getpid()
+
+    def timestamp(self):
+        # Trace event timestamps are in microseconds
+        return (time.perf_counter() - self.start) * 1e6
+
+    def add_complete(self, name, ts, args):
+        event = {
+            "name": name,
+            "ph": "X",
+            "ts": ts,
+            "dur": self.timestamp() - ts,
+            "pid": self.pid,
+            "tid": threading.get_ident(),
+        }
+        if args:
+            event["args"] = args
+        self.events.append(event)
+
+    def add_instant(self, name, args):
+        event = {
+            "name": name,
+            "ph": "i",
+            "s": "t",
+            "ts": self.timestamp(),
+            "pid": self.pid,
+            "tid": threading.get_ident(),
+        }
+        if args:
+            event["args"] = args
+        self.events.append(event)
+
+
+# The trace being recorded, None when not tracing
+_TRACE: Optional[_Trace] = None
+# Path the last trace was written to
+last_trace_path: Optional[str] = None
+
+
+def _env_flag(name):
+    value = os.environ.get(name)
+    if value is None:
+        return None
+    return value not in ("", "0")
+
+
+def is_tracing():
+    return _TRACE is not None
+
+
+def trace_requested(scene=None) -> bool:
+    """Whether operator runs should be traced, either because of the environment variable or the scene setting"""
+    if _env_flag(TRACE_ENV_VAR):
+        return True
+    if scene is None:
+        scene = bpy.context.scene
+    return bool(getattr(scene, "imscale_trace", False))
+
+
+# Depth of quiet() blocks
+_QUIET = 0
+
+
+@contextmanager
+def quiet():
+    """Stop log messages being printed within the with block, for code that runs on every change of a setting"""
+    global _QUIET
+    _QUIET += 1
+    try:
+        yield
+    finally:
+        _QUIET -= 1
+
+
+def is_verbose() -> bool:
+    if _QUIET:
+        return False
+    env_verbose = _env_flag(VERBOSE_ENV_VAR)
+    if env_verbose is not None:
+        return env_verbose
+    return bool(getattr(bpy.context.scene, "imscale_verbose", True))
+
+
+def log(message, *args):
+    """Print a progress message, formatted with str.format(*args) only if it is going to be used. Messages are also
+    recorded in the trace when tracing."""
+    verbose = is_verbose()
+    if not verbose and _TRACE is None:
+        return
+    if args:
+        message = message.format(*args)
+    if verbose:
+        print(message)
+    if _TRACE is not None:
+        _TRACE.add_instant(message, None)
+
+
+@contextmanager
+def span(name, **args):
+    """Record the time spent in the with block as a span called name, with args shown alongside it in the trace.
+    Spans nest, so a span started inside another span is shown beneath it. When profiling memory, the memory used by
+    the with block is recorded too. Does nothing when neither tracing nor profiling memory."""
+    trace = _TRACE
+    memory = _MEMORY
+    if trace is None and memory is None:
+        yield
+        return
+    if trace is not None:
+        ts = trace.timestamp()
+    if memory is not None:
+        frame = memory.enter()
+    try:
+        yield
+    finally:
+        if memory is not None:
+            phase = memory.exit(name, args, frame)
+            if trace is not None:
+                args = dict(
+                    args,
+                    python_peak_increase=phase["python_peak_increase"],
+                    rss_after=phase["rss_after"],
+                )
+        if trace is not None:
+            trace.add_complete(name, ts, args)
+
+
+def traced(name=None):
+    """Decorator that records every call of the decorated function as a span, named after the function by default"""
+
+    def decorator(func):
+        span_name = name or func.__name__
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if _TRACE is None and _MEMORY is None:
+                return func(*args, **kwargs)
+            with span(span_name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+# Counts of calls to expensive parts of the Blender API, see count_calls(). None when not counting.
+_COUNTS: Optional[Dict[str, int]] = None
+
+# Keys of the counts
+MODE_SET = "mode_set"
+VIEW_LAYER_UPDATE = "view_layer_update"
+DEPSGRAPH_UPDATE = "depsgraph_update"
+OPERATOR = "operator"
+FOREACH_GET = "foreach_get"
+FOREACH_SET = "foreach_set"
+FOREACH_GET_BYTES = "foreach_get_bytes"
+FOREACH_SET_BYTES = "foreach_set_bytes"
+# Prefix of the per-operator counts
+OPERATOR_PREFIX = "operator "
+
+
+def count(key, amount=1):
+    if _COUNTS is not None:
+        _COUNTS[key] = _COUNTS.get(key, 0) + amount
+
+
+@contextmanager
+def count_calls():
+    """Count the calls made through the helpers below within the with block, yielding the dict of counts, which is
+    filled in as calls are made. Counts of nested blocks are also added to the enclosing block's counts."""
+    global _COUNTS
+    outer = _COUNTS
+    _COUNTS = counts = {}
+    try:
+        yield counts
+    finally:
+        _COUNTS = outer
+        if outer is not None:
+            for key, value in counts.items():
+                outer[key] = outer.get(key, 0) + value
+
+
+def _operator_name(operator):
+    # bpy.ops operators know their own name, e.g. "object.mode_set"
+    try:
+        return operator.idname_py()
+    except AttributeError:
+        return str(operator)
+
+
+def count_operator(operator):
+    """Count a call of a bpy.ops operator"""
+    if _COUNTS is None:
+        return
+    name = _operator_name(operator)
+    count(OPERATOR)
+    count(OPERATOR_PREFIX + name)
+    if name == "object.mode_set":
+        count(MODE_SET)
+
+
+def mode_set(**kwargs):
+    """bpy.ops.object.mode_set, counted"""
+    operator = bpy.ops.object.mode_set
+    count_operator(operator)
+    return operator(**kwargs)
+
+
+def view_layer_update(view_layer=None):
+    """view_layer.update() for the current view layer by default, counted"""
+    count(VIEW_LAYER_UPDATE)
+    if view_layer is None:
+        view_layer = bpy.context.view_layer
+    view_layer.update()
+
+
+def depsgraph_update(depsgraph):
+    """depsgraph.update(), counted"""
+    count(DEPSGRAPH_UPDATE)
+    depsgraph.update()
+
+
+def foreach_get(collection, *args):
+    """collection.foreach_get(*args), counting the bytes read into the array, which is always the last argument"""
+    collection.foreach_get(*args)
+    if _COUNTS is not None:
+        count(FOREACH_GET)
+        count(FOREACH_GET_BYTES, getattr(args[-1], "nbytes", 0))
+
+
+def foreach_set(collection, *args):
+    """collection.foreach_set(*args), counting the bytes written from the array, which is always the last argument"""
+    collection.foreach_set(*args)
+    if _COUNTS is not None:
+        count(FOREACH_SET)
+        count(FOREACH_SET_BYTES, getattr(args[-1], "nbytes", 0))
+
+
+def format_counts(counts: Dict[str, int]) -> str:
+    """Summarise counts in a single line, e.g. for an operator report"""
+    return (
+        "{} mode switches, {} view layer updates, {} depsgraph updates,"
+        " {} operator calls, {:.1f} MB read, {:.1f} MB written".format(
+            counts.get(MODE_SET, 0),
+            counts.get(VIEW_LAYER_UPDATE, 0),
+            counts.get(DEPSGRAPH_UPDATE, 0),
+            counts.get(OPERATOR, 0),
+            counts.get(FOREACH_GET_BYTES, 0) / 1e6,
+            counts.get(FOREACH_SET_BYTES, 0) / 1e6,
+        )
+    )
+
+
+def get_trace_path(scene=None) -> str:
+    env_value = os.environ.get(TRACE_ENV_VAR, "")
+    if env_value.lower().endswith(".json"):
+        return os.path.abspath(env_value)
+    if scene is None:
+        scene = bpy.context.scene
+    path = getattr(scene, "imscale_trace_path", "")
+    if path:
+        return bpy.path.abspath(path)
+    return os.path.join(
+        tempfile.gettempdir(),
+        "imscale_trace_{}.json".format(time.strftime("%Y%m%d_%H%M%S")),
+    )
+
+
+def write_trace(trace: _Trace, path: str):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"traceEvents": trace.events, "displayTimeUnit": "ms"}, f)
+
+
+@contextmanager
+def trace_run(name, force=False, **args):
+    """Trace everything in the with block, writing the trace to a file afterwards, if tracing has been requested or
+    force is True. Nested runs, e.g. an operator called by another operator, become spans of the outermost run."""
+    global _TRACE, last_trace_path
+    if _TRACE is not None or not (force or trace_requested()):
+        with span(name, **args):
+            yield
+        return
+    path = get_trace_path()
+    _TRACE = trace = _Trace()
+    try:
+        with span(name, **args):
+            yield
+    finally:
+        _TRACE = None
+        write_trace(trace, path)
+        last_trace_path = path
+        print("Immersive Scaler trace written to {}".format(path))
+
+
+def get_rss() -> Optional[int]:
+    """Get the resident set size of Blender's process in bytes, or None if it can't be found. On macOS, only the peak
+    resident set size is available, so that is used instead."""
+    if sys.platform.startswith("linux"):
+        try:
+            with open("/proc/self/statm", "r") as f:
+                return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except (OSError, ValueError, IndexError):
+            return None
+    elif sys.platform == "win32":
+        import ctypes
+        from ctypes import wintypes
+
+        class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+            _fields_ = [
+                ("cb", wintypes.DWORD),
+                ("PageFaultCount", wintypes.DWORD),
+                ("PeakWorkingSetSize", ctypes.c_size_t),
+                ("WorkingSetSize", ctypes.c_size_t),
+                ("QuotaPeakPagedPoolUsage", ctypes.c_size_t),
+                ("QuotaPagedPoolUsage", ctypes.c_size_t),
+                ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t),
+                ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+                ("PagefileUsage", ctypes.c_size_t),
+                ("PeakPagefileUsage", ctypes.c_size_t),
+            ]
+
+        counters = PROCESS_MEMORY_COUNTERS()
+        counters.cb = ctypes.sizeof(counters)
+        get_memory_info = ctypes.windll.psapi.GetProcessMemoryInfo
+        process = ctypes.windll.kernel32.GetCurrentProcess()
+        if not get_memory_info(process, ctypes.byref(counters), counters.cb):
+            return None
+        return counters.WorkingSetSize
+    try:
+        import resource
+    except ImportError:
+        return None
+    # ru_maxrss is in bytes on macOS
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class _MemoryProfile:
+    """Memory used by each span of a single profiled run.
+
+    Python allocations, which include NumPy arrays, are measured with tracemalloc. Memory allocated by Blender itself,
+    e.g. for mesh copies, evaluated meshes and undo steps, is only visible in the RSS of the process."""
+
+    __slots__ = ("phases", "stack", "buffers")
+
+    def __init__(self):
+        self.phases: List[Dict[str, Any]] = []
+        # [traced memory at the start, peak traced memory so far, RSS at the start] of each open span
+        self.stack: List[List[int]] = []
+        # mesh name -> {label: bytes}
+        self.buffers: Dict[str, Dict[str, int]] = {}
+
+    def enter(self):
+        current, peak = tracemalloc.get_traced_memory()
+        if self.stack:
+            parent = self.stack[-1]
+            parent[1] = max(parent[1], peak)
+        # reset_peak was added in Python 3.9, without it each span's peak is the peak of the run so far, which still
+        # gives an upper bound
+        if hasattr(tracemalloc, "reset_peak"):
+            tracemalloc.reset_peak()
+            peak = current
+        frame = [current, peak, get_rss()]
+        self.stack.append(frame)
+        return frame
+
+    def exit(self, name, args, frame):
+        current, peak = tracemalloc.get_traced_memory()
+        peak = max(frame[1], peak)
+        self.stack.pop()
+        if self.stack:
+            parent = self.stack[-1]
+            parent[1] = max(parent[1], peak)
+        phase = {
+            "name": name,
+            "python_peak": peak,
+            "python_peak_increase": peak - frame[0],
+            "python_retained": current - frame[0],
+            "rss_before": frame[2],
+            "rss_after": get_rss(),
+        }
+        if args:
+            phase["args"] = args
+        self.phases.append(phase)
+        return phase
+
+    def add_buffers(self, mesh_name, label, nbytes):
+        mesh_buffers = self.buffers.setdefault(mesh_name, {})
+        # The same buffers are often allocated more than once for the same mesh, keep the largest
+        mesh_buffers[label] = max(mesh_buffers.get(label, 0), nbytes)
+
+    def report(self, top=15):
+        rss_values = [
+            p[key]
+            for p in self.phases
+            for key in ("rss_before", "rss_after")
+            if p[key] is not None
+        ]
+        meshes = [
+            {"mesh": mesh_name, "total": sum(labels.values()), "buffers": labels}
+            for mesh_name, labels in self.buffers.items()
+        ]
+        meshes.sort(key=lambda m: m["total"], reverse=True)
+        phases = sorted(
+            self.phases, key=lambda p: p["python_peak_increase"], reverse=True
+        )
+        return {
+            "python_peak": max((p["python_peak"] for p in self.phases), default=0),
+            "rss_peak": max(rss_values, default=None),
+            "num_phases": len(self.phases),
+            "phases": phases[:top],
+            "meshes": meshes[:top],
+        }
+
+
+# The memory profile being recorded, None when not profiling memory
+_MEMORY: Optional[_MemoryProfile] = None
+# Report of the last profiled run, see _MemoryProfile.report()
+last_memory_report: Optional[Dict[str, Any]] = None
+
+
+def memory_requested(scene=None) -> bool:
+    """Whether operator runs should be memory profiled, either because of the environment variable or the scene
+    setting"""
+    if _env_flag(MEMORY_ENV_VAR):
+        return True
+    if scene is None:
+        scene = bpy.context.scene
+    return bool(getattr(scene, "imscale_profile_memory", False))
+
+
+def record_arrays(mesh_name, label, *arrays):
+    """Attribute the memory of NumPy arrays to a mesh, when profiling memory. None arrays are ignored."""
+    if _MEMORY is None:
+        return
+    nbytes = sum(a.nbytes for a in arrays if a is not None)
+    _MEMORY.add_buffers(mesh_name, label, nbytes)
+
+
+def format_bytes(nbytes):
+    if nbytes is None:
+        return "?"
+    return "{:.1f} MB".format(nbytes / 1e6)
+
+
+def format_memory_report(report, top=5) -> str:
+    lines = [
+        "Python allocation peak {}, RSS peak {}".format(
+            format_bytes(report["python_peak"]), format_bytes(report["rss_peak"])
+        )
+    ]
+    for phase in report["phases"][:top]:
+        args = phase.get("args")
+        lines.append(
+            "  {}{}: +{} allocated at peak, RSS {} -> {}".format(
+                phase["name"],
+                " {}".format(args) if args else "",
+                format_bytes(phase["python_peak_increase"]),
+                format_bytes(phase["rss_before"]),
+                format_bytes(phase["rss_after"]),
+            )
+        )
+    for mesh in report["meshes"][:top]:
+        lines.append(
+            "  mesh {}: {} in NumPy buffers {}".format(
+                mesh["mesh"],
+                format_bytes(mesh["total"]),
+                {k: format_bytes(v) for k, v in mesh["buffers"].items()},
+            )
+        )
+    return "\n".join(lines)
+
+
+@contextmanager
+def memory_run(name, force=False):
+    """Profile the memory used by each span in the with block, if memory profiling has been requested or force is
+    True, and print a report of the phases and meshes that use the most memory afterwards. Nested runs are part of the
+    outermost run. Unlike trace_run(), no span is added for the with block itself, so that memory_run() and
+    trace_run() can be combined without every phase being recorded twice."""
+    global _MEMORY, last_memory_report
+    if _MEMORY is not None or not (force or memory_requested()):
+        yield
+        return
+    # Blender doesn't trace Python allocations by default and tracing has some overhead, so only trace while profiling
+    started_tracing = not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+    _MEMORY = profile = _MemoryProfile()
+    try:
+        yield
+    finally:
+        _MEMORY = None
+        if started_tracing:
+            tracemalloc.stop()
+        last_memory_report = profile.report()
+        print("Immersive Scaler memory profile of {}:".format(name))
+        print(format_memory_report(last_memory_report))
@@ -3,28 +3,57 @@ import mathutils
 import math
 import importlib
 import numpy as np
-from typing import List, Iterable
+from typing import Dict, List, Iterable, Tuple
 
 from . import common
+from . import instrument
 from . import posemode
 from . import bones
+from . import sliced
+from . import snapshot
+from . import weights
 
 importlib.reload(common)
+importlib.reload(instrument)
 importlib.reload(bones)
 importlib.reload(posemode)
+importlib.reload(sliced)
+importlib.reload(snapshot)
+importlib.reload(weights)
 
 from .common import (
     get_armature,
     op_override,
     children_recursive,
+    deselect_all,
+    run_iter,
     ArmatureOperator,
     get_body_meshes,
     obj_in_scene,
     temp_ensure_enabled,
 )
 
+from .sliced import SlicedArmatureOperator
+from .snapshot import no_undo_variant, start_from_origin
 from .bones import *
 from .posemode import *
+from .weights import (
+    get_cached_weights,
+    get_group_indices,
+    get_vertex_weights,
+    set_cached_weights,
+)
+from .instrument import (
+    foreach_get,
+    foreach_set,
+    log,
+    mode_set,
+    quiet,
+    record_arrays,
+    span,
+    traced,
+    view_layer_update,
+)
 
 
 def get_bone_worldspace_z(name, arm):
@@ -47,7 +76,7 @@ if hasattr(bpy.types.bpy_prop_array, "foreach_get") and bpy.app.version < (4, 1)
         # Temporarily disabling modifiers to get a more accurate bounding box of the mesh and then re-enabling the
         # modifiers would be far too performance heavy. Changing active shape key might be too heavy too. Though, even
         # if we change the active shape key or modifiers in code, the bounding box doesn't seem to update right away.
-        obj.bound_box.foreach_get(bb_co)
+        foreach_get(obj.bound_box, bb_co)
 
         return bb_co
 
@@ -102,31 +131,47 @@ def get_global_max_z_from_co_ndarray(v_co: np.ndarray, wm: mathutils.Matrix):
     return _get_global_z_from_co_ndarray(v_co, wm, np.max)
 
 
-def get_lowest_point():
-    """Get the lowest z coordinate of all vertices of all meshes of the avatar, in worldspace"""
-    arm = get_armature()
+def get_global_z_from_co_ndarray(v_co: np.ndarray, wm: mathutils.Matrix):
+    """Get the worldspace z of every vertex"""
+    return _get_global_z_from_co_ndarray(v_co, wm, lambda global_z_only: global_z_only)
+
+
+def get_foot_bone_names(arm):
+    """Get the names of the ankle bones and all their children, the bones that the lowest point of the avatar is
+    measured from"""
     bones = set()
     for bone in (get_bone("left_ankle", arm), get_bone("right_ankle", arm)):
         bones.add(bone.name)
         bones.update(b.name for b in bone.children_recursive)
+    return bones
+
 
-    meshes = []
-    for o in get_body_meshes():
+@traced()
+def get_lowest_point(arm=None, meshes=None):
+    """Get the lowest z coordinate of all vertices of all meshes of the avatar, in worldspace"""
+    if arm is None:
+        arm = get_armature()
+    if meshes is None:
+        meshes = get_body_meshes(arm)
+    bones = get_foot_bone_names(arm)
+
+    meshes_by_z = []
+    for o in meshes:
         # Get minimum worldspace z component. This is exceedingly likely to be lower or the same as the lowest vertex in
         # the mesh.
         likely_lowest_possible_vertex_z = get_global_min_z_from_co_ndarray(
             bound_box_to_co_array(o), o.matrix_world
         )
         # Add the minimum z component along with the mesh object
-        meshes.append((likely_lowest_possible_vertex_z, o))
+        meshes_by_z.append((likely_lowest_possible_vertex_z, o))
     # Sort meshes by lowest bounding box first, that way, we can stop checking meshes once we get to a mesh whose lowest
     # corner of the bounding box is higher than the current lowest vertex
-    meshes.sort(key=lambda t: t[0])
+    meshes_by_z.sort(key=lambda t: t[0])
 
     lowest_vertex_z = math.inf
     lowest_foot_z = math.inf
 
-    for likely_lowest_possible_vertex_z, o in meshes:
+    for likely_lowest_possible_vertex_z, o in meshes_by_z:
         mesh = o.data
         if not mesh.vertices:
             # Immediately skip if there's no vertices
@@ -139,9 +184,7 @@ def get_lowest_point():
             # don't need to check them.
             break
 
-        foot_group_indices = {
-            idx for idx, vg in enumerate(o.vertex_groups) if vg.name in bones
-        }
+        foot_group_indices = get_group_indices(o, bones)
         if not foot_group_indices:
             if found_feet_previously:
                 # Vertices belonging to feet were found previously, but the current mesh doesn't have any vertex groups
@@ -165,29 +208,20 @@ def get_lowest_point():
             v_co = np.empty(num_verts * 3, dtype=np.single)
             # Directly copy the 'co' of the reference shape key into the v_cos array (type must match the internal C
             # type for a direct copy)
-            mesh.shape_keys.reference_key.data.foreach_get("co", v_co)
+            foreach_get(mesh.shape_keys.reference_key.data, "co", v_co)
             # Directly paste the 'co' copied from the reference shape key into the 'co' of the vertices
-            mesh.vertices.foreach_set("co", v_co)
+            foreach_set(mesh.vertices, "co", v_co)
         else:
             v_co = None
 
         wm = o.matrix_world
-        foot_v_indices = []
         if foot_group_indices:
-            # There are unfortunately no fast methods for getting all vertex weights, so we must resort to iteration.
-            # We expect most vertices to not be weighted to feet, so it's generally slightly faster to get the
-            # .index of each vertex we need rather than to use enumerate
-            for vert in mesh.vertices:
-                # For performance, we want to do as little as possible within the main loop because the slowest part of
-                # the loop is Python itself, getting the attributes, calling functions etc. All we'll do is append the
-                # indices of the vertices that are weighted to feet to a list and then let numpy handle everything else.
-                for group in vert.groups:
-                    # .group is the index of the vertex_group
-                    # .weight is a 'truthy' value whenever it is not zero
-                    if group.group in foot_group_indices and group.weight:
-                        foot_v_indices.append(vert.index)
-                        break
-        found_feet = bool(foot_v_indices)
+            # All the weights of the mesh are read in bulk (and cached, since this function gets called several times
+            # per rescale), so picking out the vertices weighted to feet is a single array mask
+            foot_v_mask = get_vertex_weights(o).vertex_mask(foot_group_indices)
+        else:
+            foot_v_mask = None
+        found_feet = foot_v_mask is not None and foot_v_mask.any()
         # If there are no indices found that are weighted to feet, but we've previously found vertices that are
         # weighted to feet, we can ignore this mesh.
         # Otherwise:
@@ -197,14 +231,14 @@ def get_lowest_point():
             if v_co is None:
                 # Get v_co array
                 v_co = np.empty(len(mesh.vertices) * 3, dtype=np.single)
-                mesh.vertices.foreach_get("co", v_co)
+                foreach_get(mesh.vertices, "co", v_co)
+            record_arrays(o.name, "measure", v_co)
             # View the array with each element being a single (x,y,z) vector
             v_co.shape = (-1, 3)
 
             if found_feet:
-                # Numpy lets us index a numpy array with a list or array of indices (this creates a copy rather than
-                # a view)
-                v_co_feet_only = v_co[foot_v_indices]
+                # Numpy lets us index a numpy array with a boolean mask (this creates a copy rather than a view)
+                v_co_feet_only = v_co[foot_v_mask]
                 lowest_foot_z = min(
                     lowest_foot_z, get_global_min_z_from_co_ndarray(v_co_feet_only, wm)
                 )
@@ -221,25 +255,28 @@ def get_lowest_point():
     return lowest_foot_z
 
 
-def get_highest_point():
+@traced()
+def get_highest_point(arm=None, meshes=None):
     # Almost the same as get_lowest_point for obvious reasons, but only using numpy since we don't need to check vertex
     # weights
-    meshes = []
-    for o in get_body_meshes():
+    if meshes is None:
+        meshes = get_body_meshes(arm)
+    meshes_by_z = []
+    for o in meshes:
         # Get maximum worldspace z component. This is exceedingly likely to be higher or the same as the highest vertex
         # in the mesh.
         likely_highest_possible_vertex_z = get_global_max_z_from_co_ndarray(
             bound_box_to_co_array(o), o.matrix_world
         )
         # Add the maximum z component along with the mesh object
-        meshes.append((likely_highest_possible_vertex_z, o))
+        meshes_by_z.append((likely_highest_possible_vertex_z, o))
     # Sort meshes by highest bounding box first, that way, we can stop checking meshes once we get to a mesh whose
     # highest corner of the bounding box is lower than the current highest vertex
-    meshes.sort(key=lambda t: t[0], reverse=True)
+    meshes_by_z.sort(key=lambda t: t[0], reverse=True)
 
     minimum_value = -math.inf
     highest_vertex_z = minimum_value
-    for likely_highest_possible_vertex_z, o in meshes:
+    for likely_highest_possible_vertex_z, o in meshes_by_z:
         wm = o.matrix_world
         mesh = o.data
 
@@ -259,7 +296,8 @@ def get_highest_point():
             break
 
         v_co = np.empty(num_verts * 3, dtype=np.single)
-        vertices.foreach_get("co", v_co)
+        foreach_get(vertices, "co", v_co)
+        record_arrays(o.name, "measure", v_co)
         # Get the maximum value global vertex z value
         max_global_z = get_global_max_z_from_co_ndarray(v_co, wm)
         # Compare against the current highest vertex z and set it to whichever is greatest
@@ -270,7 +308,7 @@ def get_highest_point():
         return highest_vertex_z
 
 
-def get_view_z(obj, custom_scale_ratio=0.4537):
+def get_view_z(obj, custom_scale_ratio=0.4537, head_to_hand_length=None):
     # VRC uses the distance between the head bone and right hand in
     # t-pose as the basis for world scale.
 
@@ -280,23 +318,22 @@ def get_view_z(obj, custom_scale_ratio=0.4537):
     # Magic that somebody posted in discord. I'm going to just assume
     # these constants are correct. Testing shows it's at least pretty
     # darn close
-    view_z = (head_to_hand(obj) / custom_scale_ratio) + 0.005
+    if head_to_hand_length is None:
+        head_to_hand_length = head_to_hand(obj)
+    view_z = (head_to_hand_length / custom_scale_ratio) + 0.005
 
     return view_z
 
 
 def get_current_scaling(obj):
-    bpy.context.view_layer.objects.active = obj
-    bpy.ops.object.mode_set(mode="POSE", toggle=False)
-
-    # TODO: What's the minus .005 on the end? I'm going to assume it's intended to be in worldspace
-    ratio = head_to_hand(obj) / (get_eye_height(obj) - 0.005 - get_lowest_point())
-
-    bpy.ops.object.mode_set(mode="POSE", toggle=True)
+    # Bones and PoseBones can be read in any mode, only changes made in EDIT mode need a mode change to show up
+    with pose_bones_synced(obj):
+        # TODO: What's the minus .005 on the end? I'm going to assume it's intended to be in worldspace
+        ratio = head_to_hand(obj) / (get_eye_height(obj) - 0.005 - get_lowest_point())
     return ratio
 
 
-def get_upper_body_portion(arm):
+def get_upper_body_portion(arm, lowest_point=None):
     eye_z = (
         get_bone_worldspace_z("left_eye", arm) + get_bone_worldspace_z("right_eye", arm)
     ) / 2
@@ -304,7 +341,8 @@ def get_upper_body_portion(arm):
     leg_average_z = (
         get_bone_worldspace_z("left_leg", arm) + get_bone_worldspace_z("right_leg", arm)
     ) / 2
-    lowest_point = get_lowest_point()
+    if lowest_point is None:
+        lowest_point = get_lowest_point(arm)
 
     return 1 - (leg_average_z - lowest_point) / (eye_z - lowest_point)
 
@@ -390,32 +428,29 @@ def head_to_hand(obj, worldspace=True):
     return (upper_arm_to_head - t_hand_pos).length
 
 
-def calculate_arm_rescaling(obj, head_arm_change):
-    # Calculates the percent change in arm length needed to create a
-    # given change in head-hand length.
-
-    # This function gets called before start_pose_mode_with_reset is called in scale_to_floor, so the current mode could
-    # be EDIT mode, which could have changes that are not yet propagated to the pose data
-    # Object.update_from_editmode() only seems to update the Bones of the armature and not the PoseBones of the armature
-    # Object, so I don't think that can be used instead of swapping
-    need_mode_swap = obj.mode == "EDIT"
-    if need_mode_swap:
-        # EDIT mode
-        bpy.context.view_layer.objects.active = obj
-        bpy.ops.object.mode_set(mode="POSE", toggle=False)
-
-    rarmpos = get_bone("right_arm", obj).head
-    headpos = get_bone("head", obj).head
-
-    if need_mode_swap:
-        # Restore original mode
-        bpy.ops.object.mode_set(mode="POSE", toggle=True)
+def get_arm_rescaling_lengths(obj):
+    """Get the head to hand length, arm length and neck length in armature space, used by calculate_arm_rescaling()"""
+    # The current mode could be EDIT mode, which could have changes that are not yet propagated to the pose data
+    with pose_bones_synced(obj):
+        rarmpos = get_bone("right_arm", obj).head
+        headpos = get_bone("head", obj).head
 
     total_length = head_to_hand(obj, worldspace=False)
-    print("Head to hand length is {}".format(total_length))
+    log("Head to hand length is {}", total_length)
     arm_length = get_arm_length(obj, worldspace=False)
-    print(f"Arm length is {arm_length}")
+    log("Arm length is {}", arm_length)
     neck_length = abs((headpos[2] - rarmpos[2]))
+    return total_length, arm_length, neck_length
+
+
+@traced()
+def calculate_arm_rescaling(obj, head_arm_change, measurements=None):
+    # Calculates the percent change in arm length needed to create a
+    # given change in head-hand length.
+    if measurements is None:
+        total_length, arm_length, neck_length = get_arm_rescaling_lengths(obj)
+    else:
+        total_length, arm_length, neck_length = measurements.arm_rescaling_lengths
 
     # Sanity check - compare the difference between head_to_hand and manual
     # print("")
@@ -467,16 +502,18 @@ def get_eye_height(obj, worldspace=True):
         return eye_average.z
 
 
-def get_leg_length(arm):
+def get_leg_length(arm, lowest_point=None):
     """Assuming exact symmetry of both legs, gets vertical leg length, from the start of the upper leg bone to the
     lowest part of mesh weighted to feet or a child bone of the feet. If no mesh is weighted to the feet (or a child
     bone, the lowest mesh vertex is used instead).
     :return: Worldspace vertical leg length"""
     # Assumes exact symmetry between right and left legs
-    return get_bone_worldspace_z("left_leg", arm) - get_lowest_point()
+    if lowest_point is None:
+        lowest_point = get_lowest_point(arm)
+    return get_bone_worldspace_z("left_leg", arm) - lowest_point
 
 
-def get_leg_proportions(arm):
+def get_leg_proportions(arm, lowest_point=None):
     """Get the relative lengths in the worldspace z direction of each portion of the leg starting from the top of the
     leg and ending at the lowest vertex of the avatar's feet (or lowest vertex of the avatar if no vertices are weighted
     to the feet bones or children of the feet bones).
@@ -496,7 +533,8 @@ def get_leg_proportions(arm):
         get_bone_worldspace_z("left_ankle", arm)
         + get_bone_worldspace_z("right_ankle", arm)
     ) / 2
-    lowest_point = get_lowest_point()
+    if lowest_point is None:
+        lowest_point = get_lowest_point(arm)
 
     total = leg_average_z - lowest_point
     # The first point is leg_average_z, which always results in 0.0
@@ -513,21 +551,223 @@ def get_leg_proportions(arm):
     return nl, total
 
 
-def scale_legs(arm, leg_scale_ratio, leg_thickness, scale_foot, thigh_percentage):
-    leg_points, total_length = get_leg_proportions(arm)
+class AvatarMeasurements:
+    """Measurements of an avatar's proportions for a single pose state.
+
+    Each measurement is calculated the first time it's needed and then remembered, so the meshes of the avatar are
+    read at most once no matter how many measurements are taken. Measurements of bones are only correct until bones
+    are changed, so invalidate_bones() must be called after changing bones. invalidate() must be called after
+    changing the meshes, e.g. after applying the pose as the rest pose."""
+
+    def __init__(self, arm=None, meshes=None):
+        if arm is None:
+            arm = get_armature()
+        if meshes is None:
+            meshes = get_body_meshes(arm)
+        self.arm = arm
+        self.meshes = meshes
+        self._mesh_values = {}
+        self._bone_values = {}
+
+    def invalidate_bones(self):
+        """Forget measurements that depend on the position of bones"""
+        self._bone_values.clear()
+
+    def invalidate(self):
+        """Forget all measurements"""
+        self._mesh_values.clear()
+        self._bone_values.clear()
+
+    def get_mesh_values(self) -> Dict[str, float]:
+        """Get the measurements of the meshes taken so far, which stay correct for as long as the meshes and the
+        Objects' transforms don't change"""
+        return dict(self._mesh_values)
+
+    def set_mesh_values(self, mesh_values: Dict[str, float]):
+        """Set measurements of the meshes previously got with get_mesh_values()"""
+        self._mesh_values.update(mesh_values)
+
+    def set_mesh_measurements(self, lowest_point, highest_point):
+        """Set the measurements of the meshes when they are already known"""
+        self._mesh_values["lowest_point"] = lowest_point
+        self._mesh_values["highest_point"] = highest_point
+
+    def moved(self, z_offset):
+        """Update the measurements for the avatar having been moved by z_offset in worldspace, without reading the
+        meshes again."""
+        for key in ("lowest_point", "highest_point"):
+            if key in self._mesh_values:
+                self._mesh_values[key] += z_offset
+        self._bone_values.clear()
+
+    @staticmethod
+    def _memoize(values, key, func):
+        if key in values:
+            return values[key]
+        with span("measure " + key):
+            value = func()
+        values[key] = value
+        return value
+
+    @property
+    def lowest_point(self):
+        return self._memoize(
+            self._mesh_values,
+            "lowest_point",
+            lambda: get_lowest_point(self.arm, self.meshes),
+        )
+
+    @property
+    def highest_point(self):
+        return self._memoize(
+            self._mesh_values,
+            "highest_point",
+            lambda: get_highest_point(self.arm, self.meshes),
+        )
+
+    @property
+    def eye_height(self):
+        """Worldspace z of the eyes"""
+        return self._memoize(
+            self._bone_values, "eye_height", lambda: get_eye_height(self.arm)
+        )
+
+    def _average_bone_z(self, left, right):
+        return self._memoize(
+            self._bone_values,
+            left,
+            lambda: (
+                get_bone_worldspace_z(left, self.arm)
+                + get_bone_worldspace_z(right, self.arm)
+            )
+            / 2,
+        )
+
+    @property
+    def leg_height(self):
+        """Average worldspace z of the tops of the legs"""
+        return self._average_bone_z("left_leg", "right_leg")
+
+    @property
+    def knee_height(self):
+        """Average worldspace z of the knees"""
+        return self._average_bone_z("left_knee", "right_knee")
+
+    @property
+    def ankle_height(self):
+        """Average worldspace z of the ankles"""
+        return self._average_bone_z("left_ankle", "right_ankle")
+
+    @property
+    def arm_length(self):
+        return self._memoize(
+            self._bone_values, "arm_length", lambda: get_arm_length(self.arm)
+        )
+
+    @property
+    def head_to_hand(self):
+        return self._memoize(
+            self._bone_values, "head_to_hand", lambda: head_to_hand(self.arm)
+        )
+
+    def view_z(self, custom_scale_ratio=0.4537):
+        return get_view_z(self.arm, custom_scale_ratio, self.head_to_hand)
+
+    @property
+    def arm_rescaling_lengths(self):
+        """See get_arm_rescaling_lengths()"""
+        return self._memoize(
+            self._bone_values,
+            "arm_rescaling_lengths",
+            lambda: get_arm_rescaling_lengths(self.arm),
+        )
+
+    @property
+    def chest_height(self):
+        """Worldspace z of the upper chest, or of the chest if there is no upper chest"""
+        name = "upperchest" if check_bone("upperchest", self.arm) else "chest"
+        return self._memoize(
+            self._bone_values,
+            "chest_height",
+            lambda: get_bone_worldspace_z(name, self.arm),
+        )
+
+    @property
+    def leg_length(self):
+        return self._memoize(
+            self._bone_values,
+            "leg_length",
+            lambda: get_leg_length(self.arm, self.lowest_point),
+        )
+
+    @property
+    def upper_body_portion(self):
+        return self._memoize(
+            self._bone_values,
+            "upper_body_portion",
+            lambda: get_upper_body_portion(self.arm, self.lowest_point),
+        )
+
+    @property
+    def leg_proportions(self):
+        """See get_leg_proportions()"""
+        return self._memoize(
+            self._bone_values,
+            "leg_proportions",
+            lambda: get_leg_proportions(self.arm, self.lowest_point),
+        )
+
+
+class RescalePose:
+    """Pose bone scales and Bone.inherit_scale settings that change an avatar's proportions.
+
+    Computing them only reads measurements, and applying them only changes the pose, so the meshes follow through their
+    Armature modifiers until the pose is applied as the rest pose. Both are keyed by bone name."""
+
+    __slots__ = ("scales", "inherit_scales")
+
+    def __init__(self):
+        self.scales: Dict[str, Tuple[float, float, float]] = {}
+        self.inherit_scales: Dict[str, str] = {}
+
+
+def apply_rescale_pose(arm, rescale_pose: RescalePose):
+    """Set the inherit_scale settings and pose bone scales of rescale_pose on arm"""
+    bones = arm.data.bones
+    for name, inherit_scale in rescale_pose.inherit_scales.items():
+        bone = bones[name]
+        # Setting inherit_scale tags the armature for a depsgraph update, even when the value doesn't change
+        if bone.inherit_scale != inherit_scale:
+            bone.inherit_scale = inherit_scale
+    pose_bones = arm.pose.bones
+    for name, scale in rescale_pose.scales.items():
+        pose_bones[name].scale = scale
+
+
+def compute_leg_scales(
+    arm,
+    leg_scale_ratio,
+    leg_thickness,
+    scale_foot,
+    thigh_percentage,
+    measurements,
+    rescale_pose: RescalePose,
+):
+    leg_points, total_length = measurements.leg_proportions
 
     starting_portions = list([leg_points[i + 1] - leg_points[i] for i in range(3)])
-    print("starting_portions: {}".format(starting_portions))
+    log("starting_portions: {}", starting_portions)
 
     # Foot scale is the percentage of the final it'll take up.
     foot_portion = (1 - leg_points[2]) * leg_thickness / leg_scale_ratio
     if scale_foot:
         foot_portion = (1 - leg_points[2]) * leg_thickness
-    print("Foot portion: {}".format(foot_portion))
-    print(
-        "Leg thickness: {}, leg_scale_ratio: {}, leg_points: {}".format(
-            leg_thickness, leg_scale_ratio, leg_points
-        )
+    log("Foot portion: {}", foot_portion)
+    log(
+        "Leg thickness: {}, leg_scale_ratio: {}, leg_points: {}",
+        leg_thickness,
+        leg_scale_ratio,
+        leg_points,
     )
 
     leg_portion = 1 - foot_portion
@@ -536,10 +776,9 @@ def scale_legs(arm, leg_scale_ratio, leg_thickness, scale_foot, thigh_percentage
     thigh_portion = leg_portion * thigh_percentage
     calf_portion = leg_portion - thigh_portion
 
-    print(
-        "calculated desired leg portions: {}".format(
-            [thigh_portion, calf_portion, foot_portion]
-        )
+    log(
+        "calculated desired leg portions: {}",
+        [thigh_portion, calf_portion, foot_portion],
     )
 
     final_thigh_scale = (thigh_portion / starting_portions[0]) * leg_scale_ratio
@@ -547,33 +786,54 @@ def scale_legs(arm, leg_scale_ratio, leg_thickness, scale_foot, thigh_percentage
     final_foot_scale = (foot_portion / starting_portions[2]) * leg_scale_ratio
 
     # Disable scaling from parent for bones
-    scale_bones = ["left_knee", "right_knee", "left_ankle", "right_ankle"]
-    saved_bone_inherit_scales = {}
-    for b in scale_bones:
-        bone = get_bone(b, arm)
-        saved_bone_inherit_scales[b] = arm.data.bones[bone.name].inherit_scale
-
-        arm.data.bones[bone.name].inherit_scale = "NONE"
-
-    print(final_foot_scale)
-    print(
-        "Calculated final scales: thigh {} calf {} foot {}".format(
-            final_thigh_scale, final_calf_scale, final_foot_scale
-        )
+    for b in ["left_knee", "right_knee", "left_ankle", "right_ankle"]:
+        rescale_pose.inherit_scales[get_bone(b, arm).name] = "NONE"
+
+    log(
+        "Calculated final scales: thigh {} calf {} foot {}",
+        final_thigh_scale,
+        final_calf_scale,
+        final_foot_scale,
     )
 
-    for leg in [get_bone("left_leg", arm), get_bone("right_leg", arm)]:
-        leg.scale = (leg_thickness, final_thigh_scale, leg_thickness)
-    for knee in [get_bone("left_knee", arm), get_bone("right_knee", arm)]:
-        knee.scale = (leg_thickness, final_calf_scale, leg_thickness)
-    for foot in [get_bone("left_ankle", arm), get_bone("right_ankle", arm)]:
-        foot.scale = (final_foot_scale, final_foot_scale, final_foot_scale)
+    scales = rescale_pose.scales
+    for leg in ["left_leg", "right_leg"]:
+        scales[get_bone(leg, arm).name] = (
+            leg_thickness,
+            final_thigh_scale,
+            leg_thickness,
+        )
+    for knee in ["left_knee", "right_knee"]:
+        scales[get_bone(knee, arm).name] = (
+            leg_thickness,
+            final_calf_scale,
+            leg_thickness,
+        )
+    for foot in ["left_ankle", "right_ankle"]:
+        scales[get_bone(foot, arm).name] = (final_foot_scale,) * 3
 
-    result_final_points, result_total_legs = get_leg_proportions(arm)
-    print("Implemented leg portions: {}".format(result_final_points))
-    # restore saved bone scaling states
-    # for b in scale_bones:
-    #     arm.data.bones[b].inherit_scale = saved_bone_inherit_scales[b]
+
+@traced()
+def scale_legs(
+    arm, leg_scale_ratio, leg_thickness, scale_foot, thigh_percentage, measurements=None
+):
+    if measurements is None:
+        measurements = AvatarMeasurements(arm)
+    rescale_pose = RescalePose()
+    compute_leg_scales(
+        arm,
+        leg_scale_ratio,
+        leg_thickness,
+        scale_foot,
+        thigh_percentage,
+        measurements,
+        rescale_pose,
+    )
+    apply_rescale_pose(arm, rescale_pose)
+
+    measurements.invalidate_bones()
+    result_final_points, result_total_legs = measurements.leg_proportions
+    log("Implemented leg portions: {}", result_final_points)
 
 
 # def scale_absolute(upper_body_percent, arm_thickness_change, leg_thickness_change, scale_hand, thigh_percentage, custom_scale_ratio):
@@ -602,24 +862,18 @@ def scale_legs(arm, leg_scale_ratio, leg_thickness, scale_foot, thigh_percentage
 #     arm_scale_ratio = calculate_arm_rescaling(arm, rescale_arm_ratio)
 
 
-def scale_torso(arm, torso_scale_ratio):
+def compute_torso_scale(arm, torso_scale_ratio, measurements, rescale_pose):
+    """Returns the height from the legs to the eyes, which the torso scale is calculated from"""
     # The final distance measured is from the leg bones to the eyes,
     # but the distance lengthened is only from the leg bone roots to
     # the chest or upper chest
+    scaled_top = measurements.chest_height
+    scaled_bottom = measurements.leg_height
 
-    if check_bone("upperchest", arm):
-        scaled_top = get_bone_worldspace_z("upperchest", arm)
-    else:
-        scaled_top = get_bone_worldspace_z("chest", arm)
-
-    scaled_bottom = (
-        get_bone_worldspace_z("left_leg", arm) + get_bone_worldspace_z("right_leg", arm)
-    ) / 2
-
-    total_height = get_eye_height(arm) - scaled_bottom
+    total_height = measurements.eye_height - scaled_bottom
     scaled_height = scaled_top - scaled_bottom
 
-    print("Total height: {}, scaled height: {}".format(total_height, scaled_height))
+    log("Total height: {}, scaled height: {}", total_height, scaled_height)
     scale_ratio = 1 + ((total_height / scaled_height) * (torso_scale_ratio - 1))
 
     # Mark boundry bones as not inheriting scale
@@ -633,42 +887,43 @@ def scale_torso(arm, torso_scale_ratio):
     else:
         boundry_bones += [get_bone("chest", arm).name]
 
-    saved_bone_inherit_scales = {}
     for b in boundry_bones:
         # Every bone here either comes from a lookup or directly from
         # the armature, so it should be safe to referece pose.bones
         # directly without looking at overrides in this step
-        bone = arm.pose.bones[b]
-        saved_bone_inherit_scales[b] = arm.data.bones[bone.name].inherit_scale
-
-        print("Disabling inherit scale on bone {}".format(b))
-        arm.data.bones[bone.name].inherit_scale = "NONE"
-
-    print("Scaling hip by {}".format(scale_ratio))
-    get_bone("hips", arm).scale = (1, scale_ratio, 1)
+        log("Disabling inherit scale on bone {}", b)
+        rescale_pose.inherit_scales[b] = "NONE"
+
+    log("Scaling hip by {}", scale_ratio)
+    rescale_pose.scales[get_bone("hips", arm).name] = (1, scale_ratio, 1)
+    return total_height
+
+
+@traced()
+def scale_torso(arm, torso_scale_ratio, measurements=None):
+    if measurements is None:
+        measurements = AvatarMeasurements(arm)
+    rescale_pose = RescalePose()
+    scaled_bottom = measurements.leg_height
+    total_height = compute_torso_scale(
+        arm, torso_scale_ratio, measurements, rescale_pose
+    )
+    apply_rescale_pose(arm, rescale_pose)
 
     # Check that it worked as expected
-    if check_bone("upperchest", arm):
-        new_scaled_top = get_bone_worldspace_z("upperchest", arm)
-    else:
-        new_scaled_top = get_bone_worldspace_z("chest", arm)
-
-    new_scaled_bottom = (
-        get_bone_worldspace_z("left_leg", arm) + get_bone_worldspace_z("right_leg", arm)
-    ) / 2
-
-    new_total_height = get_eye_height(arm) - scaled_bottom
-    print(
-        "Torso Scaling Expected height: {}, actual height: {}".format(
-            total_height * torso_scale_ratio, new_total_height
-        )
+    measurements.invalidate_bones()
+    new_total_height = measurements.eye_height - scaled_bottom
+    log(
+        "Torso Scaling Expected height: {}, actual height: {}",
+        total_height * torso_scale_ratio,
+        new_total_height,
     )
 
-    # for b in boundry_bones:
-    #     arm.data.bones[b].inherit_scale = saved_bone_inherit_scales[b]
-
 
-def scale_to_floor(
+@traced()
+def compute_rescale_pose(
+    arm,
+    measurements,
     arm_to_legs,
     arm_thickness,
     leg_thickness,
@@ -679,23 +934,23 @@ def scale_to_floor(
     scale_relative,
     keep_head_size,
     upper_body_portion,
-):
-    arm = get_armature()
-
-    # Possibly for these scale calculation parts, before we adjust any bones, we could change the armature pose to
-    # 'REST' instead of resetting the pose and then taking measurements
-    start_pose_mode_with_reset(arm)
+) -> RescalePose:
+    """Compute the bone scales that scale_to_floor() poses the armature with, without changing the armature.
 
-    lowest_point = get_lowest_point()
+    Everything is calculated from measurements, which must be of the armature in its rest pose. Once measurements has
+    remembered its values, computing the pose again with different parameters doesn't read any bones or meshes, which
+    is what keeps the rescale preview fast."""
+    rescale_pose = RescalePose()
+    lowest_point = measurements.lowest_point
 
-    view_z = get_view_z(arm, custom_scale_ratio) + extra_leg_length
-    eye_z = get_eye_height(arm) - lowest_point
+    view_z = measurements.view_z(custom_scale_ratio) + extra_leg_length
+    eye_z = measurements.eye_height - lowest_point
 
     # TODO: add an option for people who *want* their legs below the floor.
     #
     # weirdos
     rescale_ratio = eye_z / view_z
-    leg_height_portion = get_leg_length(arm) / eye_z
+    leg_height_portion = measurements.leg_length / eye_z
 
     if scale_relative:
         # This uses the arm_to_legs parameter, the method below doesn't
@@ -707,11 +962,9 @@ def scale_to_floor(
         # from the legs needs to be added to the torso, making their
         # scalings the inverse of each other. Note that the division
         # between upper and lower body is determined from the eyes
-        current_ubp = get_upper_body_portion(arm)
+        current_ubp = measurements.upper_body_portion
 
-        print(
-            "current ubp: {}, desired ubp: {}".format(current_ubp, upper_body_portion)
-        )
+        log("current ubp: {}, desired ubp: {}", current_ubp, upper_body_portion)
         torso_scale_ratio = upper_body_portion / current_ubp
         leg_scale_ratio = (1 - upper_body_portion) / (1 - current_ubp)
 
@@ -719,20 +972,16 @@ def scale_to_floor(
         # leg_scale_ratio = (1 + leg_scale_ratio) / 2
 
         # For debugging, get new scales
-        eye_z = get_eye_height(arm)
-        lowest_point = get_lowest_point()
-        leg_average_z = (
-            get_bone_worldspace_z("left_leg", arm)
-            + get_bone_worldspace_z("right_leg", arm)
-        ) / 2
+        eye_z = measurements.eye_height
+        leg_average_z = measurements.leg_height
 
         ntl = (eye_z - leg_average_z) * torso_scale_ratio
         ns = ntl / (ntl + ((leg_average_z - lowest_point) * leg_scale_ratio))
 
-        print("Expected New scale: {}".format(ns))
+        log("Expected New scale: {}", ns)
 
-        print("Torso scale ratio: {}".format(torso_scale_ratio))
-        print("Leg scale ratio: {}".format(leg_scale_ratio))
+        log("Torso scale ratio: {}", torso_scale_ratio)
+        log("Leg scale ratio: {}", leg_scale_ratio)
         # If the chest isn't scaled, the shoulders shouldn't move at
         # all in this mode, so the entirety of the proportion scaling
         # happens in the arm lengthening
@@ -740,7 +989,7 @@ def scale_to_floor(
 
     else:
         # This uses the upper_body_portion parameter as the primary
-        ubp = get_upper_body_portion(arm)
+        ubp = measurements.upper_body_portion
         ub_scale_ratio = ubp / upper_body_portion
         leg_scale_ratio = ub_scale_ratio + (
             (ub_scale_ratio * ubp - ubp) / (leg_height_portion)
@@ -748,43 +997,110 @@ def scale_to_floor(
         rescale_leg_ratio = 1 / (leg_height_portion * (leg_scale_ratio - 1) + 1)
         rescale_arm_ratio = rescale_ratio / rescale_leg_ratio
 
-    arm_scale_ratio = calculate_arm_rescaling(arm, rescale_arm_ratio)
+    arm_scale_ratio = calculate_arm_rescaling(arm, rescale_arm_ratio, measurements)
 
-    print("Total required scale factor is %f" % rescale_ratio)
-    print(
-        "Scaling legs by a factor of %f to %f"
-        % (leg_scale_ratio, leg_scale_ratio * get_leg_length(arm))
+    log("Total required scale factor is {:f}", rescale_ratio)
+    log(
+        "Scaling legs by a factor of {:f} to {:f}",
+        leg_scale_ratio,
+        leg_scale_ratio * measurements.leg_length,
     )
-    print("Scaling arms by a factor of %f" % arm_scale_ratio)
+    log("Scaling arms by a factor of {:f}", arm_scale_ratio)
 
     leg_thickness = leg_thickness + leg_scale_ratio * (1 - leg_thickness)
     arm_thickness = arm_thickness + arm_scale_ratio * arm_thickness
 
     scale_foot = False
-    scale_legs(arm, leg_scale_ratio, leg_thickness, scale_foot, thigh_percentage)
+    compute_leg_scales(
+        arm,
+        leg_scale_ratio,
+        leg_thickness,
+        scale_foot,
+        thigh_percentage,
+        measurements,
+        rescale_pose,
+    )
 
     if keep_head_size:
-        scale_torso(arm, torso_scale_ratio)
+        # Scaling the legs doesn't move anything above the legs, so the torso can be calculated from the same
+        # measurements
+        compute_torso_scale(arm, torso_scale_ratio, measurements, rescale_pose)
 
     # This kept getting me - make sure arms are set to inherit scale
     for b in ["left_elbow", "right_elbow", "left_wrist", "right_wrist"]:
-        get_bone(b, arm).bone.inherit_scale = "FULL"
+        rescale_pose.inherit_scales[get_bone(b, arm).name] = "FULL"
 
-    for armbone in [get_bone("left_arm", arm), get_bone("right_arm", arm)]:
-        armbone.scale = (arm_thickness, arm_scale_ratio, arm_thickness)
+    for armbone in ["left_arm", "right_arm"]:
+        rescale_pose.scales[get_bone(armbone, arm).name] = (
+            arm_thickness,
+            arm_scale_ratio,
+            arm_thickness,
+        )
 
     if not scale_hand:
-        for hand in [get_bone("left_wrist", arm), get_bone("right_wrist", arm)]:
-            hand.scale = (1 / arm_thickness, 1 / arm_scale_ratio, 1 / arm_thickness)
+        for hand in ["left_wrist", "right_wrist"]:
+            rescale_pose.scales[get_bone(hand, arm).name] = (
+                1 / arm_thickness,
+                1 / arm_scale_ratio,
+                1 / arm_thickness,
+            )
+    return rescale_pose
+
+
+@traced()
+def scale_to_floor(
+    arm_to_legs,
+    arm_thickness,
+    leg_thickness,
+    extra_leg_length,
+    scale_hand,
+    thigh_percentage,
+    custom_scale_ratio,
+    scale_relative,
+    keep_head_size,
+    upper_body_portion,
+    apply_pose=True,
+    measurements=None,
+):
+    """Pose the armature with the proportions from the arguments, then apply the pose as the rest pose if apply_pose is
+    set. measurements must be of the armature in its rest pose, so that they stay correct after the pose is reset."""
+    arm = get_armature()
 
-            result_final_points, result_total_legs = get_leg_proportions(arm)
-        print("Implemented leg portions: {}".format(result_final_points))
+    # Possibly for these scale calculation parts, before we adjust any bones, we could change the armature pose to
+    # 'REST' instead of resetting the pose and then taking measurements
+    # POSE mode is only entered when the pose gets applied, setting and measuring the pose works in OBJECT mode too
+    reset_pose(arm)
+
+    # Every measurement up until the pose is applied is taken from this, so each mesh only gets read once
+    if measurements is None:
+        measurements = AvatarMeasurements(arm)
+    rescale_pose = compute_rescale_pose(
+        arm,
+        measurements,
+        arm_to_legs,
+        arm_thickness,
+        leg_thickness,
+        extra_leg_length,
+        scale_hand,
+        thigh_percentage,
+        custom_scale_ratio,
+        scale_relative,
+        keep_head_size,
+        upper_body_portion,
+    )
+    apply_rescale_pose(arm, rescale_pose)
+
+    measurements.invalidate_bones()
+    result_final_points, result_total_legs = measurements.leg_proportions
+    log("Implemented leg portions: {}", result_final_points)
 
-    # Apply the pose as rest pose, updating the meshes and their shape keys if they have them
-    apply_pose_to_rest()
+    if apply_pose:
+        # Apply the pose as rest pose, updating the meshes and their shape keys if they have them
+        apply_pose_to_rest()
 
 
-def move_to_floor():
+@traced()
+def move_to_floor(measurements=None):
     """Move the avatar down so that its lowest_point is at z=0 and set the origin of the armature and meshes to
     (armature_x, armature_y, z=0)"""
     # Currently, the meshes have their origin set to the same as the armature, but it might be better to not touch the
@@ -794,13 +1110,17 @@ def move_to_floor():
     # Move armature object down by get_lowest_point() (also moving the meshes, since they must be parented to the
     # armature)
     arm = get_armature()
+    if measurements is None:
+        measurements = AvatarMeasurements(arm)
+    lowest_point = measurements.lowest_point
     # arm.location is unreliable if the armature has a parent. The armature *shouldn't* be parented to something else,
     # but in-case it is, we can get worldspace location from the translation part of its .matrix_world
     arm_location_world = arm.matrix_world.translation
     # Updating a component of the matrix_world's translation will automatically update the armature Object's location,
     # so we can simply subtract get_lowest_point() from the z component to move the armature down so that the lowest
     # part of the avatar's meshes is at z=0 in worldspace.
-    arm_location_world.z -= get_lowest_point()
+    arm_location_world.z -= lowest_point
+    measurements.moved(-lowest_point)
 
     # Set origin of armature and each mesh to (worldspace_arm_x, worldspace_arm_y, 0)
     new_origin = arm_location_world.copy()
@@ -809,7 +1129,7 @@ def move_to_floor():
     bpy.context.scene.cursor.location = new_origin
 
     # Get all meshes and append the armature since we're setting the origin for all of them
-    all_objects = get_body_meshes()
+    all_objects = list(measurements.meshes)
     all_objects.append(arm)
 
     # While bpy.ops.object.origin_set doesn't raise an error when encountering multi-user data, changing the origin of
@@ -843,6 +1163,10 @@ def recursive_object_mode(objects: Iterable[bpy.types.Object]):
         op_mode_set = bpy.ops.object.mode_set
         with temp_ensure_enabled(*objects):
             for o in objects:
+                # Leaving a mode that multiple objects are in, e.g. multi-object POSE or EDIT mode, takes all of them out
+                # of that mode at once, so objects that have since been taken out of their mode get skipped
+                if o.mode == "OBJECT":
+                    continue
                 # poll checks that the active_object is 'editable' (hide_viewport or hide_viewport inherited from parent
                 # or collection is False, it's not from a linked library and is not a non-editable library override
                 # object)
@@ -850,6 +1174,7 @@ def recursive_object_mode(objects: Iterable[bpy.types.Object]):
                 op_override(op_mode_set, override, mode="OBJECT", toggle=False)
 
 
+@traced()
 def recursive_scale(objects: Iterable[bpy.types.Object]):
     """Apply scale transforms to objects, assumes the objects are already in OBJECT mode"""
     scene_objects = bpy.context.scene.objects
@@ -868,17 +1193,20 @@ def recursive_scale(objects: Iterable[bpy.types.Object]):
         )
 
 
-def scale_to_height(new_height, scale_eyes):
+@traced()
+def scale_to_height(new_height, scale_eyes, measurements=None):
     obj = get_armature()
+    if measurements is None:
+        measurements = AvatarMeasurements(obj)
     if scale_eyes:
-        old_height = get_eye_height(obj) - get_lowest_point()
+        old_height = measurements.eye_height - measurements.lowest_point
     else:
-        old_height = get_highest_point() - get_lowest_point()
+        old_height = measurements.highest_point - measurements.lowest_point
 
-    print("Old height is %f" % old_height)
+    log("Old height is {:f}", old_height)
 
     scale_ratio = new_height / old_height
-    print("Scaling by %f to achieve target height" % scale_ratio)
+    log("Scaling by {:f} to achieve target height", scale_ratio)
     bpy.context.scene.cursor.location = obj.matrix_world.translation
     bpy.context.view_layer.objects.active = obj
     obj.select_set(True)
@@ -891,6 +1219,218 @@ def scale_to_height(new_height, scale_eyes):
     recursive_scale(obj_and_all_children)
 
 
+def can_bake_rescale_in_single_pass(arm, meshes):
+    return all(can_deform_with_numpy(arm, mesh_obj) for mesh_obj in meshes)
+
+
+def _get_lowest_and_highest_point_from_co(arm, mesh_cos):
+    """get_lowest_point() and get_highest_point() for vertex positions that aren't (yet) in the meshes.
+
+    mesh_cos is a list of (mesh_obj, matrix_world, v_co)"""
+    foot_bones = get_foot_bone_names(arm)
+    lowest_vertex_z = math.inf
+    lowest_foot_z = math.inf
+    highest_vertex_z = -math.inf
+    for mesh_obj, wm, v_co in mesh_cos:
+        if len(v_co) == 0:
+            continue
+        global_z = get_global_z_from_co_ndarray(v_co, wm)
+        highest_vertex_z = max(highest_vertex_z, global_z.max())
+        lowest_vertex_z = min(lowest_vertex_z, global_z.min())
+        foot_group_indices = get_group_indices(mesh_obj, foot_bones)
+        if foot_group_indices:
+            foot_v_mask = get_vertex_weights(mesh_obj).vertex_mask(foot_group_indices)
+            if foot_v_mask.any():
+                lowest_foot_z = min(lowest_foot_z, global_z[foot_v_mask].min())
+    if highest_vertex_z == -math.inf:
+        raise RuntimeError("No mesh data found")
+    # Like get_lowest_point(), vertices weighted to the feet take priority
+    if lowest_foot_z < math.inf:
+        return lowest_foot_z, highest_vertex_z
+    return lowest_vertex_z, highest_vertex_z
+
+
+@traced()
+def bake_rescale_in_single_pass(
+    arm,
+    meshes,
+    new_height,
+    scale_eyes,
+    apply_pose=True,
+    move_floor=True,
+    scale_height=True,
+):
+    """See bake_rescale_in_single_pass_iter()"""
+    return run_iter(
+        bake_rescale_in_single_pass_iter(
+            arm, meshes, new_height, scale_eyes, apply_pose, move_floor, scale_height
+        )
+    )
+
+
+def count_single_bake_steps(meshes) -> int:
+    """The number of times bake_rescale_in_single_pass_iter() yields for meshes"""
+    steps = 0
+    for mesh_obj in meshes:
+        shape_keys = mesh_obj.data.shape_keys
+        steps += 2 + (len(shape_keys.key_blocks) if shape_keys else 0)
+    return steps
+
+
+def bake_rescale_in_single_pass_iter(
+    arm,
+    meshes,
+    new_height,
+    scale_eyes,
+    apply_pose=True,
+    move_floor=True,
+    scale_height=True,
+):
+    """Does the same as apply_pose_to_rest(), move_to_floor() and then scale_to_height(), but each mesh's vertices and
+    shape keys are only written once.
+
+    The pose, the move to the floor, the change of origin and the height scaling are combined into one transform per
+    vertex, which is then written to the mesh data in a single pass. Only the armature is changed stage by stage, which
+    is cheap since it only affects bones. Every mesh must be deformable with NumPy, see
+    can_bake_rescale_in_single_pass().
+
+    Yields the name of each mesh after it has been read and after each of its shape keys has been written. Returns the
+    worldspace lowest and highest points of the meshes afterwards."""
+    # Pose bone and object matrices are only updated when evaluated, which won't have happened yet if the pose was
+    # only just set
+    view_layer_update()
+
+    # Deform the 'basis' of each mesh by the pose, but only in memory for now, so that the avatar can be measured as it
+    # will be once the pose has been applied
+    mesh_states = []
+    for mesh_obj in meshes:
+        me = mesh_obj.data
+        if me.users > 1:
+            # Only mesh_obj is being rescaled, so other objects sharing the same mesh must not be affected
+            me = me.copy()
+            mesh_obj.data = me
+        blended_matrices = None
+        if apply_pose:
+            blended_matrices = get_blended_deform_matrices(arm, mesh_obj)
+        v_co = np.empty(len(me.vertices) * 3, dtype=np.single)
+        # The 'basis' (reference) shape key is what users see in Blender, so use that when there are shape keys
+        if me.shape_keys:
+            foreach_get(me.shape_keys.reference_key.data, "co", v_co)
+        else:
+            foreach_get(me.vertices, "co", v_co)
+        if blended_matrices is not None:
+            v_co = deform_co_array(blended_matrices, v_co)
+        mesh_states.append(
+            (mesh_obj, mesh_obj.matrix_world.copy(), blended_matrices, v_co)
+        )
+        # The deform matrices and basis of every mesh are held until the meshes are written
+        record_arrays(mesh_obj.name, "single bake", blended_matrices, v_co)
+        yield mesh_obj.name
+
+    lowest_point, highest_point = _get_lowest_and_highest_point_from_co(
+        arm, [(mesh_obj, wm, v_co) for mesh_obj, wm, _blended, v_co in mesh_states]
+    )
+
+    # Worldspace transform of the entire avatar
+    arm_translation = arm.matrix_world.translation.copy()
+    floor_offset = 0.0
+    # scale_to_height() scales about the armature's origin, which move_to_floor() puts at z=0
+    pivot = arm_translation.copy()
+    if move_floor:
+        floor_offset = -lowest_point
+        pivot.z = 0
+    scale_ratio = 1.0
+    if scale_height:
+        if scale_eyes:
+            old_height = get_eye_height(arm) - lowest_point
+        else:
+            old_height = highest_point - lowest_point
+        log("Old height is {:f}", old_height)
+        scale_ratio = new_height / old_height
+        log("Scaling by {:f} to achieve target height", scale_ratio)
+    world_transform = (
+        mathutils.Matrix.Translation(pivot)
+        @ mathutils.Matrix.Scale(scale_ratio, 4)
+        @ mathutils.Matrix.Translation(-pivot)
+        @ mathutils.Matrix.Translation((0, 0, floor_offset))
+    )
+
+    # Update the armature the same as the individual stages would
+    if apply_pose:
+        enter_pose_mode(arm)
+        op_override(bpy.ops.pose.armature_apply, {"active_object": arm})
+    if move_floor:
+        arm.matrix_world.translation.z += floor_offset
+        bpy.context.scene.cursor.location = pivot
+        if arm.data.users > 1:
+            arm.data = arm.data.copy()
+        override = dict(active_object=None, selected_editable_objects=[arm])
+        op_override(bpy.ops.object.origin_set, override, type="ORIGIN_CURSOR")
+    if scale_height:
+        bpy.context.scene.cursor.location = arm.matrix_world.translation
+        arm.scale = arm.scale * scale_ratio
+        # Any children that aren't body meshes get their scale applied, the same as scale_to_height(). Applying scale
+        # to the armature makes the body meshes inherit the scale, but their transforms are replaced below anyway.
+        body_meshes = set(meshes)
+        objects = [o for o in children_recursive(arm) if o not in body_meshes]
+        objects.append(arm)
+        recursive_object_mode(objects)
+        recursive_scale(objects)
+
+    # Finally, write the meshes
+    for mesh_obj, old_matrix_world, blended_matrices, basis_co in mesh_states:
+        new_matrix_world = world_transform @ old_matrix_world
+        location, rotation, scale = new_matrix_world.decompose()
+        if move_floor:
+            # move_to_floor() sets the origin of the meshes to the same place as the armature's
+            location = pivot
+        if scale_height:
+            # scale_to_height() applies the scale of the meshes
+            scale = mathutils.Vector((1.0, 1.0, 1.0))
+        final_matrix_world = (
+            mathutils.Matrix.Translation(location)
+            @ rotation.to_matrix().to_4x4()
+            @ mathutils.Matrix.Diagonal(scale).to_4x4()
+        )
+        mesh_obj.matrix_world = final_matrix_world
+        # Transform from the old local space of the mesh to its new local space
+        data_transform = np.array(
+            final_matrix_world.inverted() @ new_matrix_world, dtype=np.double
+        )
+
+        me = mesh_obj.data
+        basis_co = transform_co_array(data_transform, basis_co)
+        if me.shape_keys:
+            shape_keys = me.shape_keys
+            reference_key = shape_keys.reference_key
+            composed_matrices = None
+            if blended_matrices is not None:
+                composed_matrices = compose_deform_matrices(
+                    data_transform, blended_matrices
+                )
+            v_co = np.empty(len(basis_co), dtype=np.single)
+            record_arrays(mesh_obj.name, "single bake write", composed_matrices, v_co)
+            for shape_key in shape_keys.key_blocks:
+                if shape_key == reference_key:
+                    foreach_set(shape_key.data, "co", basis_co)
+                else:
+                    foreach_get(shape_key.data, "co", v_co)
+                    if blended_matrices is not None:
+                        shape_key_co = deform_co_array(composed_matrices, v_co)
+                    else:
+                        shape_key_co = transform_co_array(data_transform, v_co)
+                    foreach_set(shape_key.data, "co", shape_key_co)
+                yield mesh_obj.name
+        foreach_set(me.vertices, "co", basis_co)
+        me.update()
+        yield mesh_obj.name
+
+    def transform_z(z):
+        return pivot.z + scale_ratio * (z + floor_offset - pivot.z)
+
+    return transform_z(lowest_point), transform_z(highest_point)
+
+
 def center_model(worldspace=True):
     arm = get_armature()
     if worldspace:
@@ -901,6 +1441,7 @@ def center_model(worldspace=True):
         arm.matrix_local.translation = (0, 0, 0)
 
 
+@traced()
 def rescale_main(
     new_height,
     arm_to_legs,
@@ -915,9 +1456,60 @@ def rescale_main(
     keep_head_size,
     upper_body_percent,
 ):
+    run_iter(
+        rescale_main_iter(
+            new_height,
+            arm_to_legs,
+            arm_thickness,
+            leg_thickness,
+            extra_leg_length,
+            scale_hand,
+            thigh_percentage,
+            custom_scale_ratio,
+            scale_eyes,
+            scale_relative,
+            keep_head_size,
+            upper_body_percent,
+        )
+    )
+
+
+def count_rescale_steps(arm, meshes) -> int:
+    """Roughly the number of times rescale_main_iter() yields"""
+    # Both ways of baking yield about once per mesh and shape key, the other stages yield once each
+    return count_single_bake_steps(meshes) + 4
+
+
+def rescale_main_iter(
+    new_height,
+    arm_to_legs,
+    arm_thickness,
+    leg_thickness,
+    extra_leg_length,
+    scale_hand,
+    thigh_percentage,
+    custom_scale_ratio,
+    scale_eyes,
+    scale_relative,
+    keep_head_size,
+    upper_body_percent,
+    rest_measurements=None,
+    single_bake=None,
+):
+    """Generator version of rescale_main(), yielding a description of what it has just done whenever it can be paused
+    for a time-sliced run. rest_measurements are used for the measurements taken before the pose is applied, when
+    given, see scale_to_floor(). single_bake overrides the scene's imscale_single_bake when not None, the single bake is
+    still only used when the avatar supports it."""
     context = bpy.context
     s = context.scene
 
+    arm = get_armature()
+    if single_bake is None:
+        single_bake = s.imscale_single_bake
+    single_bake = single_bake and can_bake_rescale_in_single_pass(
+        arm, get_body_meshes(arm)
+    )
+
     if not s.debug_no_adjust:
         scale_to_floor(
             arm_to_legs,
@@ -930,31 +1522,108 @@ def rescale_main(
             scale_relative,
             keep_head_size,
             upper_body_percent,
+            apply_pose=False,
+            measurements=rest_measurements,
+        )
+        yield "measured"
+        if not single_bake:
+            # Apply the pose as rest pose, updating the meshes and their shape keys if they have them
+            with span("apply_pose_to_rest"):
+                yield from apply_pose_to_rest_iter()
+    # The meshes have changed if the pose was applied, so take new measurements
+    measurements = AvatarMeasurements()
+    if single_bake:
+        lowest_point, highest_point = yield from bake_rescale_in_single_pass_iter(
+            arm,
+            measurements.meshes,
+            new_height,
+            scale_eyes,
+            apply_pose=not s.debug_no_adjust,
+            move_floor=not s.debug_no_floor,
+            scale_height=not s.debug_no_scale,
         )
-    if not s.debug_no_floor:
-        move_to_floor()
+        measurements.set_mesh_measurements(lowest_point, highest_point)
+        result_final_points, result_total_legs = measurements.leg_proportions
+        log("Final Implemented leg portions: {}", result_final_points)
+    else:
+        if not s.debug_no_floor:
+            move_to_floor(measurements)
+            yield "moved to floor"
 
-    result_final_points, result_total_legs = get_leg_proportions(get_armature())
-    print("Final Implemented leg portions: {}".format(result_final_points))
+        result_final_points, result_total_legs = measurements.leg_proportions
+        log("Final Implemented leg portions: {}", result_final_points)
 
-    if not s.debug_no_scale:
-        scale_to_height(new_height, scale_eyes)
+        if not s.debug_no_scale:
+            scale_to_height(new_height, scale_eyes, measurements)
+            yield "scaled to height"
 
     if s.center_model:
         center_model()
 
     if context.mode != "OBJECT":
-        # Ensure we go to OBJECT mode so that object.select_all can be called
-        bpy.ops.object.mode_set(mode="OBJECT")
-    bpy.ops.object.select_all(action="DESELECT")
+        # Leave the armature in OBJECT mode, the same as when the pose has been applied and the avatar scaled
+        mode_set(mode="OBJECT")
+    deselect_all()
+
+
+def rescale_main_from_scene(scene):
+    """Run rescale_main() with the settings stored in scene, the same settings the Rescale Armature button uses"""
+    rescale_main(
+        scene.target_height,
+        scene.arm_to_legs / 100.0,
+        scene.arm_thickness / 100.0,
+        scene.leg_thickness / 100.0,
+        scene.extra_leg_length,
+        scene.scale_hand,
+        scene.thigh_percentage / 100.0,
+        scene.custom_scale_ratio,
+        scene.scale_eyes,
+        scene.imscale_scale_upper_body,
+        scene.imscale_keep_head_size,
+        scene.upper_body_percentage / 100,
+    )
+
+
+# Scene properties that change the pose computed by compute_rescale_pose()
+_RESCALE_POSE_SETTINGS = (
+    "arm_to_legs",
+    "arm_thickness",
+    "leg_thickness",
+    "extra_leg_length",
+    "scale_hand",
+    "thigh_percentage",
+    "custom_scale_ratio",
+    "imscale_scale_upper_body",
+    "imscale_keep_head_size",
+    "upper_body_percentage",
+)
+
+
+def compute_rescale_pose_from_scene(arm, measurements, scene) -> RescalePose:
+    """Run compute_rescale_pose() with the settings stored in scene, the same settings rescale_main_from_scene() uses"""
+    return compute_rescale_pose(
+        arm,
+        measurements,
+        scene.arm_to_legs / 100.0,
+        scene.arm_thickness / 100.0,
+        scene.leg_thickness / 100.0,
+        scene.extra_leg_length,
+        scene.scale_hand,
+        scene.thigh_percentage / 100.0,
+        scene.custom_scale_ratio,
+        scene.imscale_scale_upper_body,
+        scene.imscale_keep_head_size,
+        scene.upper_body_percentage / 100,
+    )
 
 
+@traced()
 def shrink_hips():
     arm = get_armature()
 
     bpy.context.view_layer.objects.active = arm
     arm.select_set(True)
-    bpy.ops.object.mode_set(mode="EDIT", toggle=False)
+    mode_set(mode="EDIT", toggle=False)
 
     left_leg_name = get_bone("left_leg", arm).name
     right_leg_name = get_bone("right_leg", arm).name
@@ -971,11 +1640,11 @@ def shrink_hips():
     arm.data.edit_bones["Hips"].head[1] = arm.data.edit_bones["Spine"].head[1]
     arm.data.edit_bones["Hips"].head[0] = arm.data.edit_bones["Spine"].head[0]
 
-    bpy.ops.object.mode_set(mode="EDIT", toggle=True)
-    bpy.ops.object.select_all(action="DESELECT")
+    mode_set(mode="EDIT", toggle=True)
+    deselect_all()
 
 
-class ArmatureRescale(ArmatureOperator):
+class ArmatureRescale(SlicedArmatureOperator):
     """Script to scale most aspects of an armature for use in vrchat"""
 
     bl_idname = "armature.rescale"
@@ -992,8 +1661,23 @@ class ArmatureRescale(ArmatureOperator):
     # thigh_percentage: bpy.types.Scene.thigh_percentage
     # scale_eyes: bpy.types.Scene.scale_eyes
 
-    def execute_main(self, context, arm, meshes):
-        rescale_main(
+    def execute_main_iter(self, context, arm, meshes):
+        origin = None
+        rest_measurements = None
+        if context.scene.imscale_rerun_from_original:
+            # Rescaling again starts from how the avatar was before it was first rescaled, rather than scaling the
+            # already rescaled avatar, and reuses what was read from the meshes last time
+            origin = start_from_origin(arm, context)
+            rest_measurements = AvatarMeasurements(arm, meshes)
+            rest_measurements.set_mesh_values(origin.cache.get("mesh_values", {}))
+            cached_weights = origin.cache.get("weights", {})
+            for mesh_obj in meshes:
+                mesh_weights = cached_weights.get(mesh_obj.name)
+                if mesh_weights is not None:
+                    set_cached_weights(mesh_obj, mesh_weights)
+            yield "started from original"
+
+        yield from rescale_main_iter(
             self.target_height,
             self.arm_to_legs / 100.0,
             self.arm_thickness / 100.0,
@@ -1006,9 +1690,25 @@ class ArmatureRescale(ArmatureOperator):
             self.scale_upper_body,
             self.keep_head_size,
             self.upper_body_percentage / 100,
+            rest_measurements=rest_measurements,
+            # Reruns from the origin are meant to be quick to compare settings, so the faster single bake is always used
+            single_bake=True if origin is not None else None,
         )
+
+        if origin is not None:
+            origin.cache["mesh_values"] = rest_measurements.get_mesh_values()
+            # The weights don't change when rescaling, only the vertex positions
+            origin.cache["weights"] = {
+                mesh_obj.name: get_cached_weights(mesh_obj)
+                for mesh_obj in meshes
+                if get_cached_weights(mesh_obj) is not None
+            }
+            origin.finish(arm)
         return {"FINISHED"}
 
+    def estimate_steps(self, context, arm, meshes):
+        return count_rescale_steps(arm, meshes) + 1
+
     def invoke(self, context, event):
         s = context.scene
         self.target_height = s.target_height
@@ -1024,9 +1724,136 @@ class ArmatureRescale(ArmatureOperator):
         self.keep_head_size = s.imscale_keep_head_size
         self.upper_body_percentage = s.upper_body_percentage
 
+        if s.imscale_time_sliced:
+            return self.invoke_sliced(context)
         return self.execute(context)
 
 
+class ArmatureRescalePreview(ArmatureOperator):
+    """Preview the proportions from rescaling by posing the armature, updating as the settings change. Enter rescales,
+    Esc cancels"""
+
+    bl_idname = "armature.rescale_preview"
+    bl_label = "Preview Rescale"
+    bl_options = {"REGISTER", "UNDO"}
+
+    # Seconds between checks for changed settings
+    _CHECK_INTERVAL = 1 / 30
+
+    def execute_main(self, context, arm, meshes):
+        rescale_main_from_scene(context.scene)
+        return {"FINISHED"}
+
+    @staticmethod
+    def _read_settings(scene):
+        return tuple(getattr(scene, p) for p in _RESCALE_POSE_SETTINGS)
+
+    def invoke(self, context, event):
+        if context.mode != "OBJECT":
+            mode_set(mode="OBJECT")
+        weights.clear_weights_cache()
+        arm = get_armature()
+        self._arm = arm
+        # Saved so that cancelling puts everything back the way it was
+        self._saved_pose = {pb.name: pb.matrix_basis.copy() for pb in arm.pose.bones}
+        self._saved_pose_position = arm.data.pose_position
+        self._saved_inherit_scales = {}
+        self._rescale_pose = None
+
+        reset_pose(arm)
+        meshes = get_body_meshes(arm)
+        try:
+            # The meshes are only read here, for the lowest point. Every update after this only uses the remembered
+            # measurements of the rest pose, the pose itself deforms the meshes through their Armature modifiers.
+            with temp_ensure_enabled(arm, *meshes):
+                self._measurements = AvatarMeasurements(arm, meshes)
+                self._update_preview(context)
+        except Exception as e:
+            self._restore()
+            self.report({"ERROR"}, str(e))
+            return {"CANCELLED"}
+        self._settings = self._read_settings(context.scene)
+
+        wm = context.window_manager
+        self._timer = wm.event_timer_add(self._CHECK_INTERVAL, window=context.window)
+        wm.modal_handler_add(self)
+        context.workspace.status_text_set(
+            "Rescale preview: change the settings in the sidebar, Enter to rescale, Esc to cancel"
+        )
+        return {"RUNNING_MODAL"}
+
+    def _update_preview(self, context):
+        arm = self._arm
+        with quiet():
+            rescale_pose = compute_rescale_pose_from_scene(
+                arm, self._measurements, context.scene
+            )
+        bones = arm.data.bones
+        saved_inherit_scales = self._saved_inherit_scales
+        for name in rescale_pose.inherit_scales:
+            if name not in saved_inherit_scales:
+                saved_inherit_scales[name] = bones[name].inherit_scale
+        previous = self._rescale_pose
+        if previous is not None:
+            # Bones changed for the previous settings, but not for the current settings, go back to how they were
+            scales = rescale_pose.scales
+            for name in previous.scales.keys() - scales.keys():
+                scales[name] = (1.0, 1.0, 1.0)
+            inherit_scales = rescale_pose.inherit_scales
+            for name in previous.inherit_scales.keys() - inherit_scales.keys():
+                inherit_scales[name] = saved_inherit_scales[name]
+        apply_rescale_pose(arm, rescale_pose)
+        self._rescale_pose = rescale_pose
+
+    def _restore(self):
+        arm = self._arm
+        bones = arm.data.bones
+        for name, inherit_scale in self._saved_inherit_scales.items():
+            bones[name].inherit_scale = inherit_scale
+        saved_pose = self._saved_pose
+        for pb in arm.pose.bones:
+            matrix_basis = saved_pose.get(pb.name)
+            if matrix_basis is not None:
+                pb.matrix_basis = matrix_basis
+        arm.data.pose_position = self._saved_pose_position
+
+    def _finish(self, context):
+        context.window_manager.event_timer_remove(self._timer)
+        context.workspace.status_text_set(None)
+
+    def modal(self, context, event):
+        try:
+            self._arm.name
+        except ReferenceError:
+            # The armature has been deleted, or undo has replaced it, since the preview started
+            self._finish(context)
+            return {"CANCELLED"}
+
+        if event.type == "ESC" and event.value == "PRESS":
+            self._restore()
+            self._finish(context)
+            return {"CANCELLED"}
+        if event.type in {"RET", "NUMPAD_ENTER"} and event.value == "PRESS":
+            # Rescaling starts from the original inherit_scale settings, the same as without the preview
+            self._restore()
+            self._finish(context)
+            # Only now do the meshes get baked
+            return self.execute(context)
+        if event.type == "TIMER":
+            settings = self._read_settings(context.scene)
+            if settings != self._settings:
+                self._settings = settings
+                try:
+                    self._update_preview(context)
+                except Exception as e:
+                    self._restore()
+                    self._finish(context)
+                    self.report({"ERROR"}, str(e))
+                    return {"CANCELLED"}
+        # Let the sidebar get the events, so the settings can be changed while previewing
+        return {"PASS_THROUGH"}
+
+
 class ArmatureShrinkHip(ArmatureOperator):
     """Shrinks the hip bone in a humaniod avatar to be much closer to the spine location"""
 
@@ -1047,12 +1874,12 @@ class UIGetCurrentHeight(ArmatureOperator):
     bl_options = {"REGISTER", "UNDO"}
 
     def execute_main(self, context, arm, meshes):
-        height = 1.5  # Placeholder
-        lowest_point = get_lowest_point()
+        measurements = AvatarMeasurements(arm, meshes)
+        lowest_point = measurements.lowest_point
         if context.scene.scale_eyes:
-            height = get_eye_height(arm) - lowest_point
+            height = measurements.eye_height - lowest_point
         else:
-            height = get_highest_point() - lowest_point
+            height = measurements.highest_point - lowest_point
         context.scene.target_height = height
         return {"FINISHED"}
 
@@ -1098,10 +1925,17 @@ class UIGetUpperBodyPercent(ArmatureOperator):
         return {"FINISHED"}
 
 
+ArmatureRescaleNoUndo = no_undo_variant(ArmatureRescale)
+ArmatureShrinkHipNoUndo = no_undo_variant(ArmatureShrinkHip)
+
+
 _register, _unregister = bpy.utils.register_classes_factory(
     [
         ArmatureRescale,
+        ArmatureRescaleNoUndo,
+        ArmatureRescalePreview,
         ArmatureShrinkHip,
+        ArmatureShrinkHipNoUndo,
         UIGetCurrentHeight,
         UIGetScaleRatio,
         UIGetCurrentUpperLegPercent,
@@ -2,48 +2,108 @@ import bpy
 import importlib
 import numpy as np
 
-from typing import cast
+from contextlib import contextmanager
+from typing import cast, Optional
 
 from . import common
+from . import instrument
+from . import weights
 
 importlib.reload(common)
+importlib.reload(instrument)
+importlib.reload(weights)
 
-from .common import get_armature, get_body_meshes, op_override
+from .common import get_armature, get_body_meshes, op_override, run_iter
+from .instrument import (
+    depsgraph_update,
+    foreach_get,
+    foreach_set,
+    mode_set,
+    record_arrays,
+    span,
+    traced,
+    view_layer_update,
+)
+from .weights import get_vertex_weights
 
 
 _ZERO_ROTATION_QUATERNION = np.array([1, 0, 0, 0], dtype=np.single)
 
+# Methods of deforming the meshes when applying the pose as the rest pose, see apply_pose_to_rest()
+DEFORM_MODIFIER = "MODIFIER"
+DEFORM_NUMPY = "NUMPY"
 
-def start_pose_mode_with_reset(arm):
-    """Replacement for Cats 'start pose mode' operator"""
+# The Armature modifier only deforms vertices whose total weight to deforming bones is greater than this
+_MIN_TOTAL_WEIGHT = 0.0001
+
+
+def enter_pose_mode(arm):
+    """Open arm in POSE mode as the active object.
+
+    Blender only needs POSE mode for applying the pose as the rest pose, reading and setting the pose works in any mode
+    other than EDIT mode, so apply_pose_to_rest() calls this itself, right before it's needed."""
     vl_objects = bpy.context.view_layer.objects
     if vl_objects.active != arm:
         if bpy.context.mode != "OBJECT":
             # Exit to OBJECT mode with whatever is the currently active object
-            bpy.ops.object.mode_set(mode="OBJECT")
+            mode_set(mode="OBJECT")
         # Set the armature as the active object
         vl_objects.active = arm
 
     if arm.mode != "POSE":
         # Open the armature in pose mode
-        bpy.ops.object.mode_set(mode="POSE")
+        mode_set(mode="POSE")
+
 
+def reset_pose(arm):
+    """Reset the pose of arm to its rest pose without changing mode, unless arm is in EDIT mode.
+
+    Changes made in EDIT mode only reach the Bones and PoseBones of the armature once EDIT mode is exited, so EDIT
+    mode is exited to OBJECT mode. Every other mode is left as it is."""
+    if arm.mode == "EDIT":
+        op_override(bpy.ops.object.mode_set, {"active_object": arm}, mode="OBJECT")
     # Clear the current pose of the armature (doesn't require POSE mode, just must not be in EDIT mode)
     reset_current_pose(arm.pose.bones)
     # Ensure that the armature data is set to pose position, otherwise setting a pose has no effect
     arm.data.pose_position = "POSE"
 
 
+@contextmanager
+def pose_bones_synced(arm):
+    """Make changes made to arm in EDIT mode visible to its PoseBones within the with block, going back to EDIT mode
+    afterwards. Outside of EDIT mode, PoseBones are always up-to-date, so no mode is changed."""
+    if arm.mode != "EDIT":
+        yield
+        return
+    # Object.update_from_editmode() only seems to update the Bones of the armature and not the PoseBones of the armature
+    # Object, so I don't think that can be used instead of swapping
+    bpy.context.view_layer.objects.active = arm
+    mode_set(mode="POSE", toggle=False)
+    try:
+        yield
+    finally:
+        # Restore original mode
+        mode_set(mode="POSE", toggle=True)
+
+
+def start_pose_mode_with_reset(arm):
+    """Replacement for Cats 'start pose mode' operator"""
+    enter_pose_mode(arm)
+    reset_pose(arm)
+
+
 def reset_current_pose(pose_bones):
     """Resets the location, scale and rotation of each pose bone to the rest pose."""
     num_bones = len(pose_bones)
     # 3 components: X, Y, Z, set each bone to (0,0,0)
-    pose_bones.foreach_set("location", np.zeros(num_bones * 3, dtype=np.single))
+    foreach_set(pose_bones, "location", np.zeros(num_bones * 3, dtype=np.single))
     # 3 components: X, Y, Z, set each bone to (1,1,1)
-    pose_bones.foreach_set("scale", np.ones(num_bones * 3, dtype=np.single))
+    foreach_set(pose_bones, "scale", np.ones(num_bones * 3, dtype=np.single))
     # 4 components: W, X, Y, Z, set each bone to (1, 0, 0, 0)
-    pose_bones.foreach_set(
-        "rotation_quaternion", np.tile(_ZERO_ROTATION_QUATERNION, num_bones)
+    foreach_set(
+        pose_bones,
+        "rotation_quaternion",
+        np.tile(_ZERO_ROTATION_QUATERNION, num_bones),
     )
 
 
@@ -97,7 +157,10 @@ def _apply_armature_to_mesh_with_no_shape_keys(armature_obj, mesh_obj, preserve_
     op_override(bpy.ops.object.modifier_apply, context_override, modifier=mod_name)
 
 
-def _apply_armature_to_mesh_with_shape_keys(armature_obj, mesh_obj, preserve_volume):
+def _apply_armature_to_mesh_with_shape_keys_iter(
+    armature_obj, mesh_obj, preserve_volume
+):
+    """Yields after each shape key"""
     # The active shape key will be changed, so save the current active index, so it can be restored afterwards
     old_active_shape_key_index = mesh_obj.active_shape_key_index
 
@@ -108,7 +171,6 @@ def _apply_armature_to_mesh_with_shape_keys(armature_obj, mesh_obj, preserve_vol
     old_show_only_shape_key = mesh_obj.show_only_shape_key
     mesh_obj.show_only_shape_key = True
 
-    # Temporarily remove vertex_groups from and disable mutes on shape keys because they affect pinned shape keys
     me = mesh_obj.data
     if me.users > 1:
         # Imagine two objects in different places with the same mesh data. Both objects can move different amounts
@@ -118,121 +180,412 @@ def _apply_armature_to_mesh_with_shape_keys(armature_obj, mesh_obj, preserve_vol
         mesh_obj.data = me
     shape_key_vertex_groups = []
     shape_key_mutes = []
-    key_blocks = me.shape_keys.key_blocks
-    for shape_key in key_blocks:
-        shape_key_vertex_groups.append(shape_key.vertex_group)
-        shape_key.vertex_group = ""
-        shape_key_mutes.append(shape_key.mute)
-        shape_key.mute = False
-
-    # Temporarily disable all modifiers from showing in the viewport so that they have no effect
     mods_to_reenable_viewport = []
-    for mod in mesh_obj.modifiers:
-        if mod.show_viewport:
-            mod.show_viewport = False
-            mods_to_reenable_viewport.append(mod)
+    armature_mod = None
+    # The temporary changes are undone in the 'finally', so they are also undone when the generator is closed early
+    # because a time-sliced run has been cancelled
+    try:
+        # Temporarily remove vertex_groups from and disable mutes on shape keys because they affect pinned shape keys
+        key_blocks = me.shape_keys.key_blocks
+        for shape_key in key_blocks:
+            shape_key_vertex_groups.append(shape_key.vertex_group)
+            shape_key.vertex_group = ""
+            shape_key_mutes.append(shape_key.mute)
+            shape_key.mute = False
 
-    # Temporarily add a new armature modifier
-    armature_mod = _create_armature_mod_for_apply(
-        armature_obj, mesh_obj, preserve_volume
+        # Temporarily disable all modifiers from showing in the viewport so that they have no effect
+        for mod in mesh_obj.modifiers:
+            if mod.show_viewport:
+                mod.show_viewport = False
+                mods_to_reenable_viewport.append(mod)
+
+        # Temporarily add a new armature modifier
+        armature_mod = _create_armature_mod_for_apply(
+            armature_obj, mesh_obj, preserve_volume
+        )
+
+        # cos are xyz positions and get flattened when using the foreach_set/foreach_get functions, so the array
+        # length will be 3 times the number of vertices
+        co_length = len(me.vertices) * 3
+        # We can re-use the same array over and over
+        eval_verts_cos_array = np.empty(co_length, dtype=np.single)
+        record_arrays(mesh_obj.name, "pose bake", eval_verts_cos_array)
+
+        # The first shape key will be the first one we'll affect, so set it as active before we get the depsgraph to
+        # avoid having to update the depsgraph
+        mesh_obj.active_shape_key_index = 0
+        # depsgraph lets us evaluate objects and get their state after the effect of modifiers and shape keys
+        # Get the depsgraph
+        depsgraph = bpy.context.evaluated_depsgraph_get()
+        # Evaluate the mesh
+        evaluated_mesh_obj = mesh_obj.evaluated_get(depsgraph)
+
+        # The cos of the vertices of the evaluated mesh include the effect of the pinned shape key and all the
+        # modifiers (in this case, only the armature modifier we added since all the other modifiers are disabled in
+        # the viewport).
+        # This combination gives the same effect as if we'd applied the armature modifier to a mesh with the same
+        # shape as the active shape key, so we can simply set the shape key to the evaluated mesh position.
+        #
+        # Get the evaluated cos
+        foreach_get(evaluated_mesh_obj.data.vertices, "co", eval_verts_cos_array)
+        # Set the 'basis' (reference) shape key
+        foreach_set(key_blocks[0].data, "co", eval_verts_cos_array)
+        # And also set the mesh vertices to ensure that the two remain in sync
+        foreach_set(me.vertices, "co", eval_verts_cos_array)
+        yield
+
+        # For the remainder of the shape keys, we only need to update the shape key itself
+        with span("shape key bake", shape_keys=len(key_blocks) - 1):
+            for i, shape_key in enumerate(key_blocks[1:], start=1):
+                # As shape key pinning is enabled, when we change the active shape key, it will change the state of the
+                # mesh
+                mesh_obj.active_shape_key_index = i
+
+                # In order for the change to the active shape key to take effect, the depsgraph has to be updated
+                depsgraph_update(depsgraph)
+                # Get the evaluated Object again, since Blender could have replaced it while a time-sliced run was
+                # paused
+                evaluated_mesh_obj = mesh_obj.evaluated_get(depsgraph)
+
+                # Get the cos of the vertices from the evaluated mesh
+                foreach_get(
+                    evaluated_mesh_obj.data.vertices, "co", eval_verts_cos_array
+                )
+                # And set the shape key to those same cos
+                foreach_set(shape_key.data, "co", eval_verts_cos_array)
+                yield
+    finally:
+        # Restore temporarily changed attributes and remove the added armature modifier
+        for mod in mods_to_reenable_viewport:
+            mod.show_viewport = True
+        if armature_mod is not None:
+            mesh_obj.modifiers.remove(armature_mod)
+        for shape_key, vertex_group, mute in zip(
+            me.shape_keys.key_blocks, shape_key_vertex_groups, shape_key_mutes
+        ):
+            shape_key.vertex_group = vertex_group
+            shape_key.mute = mute
+        mesh_obj.active_shape_key_index = old_active_shape_key_index
+        mesh_obj.show_only_shape_key = old_show_only_shape_key
+
+
+def can_deform_with_numpy(armature_obj, mesh_obj, preserve_volume=False):
+    """Check whether the NumPy deformation gives the same result as an Armature modifier would for mesh_obj.
+
+    Only the default linear blending of bone transforms is implemented, so preserve volume (dual quaternion blending)
+    and B-Bones with more than one segment are not supported."""
+    if preserve_volume:
+        return False
+    pose_bones = armature_obj.pose.bones
+    for vg in mesh_obj.vertex_groups:
+        pose_bone = pose_bones.get(vg.name)
+        if (
+            pose_bone is not None
+            and pose_bone.bone.use_deform
+            and pose_bone.bone.bbone_segments > 1
+        ):
+            return False
+    return True
+
+
+def _get_group_deform_matrices(armature_obj, mesh_obj, bone_deforms=None):
+    """Get the matrix each vertex group of mesh_obj deforms its vertices by, in the local space of mesh_obj.
+
+    Returns a (num_vertex_groups, 4, 4) array and a boolean array of which vertex groups deform at all. A vertex group
+    only deforms when it has the same name as a bone of the armature that has Deform enabled. bone_deforms maps bone
+    names to the armature space deformation of each bone, by default the change from the rest pose to the current
+    pose."""
+    pose_bones = armature_obj.pose.bones
+    vertex_groups = mesh_obj.vertex_groups
+    num_groups = len(vertex_groups)
+    group_matrices = np.empty((num_groups, 4, 4), dtype=np.double)
+    deforming = np.zeros(num_groups, dtype=bool)
+
+    # The Armature modifier deforms in the armature's space, so vertices are transformed from mesh_obj's space into the
+    # armature's space, deformed and then transformed back
+    mesh_to_armature = armature_obj.matrix_world.inverted() @ mesh_obj.matrix_world
+    armature_to_mesh = mesh_to_armature.inverted()
+    for idx, vg in enumerate(vertex_groups):
+        pose_bone = pose_bones.get(vg.name)
+        if pose_bone is None or not pose_bone.bone.use_deform:
+            continue
+        if bone_deforms is not None:
+            bone_deform = bone_deforms[vg.name]
+        else:
+            # The change from the rest pose to the current pose of the bone
+            bone_deform = pose_bone.matrix @ pose_bone.bone.matrix_local.inverted()
+        # Converting a mathutils.Matrix to an np.ndarray gives an array of its rows
+        group_matrices[idx] = armature_to_mesh @ bone_deform @ mesh_to_armature
+        deforming[idx] = True
+    return group_matrices, deforming
+
+
+def get_blended_deform_matrices(
+    armature_obj, mesh_obj, bone_deforms=None
+) -> Optional[np.ndarray]:
+    """Get the transform the current pose of armature_obj applies to each vertex of mesh_obj, the same as an Armature
+    modifier would do without preserve volume.
+
+    Each vertex is transformed by the average of the matrices of the bones it's weighted to, weighted by its weights.
+    That makes the deformation of each vertex a single affine transform, so it can be applied to the vertex positions
+    of the mesh and every shape key alike. Returns a (num_verts, 3, 4) array of the top three rows of each vertex's
+    transform, or None if the pose doesn't deform any vertices. See _get_group_deform_matrices() for bone_deforms."""
+    group_matrices, deforming = _get_group_deform_matrices(
+        armature_obj, mesh_obj, bone_deforms
     )
+    vertex_weights = get_vertex_weights(mesh_obj)
+    num_verts = vertex_weights.num_verts
+    rows, groups, data = vertex_weights.triples()
 
-    # cos are xyz positions and get flattened when using the foreach_set/foreach_get functions, so the array length
-    # will be 3 times the number of vertices
-    co_length = len(me.vertices) * 3
-    # We can re-use the same array over and over
-    eval_verts_cos_array = np.empty(co_length, dtype=np.single)
-
-    # The first shape key will be the first one we'll affect, so set it as active before we get the depsgraph to avoid
-    # having to update the depsgraph
-    mesh_obj.active_shape_key_index = 0
-    # depsgraph lets us evaluate objects and get their state after the effect of modifiers and shape keys
-    # Get the depsgraph
-    depsgraph = bpy.context.evaluated_depsgraph_get()
-    # Evaluate the mesh
-    evaluated_mesh_obj = mesh_obj.evaluated_get(depsgraph)
-
-    # The cos of the vertices of the evaluated mesh include the effect of the pinned shape key and all the
-    # modifiers (in this case, only the armature modifier we added since all the other modifiers are disabled in
-    # the viewport).
-    # This combination gives the same effect as if we'd applied the armature modifier to a mesh with the same
-    # shape as the active shape key, so we can simply set the shape key to the evaluated mesh position.
-    #
-    # Get the evaluated cos
-    evaluated_mesh_obj.data.vertices.foreach_get("co", eval_verts_cos_array)
-    # Set the 'basis' (reference) shape key
-    key_blocks[0].data.foreach_set("co", eval_verts_cos_array)
-    # And also set the mesh vertices to ensure that the two remain in sync
-    me.vertices.foreach_set("co", eval_verts_cos_array)
-
-    # For the remainder of the shape keys, we only need to update the shape key itself
-    for i, shape_key in enumerate(key_blocks[1:], start=1):
-        # As shape key pinning is enabled, when we change the active shape key, it will change the state of the mesh
-        mesh_obj.active_shape_key_index = i
-
-        # In order for the change to the active shape key to take effect, the depsgraph has to be updated
-        depsgraph.update()
-
-        # Get the cos of the vertices from the evaluated mesh
-        evaluated_mesh_obj.data.vertices.foreach_get("co", eval_verts_cos_array)
-        # And set the shape key to those same cos
-        shape_key.data.foreach_set("co", eval_verts_cos_array)
-
-    # Restore temporarily changed attributes and remove the added armature modifier
-    for mod in mods_to_reenable_viewport:
-        mod.show_viewport = True
-    mesh_obj.modifiers.remove(armature_mod)
-    for shape_key, vertex_group, mute in zip(
-        me.shape_keys.key_blocks, shape_key_vertex_groups, shape_key_mutes
-    ):
-        shape_key.vertex_group = vertex_group
-        shape_key.mute = mute
-    mesh_obj.active_shape_key_index = old_active_shape_key_index
-    mesh_obj.show_only_shape_key = old_show_only_shape_key
-
-
-def apply_pose_to_rest(preserve_volume=False, arm=None):
+    # Weights can exist for vertex groups that have since been removed from the Object, those never deform
+    in_range = groups < len(deforming)
+    rows, groups, data = rows[in_range], groups[in_range], data[in_range]
+    used = deforming[groups] & (data > 0)
+    if not used.any():
+        return None
+    rows, groups = rows[used], groups[used]
+    data = data[used].astype(np.double)
+
+    total_weights = np.bincount(rows, weights=data, minlength=num_verts)
+    # Sum the weighted matrices of each vertex one matrix component at a time. np.bincount is used to sum the
+    # contribution of every weight to the vertex it belongs to, which is much faster than np.add.at.
+    flat_matrices = group_matrices[:, :3, :].reshape(-1, 12)
+    blended = np.empty((num_verts, 12), dtype=np.double)
+    for component in range(12):
+        blended[:, component] = np.bincount(
+            rows, weights=data * flat_matrices[groups, component], minlength=num_verts
+        )
+
+    deformed = total_weights > _MIN_TOTAL_WEIGHT
+    blended[deformed] /= total_weights[deformed, np.newaxis]
+    # Vertices that aren't (sufficiently) weighted to deforming bones stay where they are
+    blended[~deformed] = np.eye(3, 4, dtype=np.double).ravel()
+    return blended.reshape(num_verts, 3, 4)
+
+
+def deform_co_array(blended_matrices: np.ndarray, v_co: np.ndarray) -> np.ndarray:
+    """Transform a flat single precision co array by the per-vertex transforms from get_blended_deform_matrices()"""
+    v_co = v_co.reshape(-1, 3).astype(np.double)
+    deformed = np.einsum("nij,nj->ni", blended_matrices[:, :, :3], v_co)
+    deformed += blended_matrices[:, :, 3]
+    return deformed.astype(np.single).ravel()
+
+
+def transform_co_array(matrix: np.ndarray, v_co: np.ndarray) -> np.ndarray:
+    """Transform a flat single precision co array by a single 4x4 (or 3x4) matrix"""
+    v_co = v_co.reshape(-1, 3).astype(np.double)
+    transformed = v_co @ matrix[:3, :3].T
+    transformed += matrix[:3, 3]
+    return transformed.astype(np.single).ravel()
+
+
+def compose_deform_matrices(matrix: np.ndarray, blended_matrices: np.ndarray):
+    """Get per-vertex transforms that first apply blended_matrices and then matrix, a single 4x4 (or 3x4) matrix"""
+    composed = np.empty_like(blended_matrices)
+    rotation_scale = matrix[:3, :3]
+    composed[:, :, :3] = np.einsum(
+        "ij,njk->nik", rotation_scale, blended_matrices[:, :, :3]
+    )
+    composed[:, :, 3] = blended_matrices[:, :, 3] @ rotation_scale.T
+    composed[:, :, 3] += matrix[:3, 3]
+    return composed
+
+
+def _apply_armature_to_mesh_with_numpy_iter(armature_obj, mesh_obj, bone_deforms=None):
+    """Yields after each shape key"""
+    me = mesh_obj.data
+    if me.users > 1:
+        # Like when applying a modifier, a copy of multi-user data has to be made so that other objects using the same
+        # mesh are unaffected
+        me = me.copy()
+        mesh_obj.data = me
+
+    with span("blend deform matrices"):
+        blended_matrices = get_blended_deform_matrices(
+            armature_obj, mesh_obj, bone_deforms
+        )
+    if blended_matrices is None:
+        return
+
+    num_verts = len(me.vertices)
+    # We can re-use the same array for reading every shape key
+    v_co = np.empty(num_verts * 3, dtype=np.single)
+    # Deforming also allocates a float64 copy of v_co and the deformed result
+    record_arrays(mesh_obj.name, "pose bake", blended_matrices, v_co)
+    if me.shape_keys:
+        shape_keys = me.shape_keys
+        reference_key = shape_keys.reference_key
+        # Each shape key stores the absolute position of every vertex, and without preserve volume, the deformation of
+        # each vertex is the same affine transform no matter where the vertex is, so every shape key can be deformed
+        # with the same blended matrices. This gives the same result as evaluating each shape key pinned with an
+        # Armature modifier, but without having to update the depsgraph for each shape key, and since the shape keys
+        # are never evaluated, there's no need to temporarily change show_only_shape_key, mutes or vertex groups.
+        key_blocks = shape_keys.key_blocks
+        with span("shape key bake", shape_keys=len(key_blocks)):
+            for shape_key in key_blocks:
+                shape_key_data = shape_key.data
+                foreach_get(shape_key_data, "co", v_co)
+                deformed_co = deform_co_array(blended_matrices, v_co)
+                foreach_set(shape_key_data, "co", deformed_co)
+                if shape_key == reference_key:
+                    # The 'basis' (reference) shape key is what users see in Blender, keep the mesh vertices in sync
+                    # with it
+                    foreach_set(me.vertices, "co", deformed_co)
+                yield
+    else:
+        foreach_get(me.vertices, "co", v_co)
+        foreach_set(me.vertices, "co", deform_co_array(blended_matrices, v_co))
+    me.update()
+
+
+@traced()
+def apply_pose_to_rest(preserve_volume=False, arm=None, deform_mode=None):
     """Apply pose to armature and meshes, taking into account shape keys on the meshes.
-    The armature must be in Pose mode."""
+    The armature is put into POSE mode if it isn't already, since Blender requires it for applying the pose.
+
+    deform_mode picks how the meshes are deformed, DEFORM_MODIFIER applies a temporary Armature modifier to each mesh
+    while DEFORM_NUMPY deforms the vertices directly, which avoids evaluating the modifier stack of every mesh. Meshes
+    that DEFORM_NUMPY can't deform identically to an Armature modifier use an Armature modifier regardless. Defaults
+    to the scene's imscale_deform_mode."""
+    run_iter(apply_pose_to_rest_iter(preserve_volume, arm, deform_mode))
+
+
+def count_pose_bake_steps(meshes) -> int:
+    """The number of times apply_pose_to_rest_iter() yields for meshes, give or take a few"""
+    steps = 0
+    for mesh_obj in meshes:
+        shape_keys = mesh_obj.data.shape_keys
+        steps += 1 + (len(shape_keys.key_blocks) if shape_keys else 0)
+    return steps
+
+
+def apply_pose_to_rest_iter(preserve_volume=False, arm=None, deform_mode=None):
+    """Generator version of apply_pose_to_rest(), yielding the name of each mesh after it has been baked and in between
+    its shape keys"""
     if not arm:
         arm = get_armature()
+    if deform_mode is None:
+        deform_mode = getattr(bpy.context.scene, "imscale_deform_mode", DEFORM_MODIFIER)
     meshes = get_body_meshes(arm)
+    if deform_mode == DEFORM_NUMPY:
+        # Pose bone matrices are only updated when the armature is evaluated, which won't have happened yet if the
+        # pose was only just set
+        view_layer_update()
     for mesh_obj in meshes:
-        me = cast(bpy.types.Mesh, mesh_obj.data)
-        if me:
-            if me.shape_keys and me.shape_keys.key_blocks:
-                # The mesh has shape keys
-                shape_keys = me.shape_keys
-                key_blocks = shape_keys.key_blocks
-                if len(key_blocks) == 1:
-                    # The mesh only has a basis shape key, so we can remove it and then add it back afterwards
-                    # Get basis shape key
-                    basis_shape_key = key_blocks[0]
-                    # Save the name of the basis shape key
-                    original_basis_name = basis_shape_key.name
-                    # Remove the basis shape key so there are now no shape keys
-                    mesh_obj.shape_key_remove(basis_shape_key)
-                    # Apply the pose to the mesh
-                    _apply_armature_to_mesh_with_no_shape_keys(
-                        arm, mesh_obj, preserve_volume
-                    )
-                    # Add the basis shape key back with the same name as before
-                    mesh_obj.shape_key_add(name=original_basis_name)
+        mesh_name = mesh_obj.name
+        with span("pose bake", mesh=mesh_name):
+            me = cast(bpy.types.Mesh, mesh_obj.data)
+            if me:
+                if deform_mode == DEFORM_NUMPY and can_deform_with_numpy(
+                    arm, mesh_obj, preserve_volume
+                ):
+                    for _ in _apply_armature_to_mesh_with_numpy_iter(arm, mesh_obj):
+                        yield mesh_name
+                elif me.shape_keys and me.shape_keys.key_blocks:
+                    # The mesh has shape keys
+                    shape_keys = me.shape_keys
+                    key_blocks = shape_keys.key_blocks
+                    if len(key_blocks) == 1:
+                        # The mesh only has a basis shape key, so we can remove it and then add it back afterwards
+                        # Get basis shape key
+                        basis_shape_key = key_blocks[0]
+                        # Save the name of the basis shape key
+                        original_basis_name = basis_shape_key.name
+                        # Remove the basis shape key so there are now no shape keys
+                        mesh_obj.shape_key_remove(basis_shape_key)
+                        # Apply the pose to the mesh
+                        _apply_armature_to_mesh_with_no_shape_keys(
+                            arm, mesh_obj, preserve_volume
+                        )
+                        # Add the basis shape key back with the same name as before
+                        mesh_obj.shape_key_add(name=original_basis_name)
+                    else:
+                        # Apply the pose to the mesh, taking into account the shape keys
+                        for _ in _apply_armature_to_mesh_with_shape_keys_iter(
+                            arm, mesh_obj, preserve_volume
+                        ):
+                            yield mesh_name
                 else:
-                    # Apply the pose to the mesh, taking into account the shape keys
-                    _apply_armature_to_mesh_with_shape_keys(
+                    # The mesh doesn't have shape keys, so we can easily apply the pose to the mesh
+                    _apply_armature_to_mesh_with_no_shape_keys(
                         arm, mesh_obj, preserve_volume
                     )
-            else:
-                # The mesh doesn't have shape keys, so we can easily apply the pose to the mesh
-                _apply_armature_to_mesh_with_no_shape_keys(
-                    arm, mesh_obj, preserve_volume
-                )
+        yield mesh_name
     # Once the mesh and shape keys (if any) have been applied, the last step is to apply the current pose of the
     # bones as the new rest pose.
     #
-    # From the poll function, armature_obj must already be in pose mode, but it's possible it might not be the
-    # active object e.g., the user has multiple armatures opened in pose mode, but a different armature is currently
-    # active. We can use an operator override to tell the operator to treat armature_obj as if it's the active
-    # object even if it's not, skipping the need to actually set armature_obj as the active object.
-    op_override(bpy.ops.pose.armature_apply, {"active_object": arm})
+    # The poll function of the operator requires armature_obj to be in pose mode, which is the only reason for entering
+    # pose mode at all, so it's only done here, right before it's needed. It's possible that armature_obj might still
+    # not be the active object e.g., the user has multiple armatures opened in pose mode, but a different armature is
+    # currently active. We can use an operator override to tell the operator to treat armature_obj as if it's the
+    # active object even if it's not.
+    with span("armature_apply"):
+        enter_pose_mode(arm)
+        op_override(bpy.ops.pose.armature_apply, {"active_object": arm})
+
+
+class DeferredPoseBake:
+    """Applies the pose of arm as its rest pose any number of times, baking the combined deformation into the meshes
+    only once, in bake().
+
+    Each apply_pose_to_rest() only applies the pose to the armature, while the deformation of each bone, the change from
+    its rest pose to its pose, is accumulated. bake() then deforms the meshes by the accumulated deformation of every
+    bone with the NumPy pose bake method. Until bake() is called, the meshes keep their original shape.
+
+    Vertices weighted to a single bone end up exactly where baking after every apply would put them. Vertices blended
+    between bones are blended once instead of once per apply, which isn't the same: for a vertex v weighted w1 and w2
+    to two bones that are deformed by M1 and M2 in one apply and by N1 and N2 in a later one, the result is off by
+    w1 * w2 * (N1 - N2) @ (M1 - M2) @ v. The error is only small when the two bones deform alike in at least one of the
+    applies. Aligning to a reference with different proportions scales neighbouring bones very differently in several
+    applies, which can move blended vertices around joints visibly.
+
+    When deferring isn't possible, because a mesh can't be deformed with the NumPy pose bake method, or when created
+    with deferred=False, apply_pose_to_rest() bakes every mesh immediately and bake() does nothing."""
+
+    __slots__ = ("arm", "deferred", "bone_deforms", "applies")
+
+    def __init__(self, arm, deferred=True):
+        self.arm = arm
+        self.deferred = deferred and all(
+            can_deform_with_numpy(arm, mesh_obj) for mesh_obj in get_body_meshes(arm)
+        )
+        # Bone name -> the accumulated armature space deformation of the bone
+        self.bone_deforms = {}
+        self.applies = 0
+
+    def apply_pose_to_rest(self):
+        self.applies += 1
+        if not self.deferred:
+            apply_pose_to_rest(arm=self.arm)
+            return
+        arm = self.arm
+        # Pose bone matrices are only updated when the armature is evaluated
+        view_layer_update()
+        bone_deforms = self.bone_deforms
+        for pose_bone in arm.pose.bones:
+            step = pose_bone.matrix @ pose_bone.bone.matrix_local.inverted()
+            previous = bone_deforms.get(pose_bone.name)
+            bone_deforms[pose_bone.name] = (
+                step if previous is None else step @ previous
+            )
+        # Only the armature is changed, the meshes are deformed by bake()
+        with span("armature_apply"):
+            enter_pose_mode(arm)
+            op_override(bpy.ops.pose.armature_apply, {"active_object": arm})
+
+    @traced("deferred pose bake")
+    def bake(self):
+        """Deform the meshes by everything applied since the last bake()"""
+        if not self.deferred or not self.bone_deforms:
+            return
+        arm = self.arm
+        for mesh_obj in get_body_meshes(arm):
+            if mesh_obj.data:
+                with span("pose bake", mesh=mesh_obj.name, applies=self.applies):
+                    run_iter(
+                        _apply_armature_to_mesh_with_numpy_iter(
+                            arm, mesh_obj, self.bone_deforms
+                        )
+                    )
+        self.bone_deforms = {}
+        self.applies = 0
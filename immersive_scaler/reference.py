@@ -0,0 +1,401 @@
+import bpy
+import importlib
+import json
+import mathutils
+import numpy as np
+import os
+
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from . import bones
+from . import common
+from . import instrument
+
+importlib.reload(bones)
+importlib.reload(common)
+importlib.reload(instrument)
+
+from .bones import bone_lookup, bone_names, check_bone, get_bone
+from .common import temp_ensure_enabled
+from .instrument import log, view_layer_update
+
+
+# Identifies reference template files and the version of their layout, see ReferenceSkeleton.to_template()
+TEMPLATE_FORMAT = "immersive_scaler_reference"
+TEMPLATE_VERSION = 2
+
+
+def _read_hierarchy(
+    arm: bpy.types.Object,
+) -> Tuple[List[str], List[int], Dict[str, int]]:
+    """The bone names, parent indices and humanoid bone indices of arm, in the order of arm.pose.bones"""
+    pose_bones = arm.pose.bones
+    names = [pb.name for pb in pose_bones]
+    index = {bone: i for i, bone in enumerate(names)}
+    parents = [index[pb.parent.name] if pb.parent else -1 for pb in pose_bones]
+    keys = {
+        key: index[get_bone(key, arm).name]
+        for key in bone_names
+        if check_bone(key, arm)
+    }
+    return names, parents, keys
+
+
+class ReferenceBone:
+    """The parts of a PoseBone of the reference armature that align.align_bones() reads, taken from a
+    ReferenceSkeleton"""
+
+    __slots__ = ("skeleton", "index")
+
+    def __init__(self, skeleton: "ReferenceSkeleton", index: int):
+        self.skeleton = skeleton
+        self.index = index
+
+    @property
+    def name(self) -> str:
+        return self.skeleton.names[self.index]
+
+    @property
+    def head(self) -> mathutils.Vector:
+        return mathutils.Vector(self.skeleton.heads[self.index])
+
+    @property
+    def children(self) -> List["ReferenceBone"]:
+        skeleton = self.skeleton
+        return [ReferenceBone(skeleton, i) for i in skeleton.children[self.index]]
+
+
+class ReferenceSkeleton:
+    """Everything aligning an armature to a reference armature needs from the reference: the hierarchy of its bones,
+    where their heads are in its current pose and which humanoid bone each one is.
+
+    Reading the reference once into a ReferenceSkeleton means any number of armatures can be aligned to it without
+    reading the reference armature again, or even having it in the scene. Bones are indexed in the order of
+    arm.pose.bones and heads are in armature space, like PoseBone.head."""
+
+    __slots__ = (
+        "name",
+        "names",
+        "index",
+        "parents",
+        "children",
+        "heads",
+        "lengths",
+        "keys",
+    )
+
+    def __init__(
+        self,
+        name: str,
+        names: List[str],
+        parents: List[int],
+        heads: np.ndarray,
+        lengths: np.ndarray,
+        keys: Dict[str, int],
+    ):
+        self.name = name
+        self.names = names
+        self.index: Dict[str, int] = {bone: i for i, bone in enumerate(names)}
+        # -1 for root bones
+        self.parents = parents
+        self.children: List[List[int]] = [[] for _ in names]
+        for i, parent in enumerate(parents):
+            if parent >= 0:
+                self.children[parent].append(i)
+        self.heads = heads
+        self.lengths = lengths
+        # humanoid bone name (a key of bones.bone_names) -> bone index, for the humanoid bones the reference has
+        self.keys = keys
+
+    @classmethod
+    def from_armature(cls, arm: bpy.types.Object) -> "ReferenceSkeleton":
+        """Read arm, which must be enabled in the scene for its pose to be evaluated"""
+        # Pose bone heads are only updated when the armature is evaluated
+        view_layer_update()
+        pose_bones = arm.pose.bones
+        names, parents, keys = _read_hierarchy(arm)
+        heads = np.array([pb.head for pb in pose_bones], dtype=np.double).reshape(-1, 3)
+        lengths = np.array([pb.length for pb in pose_bones], dtype=np.double)
+        return cls(arm.name, names, parents, heads, lengths, keys)
+
+    def to_template(self) -> Dict[str, Any]:
+        """The bones of the reference as a JSON serializable dict.
+
+        Every bone is kept with its own parent, rather than only the humanoid bones, so that aligning to the template
+        matches and recurses into the same children as aligning to the reference armature it was exported from, e.g.
+        when there are twist bones between humanoid bones. Humanoid bones also get their humanoid bone name."""
+        key_of = {i: key for key, i in self.keys.items()}
+        template_bones = []
+        for i, name in enumerate(self.names):
+            parent = self.parents[i]
+            template_bones.append(
+                {
+                    "name": name,
+                    "parent": self.names[parent] if parent >= 0 else None,
+                    "key": key_of.get(i),
+                    "head": [round(float(v), 6) for v in self.heads[i]],
+                    "length": round(float(self.lengths[i]), 6),
+                }
+            )
+        return {
+            "format": TEMPLATE_FORMAT,
+            "version": TEMPLATE_VERSION,
+            "name": self.name,
+            "bones": template_bones,
+        }
+
+    @classmethod
+    def from_template(cls, template: Dict[str, Any]) -> "ReferenceSkeleton":
+        """Create a ReferenceSkeleton from the dict made by to_template()"""
+        if template.get("format") != TEMPLATE_FORMAT:
+            raise ValueError("Not an Immersive Scaler reference template")
+        if template.get("version") != TEMPLATE_VERSION:
+            raise ValueError(
+                "Unsupported reference template version {}, export the reference"
+                " again".format(template.get("version"))
+            )
+        template_bones = template["bones"]
+        keys = {
+            bone["key"]: i
+            for i, bone in enumerate(template_bones)
+            if bone.get("key") is not None
+        }
+        unknown = [key for key in keys if key not in bone_names]
+        if unknown:
+            raise ValueError("Unknown humanoid bones {}".format(", ".join(unknown)))
+        names = [bone["name"] for bone in template_bones]
+        index = {name: i for i, name in enumerate(names)}
+        parents = [
+            -1 if bone["parent"] is None else index[bone["parent"]]
+            for bone in template_bones
+        ]
+        heads = np.array(
+            [bone["head"] for bone in template_bones], dtype=np.double
+        ).reshape(-1, 3)
+        lengths = np.array([bone["length"] for bone in template_bones], dtype=np.double)
+        return cls(template["name"], names, parents, heads, lengths, keys)
+
+    def __len__(self):
+        return len(self.names)
+
+    def has(self, key: str) -> bool:
+        """Whether the reference has the humanoid bone key, like bones.check_bone()"""
+        return key in self.keys
+
+    def bone_index(self, key: str) -> int:
+        """The index of the humanoid bone key, raising KeyError when the reference doesn't have it"""
+        i = self.keys.get(key)
+        if i is None:
+            raise KeyError("The reference '{}' has no {} bone".format(self.name, key))
+        return i
+
+    def bone(self, key: str) -> ReferenceBone:
+        """The humanoid bone key, like bones.get_bone()"""
+        return ReferenceBone(self, self.bone_index(key))
+
+    def head(self, key: str) -> mathutils.Vector:
+        """The head of the humanoid bone key in the reference's armature space"""
+        return mathutils.Vector(self.heads[self.bone_index(key)])
+
+
+class BoneCorrespondence:
+    """Which bone of a ReferenceSkeleton each bone of an armature being aligned to it corresponds to.
+
+    The humanoid bone name of every bone of both armatures is looked up once, up front, so that matching the children
+    of a bone to the children of the reference bone it's aligned to only compares names, the same as comparing every
+    child of the bone with every child of the reference bone by name and by humanoid bone name."""
+
+    __slots__ = (
+        "ref_names",
+        "ref_parents",
+        "ref_children",
+        "ref_keys",
+        "ref_key_of",
+        "keys",
+        "to_ref",
+    )
+
+    def __init__(
+        self,
+        names: List[str],
+        ref_names: List[str],
+        ref_parents: List[int],
+        ref_keys: Dict[str, int],
+    ):
+        """names are the names of the bones of the armature being aligned, ref_names, ref_parents and ref_keys are the
+        same as the names, parents and keys of a ReferenceSkeleton"""
+        self.ref_names = ref_names
+        self.ref_parents = ref_parents
+        self.ref_children: List[List[int]] = [[] for _ in ref_names]
+        for i, parent in enumerate(ref_parents):
+            if parent >= 0:
+                self.ref_children[parent].append(i)
+        self.ref_keys = ref_keys
+        # Reference bone index -> humanoid bone name, or None when it isn't one
+        self.ref_key_of: List[Optional[str]] = [bone_lookup(n) for n in ref_names]
+        for key, i in ref_keys.items():
+            self.ref_key_of[i] = key
+        ref_index = {bone: i for i, bone in enumerate(ref_names)}
+        # bone name -> humanoid bone name, or None when it isn't one
+        self.keys: Dict[str, Optional[str]] = {}
+        # bone name -> index of the matching reference bone anywhere in the reference, by name first, only for bones
+        # that have one. Only used to report unmatched bones, aligning matches children with matching_children().
+        self.to_ref: Dict[str, int] = {}
+        for name in names:
+            key = bone_lookup(name)
+            self.keys[name] = key
+            ref_i = ref_index.get(name)
+            if ref_i is None and key is not None:
+                ref_i = ref_keys.get(key)
+            if ref_i is not None:
+                self.to_ref[name] = ref_i
+
+    @classmethod
+    def between(cls, ref: ReferenceSkeleton, names: List[str]) -> "BoneCorrespondence":
+        return cls(names, ref.names, ref.parents, ref.keys)
+
+    def match(self, name: str) -> Optional[int]:
+        """The index of the reference bone matching the bone called name, or None if there isn't one"""
+        return self.to_ref.get(name)
+
+    def matching_children(
+        self, child_names: Iterable[str], ref_i: int
+    ) -> List[Tuple[str, int]]:
+        """(name, reference bone index) of every pair of one of child_names and a child of the reference bone at ref_i
+        that have the same name or the same humanoid bone name, in the same order as comparing each of child_names with
+        each child of the reference bone in turn"""
+        ref_names = self.ref_names
+        ref_key_of = self.ref_key_of
+        r_children = self.ref_children[ref_i]
+        pairs = []
+        for name in child_names:
+            key = self.keys.get(name)
+            for r_child in r_children:
+                if ref_names[r_child] == name or (
+                    key is not None and ref_key_of[r_child] == key
+                ):
+                    pairs.append((name, r_child))
+        return pairs
+
+    def unmatched(self) -> Tuple[List[str], List[str]]:
+        """The humanoid bones that can't be aligned: those of the armature with no matching reference bone, and those
+        of the reference that no bone of the armature matches"""
+        unmatched = [
+            name
+            for name, key in self.keys.items()
+            if key is not None and name not in self.to_ref
+        ]
+        matched_ref = set(self.to_ref.values())
+        ref_unmatched = [
+            self.ref_names[i] for i in self.ref_keys.values() if i not in matched_ref
+        ]
+        return unmatched, ref_unmatched
+
+
+# Scene -> (fingerprint, BoneCorrespondence or None), see get_scene_correspondence()
+_SCENE_CORRESPONDENCE: Dict[int, Tuple[tuple, Optional[BoneCorrespondence]]] = {}
+
+
+def get_scene_correspondence(scene: bpy.types.Scene) -> Optional[BoneCorrespondence]:
+    """The BoneCorrespondence between the Scaling Armature of scene and the reference it would be aligned to, or None
+    when there's nothing to align. Only bone names are read, nothing is evaluated, so the UI can show the unmatched
+    bones before aligning. Cached until the armatures, the reference template or the bone overrides change."""
+    objects = scene.objects
+    scale_arm = objects.get(scene.imscale_scale_armature_arm)
+    if scale_arm is None or scale_arm.type != "ARMATURE":
+        return None
+    template_path = scene.imscale_reference_template
+    ref_arm = None
+    if template_path:
+        path = os.path.abspath(bpy.path.abspath(template_path))
+        try:
+            ref_fingerprint = (path, os.stat(path).st_mtime)
+        except OSError:
+            return None
+    else:
+        ref_arm = objects.get(scene.imscale_scale_armature_ref)
+        if ref_arm is None or ref_arm.type != "ARMATURE" or ref_arm == scale_arm:
+            return None
+        ref_fingerprint = (ref_arm.as_pointer(), len(ref_arm.pose.bones))
+    fingerprint = (scale_arm.as_pointer(), len(scale_arm.pose.bones), ref_fingerprint)
+    key = scene.as_pointer()
+    cached = _SCENE_CORRESPONDENCE.get(key)
+    if cached is not None and cached[0] == fingerprint:
+        return cached[1]
+
+    names = [pb.name for pb in scale_arm.pose.bones]
+    correspondence = None
+    if ref_arm is not None:
+        correspondence = BoneCorrespondence(names, *_read_hierarchy(ref_arm))
+    else:
+        try:
+            correspondence = BoneCorrespondence.between(load_template(path), names)
+        except (KeyError, OSError, ValueError) as e:
+            # Shown as no correspondence, the error is reported when aligning
+            log("Couldn't load reference template {}: {}", path, e)
+    _SCENE_CORRESPONDENCE[key] = (fingerprint, correspondence)
+    return correspondence
+
+
+def invalidate_scene_correspondence():
+    """Forget the cached correspondences. Called whenever an override_* scene property changes, since that changes
+    which humanoid bone each bone is."""
+    _SCENE_CORRESPONDENCE.clear()
+
+
+@bpy.app.handlers.persistent
+def _correspondence_depsgraph_handler(scene, depsgraph=None):
+    # depsgraph only gets passed to handlers in Blender 2.91+. Bones being renamed updates the armature data.
+    if depsgraph is None or depsgraph.id_type_updated("ARMATURE"):
+        _SCENE_CORRESPONDENCE.clear()
+
+
+@bpy.app.handlers.persistent
+def _correspondence_reset_handler(*args):
+    # Loading a file or undoing/redoing frees every scene and armature, so their pointers could be reused
+    _SCENE_CORRESPONDENCE.clear()
+
+
+CORRESPONDENCE_HANDLERS = (
+    ("depsgraph_update_post", _correspondence_depsgraph_handler),
+    ("load_post", _correspondence_reset_handler),
+    ("undo_post", _correspondence_reset_handler),
+    ("redo_post", _correspondence_reset_handler),
+)
+
+
+def save_template(ref: ReferenceSkeleton, path: str):
+    """Save the humanoid bones of ref as a reference template JSON file at path"""
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(ref.to_template(), f, indent=1)
+    log("Saved reference template of {} to {}", ref.name, path)
+
+
+# Absolute path -> (modification time, size, ReferenceSkeleton), so aligning many armatures to the same template in
+# one session only reads the file once
+_TEMPLATE_CACHE: Dict[str, Tuple[float, int, ReferenceSkeleton]] = {}
+
+
+def load_template(path: str) -> ReferenceSkeleton:
+    """Load the reference template JSON file at path, which may be relative to the .blend file"""
+    path = os.path.abspath(bpy.path.abspath(path))
+    stat = os.stat(path)
+    cached = _TEMPLATE_CACHE.get(path)
+    if cached is not None and cached[:2] == (stat.st_mtime, stat.st_size):
+        return cached[2]
+    with open(path, "r", encoding="utf-8") as f:
+        ref = ReferenceSkeleton.from_template(json.load(f))
+    _TEMPLATE_CACHE[path] = (stat.st_mtime, stat.st_size, ref)
+    return ref
+
+
+def read_reference(
+    ref_arm: Optional[bpy.types.Object], template_path=""
+) -> ReferenceSkeleton:
+    """The ReferenceSkeleton to align to, the template at template_path when one is given, otherwise ref_arm"""
+    if template_path:
+        return load_template(template_path)
+    if ref_arm is None:
+        raise KeyError("Reference armature not found")
+    with temp_ensure_enabled(ref_arm):
+        return ReferenceSkeleton.from_armature(ref_arm)
@@ -0,0 +1,203 @@
+import bpy
+import importlib
+import numpy as np
+
+from typing import Dict, Iterable, List, Optional
+
+from . import instrument
+
+importlib.reload(instrument)
+
+from .instrument import foreach_get, foreach_set
+
+
+# Bone.inherit_scale modes that Skeleton can reproduce
+_INHERIT_FULL = 0
+_INHERIT_NONE = 1
+_INHERIT_SCALE_MODES = {"FULL": _INHERIT_FULL, "NONE": _INHERIT_NONE}
+
+
+def quaternions_to_matrices(quats: np.ndarray) -> np.ndarray:
+    """Convert (n, 4) WXYZ quaternions to (n, 3, 3) rotation matrices, normalizing them first like Blender does for
+    pose bones"""
+    quats = quats / np.linalg.norm(quats, axis=1, keepdims=True)
+    w, x, y, z = quats.T
+    matrices = np.empty((len(quats), 3, 3))
+    matrices[:, 0, 0] = 1 - 2 * (y * y + z * z)
+    matrices[:, 0, 1] = 2 * (x * y - w * z)
+    matrices[:, 0, 2] = 2 * (x * z + w * y)
+    matrices[:, 1, 0] = 2 * (x * y + w * z)
+    matrices[:, 1, 1] = 1 - 2 * (x * x + z * z)
+    matrices[:, 1, 2] = 2 * (y * z - w * x)
+    matrices[:, 2, 0] = 2 * (x * z - w * y)
+    matrices[:, 2, 1] = 2 * (y * z + w * x)
+    matrices[:, 2, 2] = 1 - 2 * (x * x + y * y)
+    return matrices
+
+
+def _orthogonalize(matrices: np.ndarray) -> np.ndarray:
+    """Remove the scale and shear from the 3x3 part of (n, 4, 4) matrices, keeping the direction of the Y axis, which
+    is the direction bones point in. Same as Blender's orthogonalize_m4_stable(mat, 1, true)."""
+    result = matrices.copy()
+    x = matrices[:, :3, 0]
+    y = matrices[:, :3, 1]
+    y = y / np.linalg.norm(y, axis=1, keepdims=True)
+    x = x - np.einsum("ni,ni->n", x, y)[:, None] * y
+    x = x / np.linalg.norm(x, axis=1, keepdims=True)
+    z = np.cross(x, y)
+    result[:, :3, 0] = x
+    result[:, :3, 1] = y
+    result[:, :3, 2] = z
+    return result
+
+
+class Skeleton:
+    """The bones of an armature as arrays indexed in the order of arm.pose.bones, with a NumPy forward kinematics solver
+    that computes the pose matrices Blender would, without updating the depsgraph.
+
+    The rest pose is stored as the parent index of each bone and the offset of each bone from its parent in the rest
+    pose. The pose is stored as location, rotation_quaternion and scale arrays that can be changed freely and then
+    written back to the armature in one go with write_pose(). Only bones that inherit rotation, inherit scale FULL or
+    NONE, use quaternion rotation and have no constraints are solved the same as Blender, see unsupported_reason()."""
+
+    __slots__ = (
+        "names",
+        "index",
+        "parents",
+        "children",
+        "depths",
+        "rest",
+        "offsets",
+        "inherit_scale",
+        "unsupported",
+        "location",
+        "rotation",
+        "scale",
+    )
+
+    def __init__(self, arm: bpy.types.Object):
+        pose_bones = arm.pose.bones
+        num_bones = len(pose_bones)
+        self.names: List[str] = [pb.name for pb in pose_bones]
+        self.index: Dict[str, int] = {name: i for i, name in enumerate(self.names)}
+        self.parents = np.full(num_bones, -1, dtype=np.intp)
+        self.children: List[List[int]] = [[] for _ in range(num_bones)]
+        self.inherit_scale = np.zeros(num_bones, dtype=np.intp)
+        # Bone index -> why Blender would pose the bone differently to solve()
+        self.unsupported: Dict[int, str] = {}
+        self.rest = np.empty((num_bones, 4, 4))
+        for i, pb in enumerate(pose_bones):
+            bone = pb.bone
+            self.rest[i] = bone.matrix_local
+            if pb.parent is not None:
+                self.parents[i] = self.index[pb.parent.name]
+            inherit_scale = _INHERIT_SCALE_MODES.get(bone.inherit_scale)
+            if inherit_scale is None:
+                self.unsupported[i] = "inherit scale " + bone.inherit_scale
+            else:
+                self.inherit_scale[i] = inherit_scale
+            if not bone.use_inherit_rotation:
+                self.unsupported[i] = "doesn't inherit rotation"
+            elif not bone.use_local_location:
+                self.unsupported[i] = "doesn't use local location"
+            elif pb.rotation_mode != "QUATERNION":
+                self.unsupported[i] = "rotation mode " + pb.rotation_mode
+            elif len(pb.constraints) > 0:
+                self.unsupported[i] = "has constraints"
+        # Children in the same order as Bone.children
+        for i, parent in enumerate(self.parents):
+            if parent >= 0:
+                self.children[parent].append(i)
+        self.depths = np.zeros(num_bones, dtype=np.intp)
+        for i in range(num_bones):
+            depth = 0
+            parent = self.parents[i]
+            while parent >= 0:
+                depth += 1
+                parent = self.parents[parent]
+            self.depths[i] = depth
+
+        # The offset of each bone from its parent in the rest pose, the rest matrix of root bones
+        self.offsets = self.rest.copy()
+        has_parent = self.parents >= 0
+        self.offsets[has_parent] = (
+            np.linalg.inv(self.rest[self.parents[has_parent]]) @ self.rest[has_parent]
+        )
+
+        self.location = np.empty((num_bones, 3), dtype=np.single)
+        self.rotation = np.empty((num_bones, 4), dtype=np.single)
+        self.scale = np.empty((num_bones, 3), dtype=np.single)
+        foreach_get(pose_bones, "location", self.location.ravel())
+        foreach_get(pose_bones, "rotation_quaternion", self.rotation.ravel())
+        foreach_get(pose_bones, "scale", self.scale.ravel())
+
+    def __len__(self):
+        return len(self.names)
+
+    def subtree(self, i: int) -> List[int]:
+        """i and every bone descended from it"""
+        indices = [i]
+        for bone in indices:
+            indices.extend(self.children[bone])
+        return indices
+
+    def unsupported_reason(self, indices: Iterable[int]) -> Optional[str]:
+        """Why solve() wouldn't give the same pose matrices as Blender for the bones at indices, or None if it would"""
+        for i in indices:
+            reason = self.unsupported.get(i)
+            if reason is not None:
+                return "{} {}".format(self.names[i], reason)
+        return None
+
+    def basis_matrices(self, indices) -> np.ndarray:
+        """The pose matrices of the bones at indices relative to their rest pose, like PoseBone.matrix_basis"""
+        basis = np.zeros((len(indices), 4, 4))
+        basis[:, :3, :3] = (
+            quaternions_to_matrices(self.rotation[indices].astype(np.double))
+            * self.scale[indices, None, :]
+        )
+        basis[:, :3, 3] = self.location[indices]
+        basis[:, 3, 3] = 1
+        return basis
+
+    def solve(self, matrices: np.ndarray, indices=None):
+        """Compute the armature space pose matrices of the bones at indices, or of every bone, into matrices, which must
+        already hold the pose matrices of the parents of those bones that aren't in indices themselves.
+
+        Bones are solved a whole level of the hierarchy at a time, so the number of NumPy calls depends on the depth of
+        the bones rather than the number of bones."""
+        if indices is None:
+            indices = np.arange(len(self))
+        else:
+            indices = np.asarray(indices, dtype=np.intp)
+        depths = self.depths[indices]
+        for depth in np.unique(depths):
+            level = indices[depths == depth]
+            parents = self.parents[level]
+            offsets = self.offsets[level]
+            # Root bones are posed relative to the armature
+            parent_matrices = np.broadcast_to(np.identity(4), offsets.shape).copy()
+            has_parent = parents >= 0
+            parent_matrices[has_parent] = matrices[parents[has_parent]]
+            rest_matrices = parent_matrices @ offsets
+            no_scale = self.inherit_scale[level] == _INHERIT_NONE
+            if np.any(no_scale):
+                # The bone doesn't inherit the scale of its parent, but its head still follows where the scaled parent
+                # puts it
+                heads = rest_matrices[no_scale, :3, 3]
+                rest_matrices[no_scale] = (
+                    _orthogonalize(parent_matrices[no_scale]) @ offsets[no_scale]
+                )
+                rest_matrices[no_scale, :3, 3] = heads
+            matrices[level] = rest_matrices @ self.basis_matrices(level)
+
+    def read_pose_matrices(self, arm: bpy.types.Object) -> np.ndarray:
+        """The pose matrices of arm as last evaluated by Blender"""
+        return np.array([pb.matrix for pb in arm.pose.bones], dtype=np.double)
+
+    def write_pose(self, arm: bpy.types.Object):
+        """Set the pose of arm to the location, rotation and scale of every bone, without updating the depsgraph"""
+        pose_bones = arm.pose.bones
+        foreach_set(pose_bones, "location", self.location.ravel())
+        foreach_set(pose_bones, "rotation_quaternion", self.rotation.ravel())
+        foreach_set(pose_bones, "scale", self.scale.ravel())
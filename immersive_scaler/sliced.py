@@ -0,0 +1,124 @@
+import bpy
+import importlib
+import time
+
+from contextlib import ExitStack
+
+from . import common
+from . import instrument
+from . import snapshot
+
+importlib.reload(common)
+importlib.reload(instrument)
+importlib.reload(snapshot)
+
+from .common import ArmatureOperator, run_iter
+from .instrument import log
+
+
+class SlicedArmatureOperator(ArmatureOperator):
+    """ArmatureOperator that can also be run as a modal operator, doing its work in slices of at most about
+    _SLICE_SECONDS between redraws, so that Blender stays responsive, shows progress and can be cancelled with Esc.
+
+    Subclasses implement execute_main_iter() as a generator that yields whenever the work can be paused and call
+    invoke_sliced() from invoke() to run it time-sliced. Cancelling, or an error part way through, restores a snapshot
+    of the avatar taken before starting, so the avatar is never left half rescaled. Operator calls such as
+    object.transform_apply can't be split up, so a single slice can still take longer than _SLICE_SECONDS."""
+
+    # Maximum time spent working before returning to Blender so that it can redraw and handle events
+    _SLICE_SECONDS = 0.1
+    # Seconds between timer events, as short as possible, the work is already limited by _SLICE_SECONDS
+    _TIMER_SECONDS = 0.01
+
+    def execute_main_iter(self, context, arm, meshes):
+        # To be overridden in subclasses, yields whenever the work can be paused and returns the operator result
+        return {"FINISHED"}
+        yield
+
+    def estimate_steps(self, context, arm, meshes) -> int:
+        """Roughly the number of times execute_main_iter() will yield, used for the progress shown"""
+        return 1
+
+    def execute_main(self, context, arm, meshes):
+        return run_iter(self.execute_main_iter(context, arm, meshes))
+
+    def invoke_sliced(self, context: bpy.types.Context):
+        arm, meshes = self.prepare()
+        if self.remember_snapshot:
+            # Kept for Revert Snapshot as well as for rolling back
+            self._snapshot = snapshot.remember(arm, context)
+        else:
+            self._snapshot = snapshot.capture(arm, context)
+        self._exit_stack = ExitStack()
+        self._counts = self._exit_stack.enter_context(
+            self.run_context(context, arm, meshes)
+        )
+        self._iter = self.execute_main_iter(context, arm, meshes)
+        self._steps_done = 0
+        self._steps_total = max(self.estimate_steps(context, arm, meshes), 1)
+        self._last_step = ""
+
+        wm = context.window_manager
+        self._timer = wm.event_timer_add(self._TIMER_SECONDS, window=context.window)
+        wm.progress_begin(0, 100)
+        wm.modal_handler_add(self)
+        self._update_status(context)
+        return {"RUNNING_MODAL"}
+
+    def _update_status(self, context):
+        percent = min(100 * self._steps_done // self._steps_total, 99)
+        context.window_manager.progress_update(percent)
+        if context.workspace is not None:
+            step = ": {}".format(self._last_step) if self._last_step else ""
+            context.workspace.status_text_set(
+                "{} {}%{} (Esc to cancel)".format(self.bl_label, percent, step)
+            )
+
+    def _finish(self, context):
+        wm = context.window_manager
+        wm.event_timer_remove(self._timer)
+        wm.progress_end()
+        if context.workspace is not None:
+            context.workspace.status_text_set(None)
+        self._iter = None
+        self._snapshot = None
+
+    def _roll_back(self, context):
+        """Stop the work part way and restore the avatar to how it was before it started"""
+        self._iter.close()
+        # Restored before leaving run_context, while the objects that were temporarily enabled are still enabled, so
+        # that they can be made active to restore them
+        try:
+            self._snapshot.restore(context)
+        finally:
+            self._exit_stack.close()
+            self._finish(context)
+
+    def modal(self, context: bpy.types.Context, event: bpy.types.Event):
+        if event.type == "ESC":
+            self._roll_back(context)
+            log("{}: cancelled", self.bl_idname)
+            self.report({"WARNING"}, "Cancelled, the avatar has been restored")
+            return {"CANCELLED"}
+        if event.type != "TIMER" or event.timer != self._timer:
+            # Swallow every other event, the avatar must not be edited while the work is only part way done
+            return {"RUNNING_MODAL"}
+
+        deadline = time.perf_counter() + self._SLICE_SECONDS
+        try:
+            while time.perf_counter() < deadline:
+                self._last_step = next(self._iter)
+                self._steps_done += 1
+        except StopIteration as e:
+            result = e.value
+            self._exit_stack.close()
+            self._finish(context)
+            self.report_counts(self._counts)
+            return result
+        except Exception as e:
+            self._roll_back(context)
+            log("{}: failed with {!r}", self.bl_idname, e)
+            self.report({"ERROR"}, "{}: {}".format(type(e).__name__, e))
+            return {"CANCELLED"}
+        self._update_status(context)
+        return {"RUNNING_MODAL"}
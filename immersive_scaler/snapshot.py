@@ -0,0 +1,575 @@
+import bpy
+import hashlib
+import importlib
+import mathutils
+import numpy as np
+import time
+
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+from . import common
+from . import instrument
+
+importlib.reload(common)
+importlib.reload(instrument)
+
+from .common import (
+    add_app_handlers,
+    children_recursive,
+    get_armature,
+    op_override,
+    remove_app_handlers,
+    temp_ensure_enabled,
+)
+from .instrument import foreach_get, foreach_set, log, span
+
+
+# PoseBone properties that make up the current pose, with the number of floats in each
+_POSE_PROPERTIES = (
+    ("location", 3),
+    ("scale", 3),
+    ("rotation_quaternion", 4),
+    ("rotation_euler", 3),
+    ("rotation_axis_angle", 4),
+)
+
+
+class MeshSnapshot:
+    """Vertex positions of a Mesh and of each of its shape keys"""
+
+    __slots__ = ("mesh", "co", "shape_key_cos")
+
+    def __init__(self, mesh: bpy.types.Mesh):
+        self.mesh = mesh
+        vertices = mesh.vertices
+        self.co = np.empty(len(vertices) * 3, dtype=np.single)
+        foreach_get(vertices, "co", self.co)
+        self.shape_key_cos: Dict[str, np.ndarray] = {}
+        if mesh.shape_keys:
+            for key_block in mesh.shape_keys.key_blocks:
+                co = np.empty(len(key_block.data) * 3, dtype=np.single)
+                foreach_get(key_block.data, "co", co)
+                self.shape_key_cos[key_block.name] = co
+
+    @property
+    def nbytes(self) -> int:
+        return self.co.nbytes + sum(co.nbytes for co in self.shape_key_cos.values())
+
+    def restore(self):
+        mesh = self.mesh
+        vertices = mesh.vertices
+        if len(vertices) * 3 != len(self.co):
+            log("Not restoring {}, its number of vertices has changed", mesh.name)
+            return
+        foreach_set(vertices, "co", self.co)
+        if mesh.shape_keys:
+            for key_block in mesh.shape_keys.key_blocks:
+                co = self.shape_key_cos.get(key_block.name)
+                if co is not None and len(key_block.data) * 3 == len(co):
+                    foreach_set(key_block.data, "co", co)
+        mesh.update()
+
+
+class ArmatureSnapshot:
+    """Rest pose, current pose and bone settings of an armature Object"""
+
+    __slots__ = (
+        "bone_names",
+        "matrix_local",
+        "length",
+        "inherit_scale",
+        "pose",
+        "pose_position",
+    )
+
+    def __init__(self, arm: bpy.types.Object):
+        bones = arm.data.bones
+        self.bone_names = [b.name for b in bones]
+        # Bone.matrix_local is a 4x4 matrix property, which foreach_get doesn't support in all the Blender versions
+        # supported, so it is read one bone at a time
+        self.matrix_local = np.array([b.matrix_local for b in bones], dtype=np.single)
+        self.length = np.empty(len(bones), dtype=np.single)
+        foreach_get(bones, "length", self.length)
+        self.inherit_scale = [b.inherit_scale for b in bones]
+        pose_bones = arm.pose.bones
+        self.pose: Dict[str, np.ndarray] = {}
+        for prop, size in _POSE_PROPERTIES:
+            values = np.empty(len(pose_bones) * size, dtype=np.single)
+            foreach_get(pose_bones, prop, values)
+            self.pose[prop] = values
+        self.pose_position = arm.data.pose_position
+
+    @property
+    def nbytes(self) -> int:
+        return (
+            self.matrix_local.nbytes
+            + self.length.nbytes
+            + sum(values.nbytes for values in self.pose.values())
+        )
+
+    def rest_changed(self, arm: bpy.types.Object) -> bool:
+        bones = arm.data.bones
+        if [b.name for b in bones] != self.bone_names:
+            return True
+        matrix_local = np.array([b.matrix_local for b in bones], dtype=np.single)
+        length = np.empty(len(bones), dtype=np.single)
+        foreach_get(bones, "length", length)
+        return not (
+            np.allclose(matrix_local, self.matrix_local, atol=1e-6)
+            and np.allclose(length, self.length, atol=1e-6)
+        )
+
+    def restore(self, arm: bpy.types.Object):
+        if self.rest_changed(arm):
+            with span("restore rest pose"):
+                self._restore_rest_pose(arm)
+        bones = arm.data.bones
+        for name, inherit_scale in zip(self.bone_names, self.inherit_scale):
+            bone = bones.get(name)
+            if bone is not None:
+                bone.inherit_scale = inherit_scale
+        pose_bones = arm.pose.bones
+        if [pb.name for pb in pose_bones] == self.bone_names:
+            for prop, _size in _POSE_PROPERTIES:
+                foreach_set(pose_bones, prop, self.pose[prop])
+        arm.data.pose_position = self.pose_position
+
+    def _restore_rest_pose(self, arm: bpy.types.Object):
+        # The rest pose can only be set through EditBones
+        op_override(bpy.ops.object.mode_set, {"active_object": arm}, mode="EDIT")
+        try:
+            edit_bones = arm.data.edit_bones
+            for name, matrix, length in zip(
+                self.bone_names, self.matrix_local, self.length
+            ):
+                edit_bone = edit_bones.get(name)
+                if edit_bone is None:
+                    continue
+                # Setting EditBone.matrix keeps the current length of the bone, so the length has to be set first
+                edit_bone.length = float(length)
+                edit_bone.matrix = mathutils.Matrix(matrix.tolist())
+        finally:
+            op_override(
+                bpy.ops.object.mode_set, {"active_object": arm}, mode="OBJECT"
+            )
+
+
+def _id_keys(ids: Iterable[bpy.types.ID]) -> Set[Tuple[int, str, Optional[int]]]:
+    """What identifies each of ids: its pointer, its name and, in Blender 2.91+, its session_uid.
+
+    The pointer alone isn't enough, since once an ID has been deleted, a new ID can be created at the same address."""
+    return {(i.as_pointer(), i.name, getattr(i, "session_uid", None)) for i in ids}
+
+
+class AvatarSnapshot:
+    """Copy of the state of an armature and the Objects parented to it that the add-on's operators change, which can be
+    restored far faster than an undo step can be loaded, or used to roll back an operator that was stopped part way.
+
+    Only what the operators change is captured: the Object transforms, the data used by each Object, the vertex
+    positions of meshes and their shape keys, the rest pose, pose and bone inherit scale of the armature and the 3D
+    cursor location."""
+
+    __slots__ = (
+        "arm",
+        "objects",
+        "meshes",
+        "armature",
+        "cursor_location",
+        "object_ids",
+        "mesh_ids",
+        "names",
+        "mesh_names",
+    )
+
+    def __init__(self, arm: bpy.types.Object, context: bpy.types.Context):
+        self.arm = arm
+        objs = [arm, *children_recursive(arm)]
+        # (Object, matrix_basis, data)
+        self.objects: List[Tuple[bpy.types.Object, np.ndarray, bpy.types.ID]] = [
+            (obj, np.array(obj.matrix_basis, dtype=np.single), obj.data)
+            for obj in objs
+        ]
+        # Meshes can be shared by multiple Objects, so each Mesh is only captured once
+        self.meshes: Dict[bpy.types.Mesh, MeshSnapshot] = {}
+        for obj in objs:
+            if obj.type == "MESH" and obj.data not in self.meshes:
+                self.meshes[obj.data] = MeshSnapshot(obj.data)
+        self.armature = ArmatureSnapshot(arm)
+        self.cursor_location = context.scene.cursor.location.copy()
+        # Read now, while the IDs are known to exist, since reading the name of a deleted ID isn't safe
+        self.object_ids = _id_keys(objs)
+        self.mesh_ids = _id_keys(self.meshes)
+        # (Object name, data name) of each of self.objects and the name of each of self.meshes, see rebind()
+        self.names = [
+            (obj.name, data.name if data is not None else None)
+            for obj, _matrix, data in self.objects
+        ]
+        self.mesh_names = [mesh.name for mesh in self.meshes]
+
+    @property
+    def nbytes(self) -> int:
+        return (
+            sum(m.nbytes for m in self.meshes.values())
+            + self.armature.nbytes
+            + sum(matrix.nbytes for _obj, matrix, _data in self.objects)
+        )
+
+    def is_valid(self) -> bool:
+        """Whether every Object and Mesh captured still exists, so the snapshot can be restored. An ID is only taken to
+        be the same ID when it still has the same pointer, name and session_uid."""
+        return self.object_ids <= _id_keys(
+            bpy.data.objects
+        ) and self.mesh_ids <= _id_keys(bpy.data.meshes)
+
+    def rebind(self) -> bool:
+        """Point the snapshot at the Objects and Meshes with the names that were captured, e.g. after an undo step has
+        replaced every ID with a new copy. Returns False, leaving the snapshot unchanged, if any of them is missing."""
+        objects = bpy.data.objects
+        meshes = bpy.data.meshes
+        new_objects = []
+        for (obj_name, data_name), (_obj, matrix, _data) in zip(
+            self.names, self.objects
+        ):
+            obj = objects.get(obj_name)
+            if obj is None:
+                return False
+            data = obj.data
+            if data is not None and data.name != data_name:
+                # The Object was given a copy of its Mesh, e.g. when applying the pose to multi-user data
+                data = meshes.get(data_name) if obj.type == "MESH" else None
+                if data is None:
+                    return False
+            new_objects.append((obj, matrix, data))
+        new_meshes = {}
+        for mesh_name, mesh_snapshot in zip(self.mesh_names, self.meshes.values()):
+            mesh = meshes.get(mesh_name)
+            if mesh is None:
+                return False
+            new_meshes[mesh] = mesh_snapshot
+        for mesh, mesh_snapshot in new_meshes.items():
+            mesh_snapshot.mesh = mesh
+        self.objects = new_objects
+        self.meshes = new_meshes
+        self.arm = new_objects[0][0]
+        self.object_ids = _id_keys(obj for obj, _matrix, _data in new_objects)
+        self.mesh_ids = _id_keys(new_meshes)
+        return True
+
+    def describe(self) -> str:
+        num_shape_keys = sum(len(m.shape_key_cos) for m in self.meshes.values())
+        return "{}: {} meshes, {} shape keys, {} bones, {}".format(
+            self.arm.name,
+            len(self.meshes),
+            num_shape_keys,
+            len(self.armature.bone_names),
+            instrument.format_bytes(self.nbytes),
+        )
+
+    def restore(self, context: bpy.types.Context):
+        if context.mode != "OBJECT":
+            instrument.mode_set(mode="OBJECT")
+        for obj, _matrix, data in self.objects:
+            if obj.data != data:
+                obj.data = data
+        for mesh_snapshot in self.meshes.values():
+            mesh_snapshot.restore()
+        self.armature.restore(self.arm)
+        for obj, matrix, _data in self.objects:
+            # mathutils.Matrix is row-major when constructed from rows, the same as the array
+            obj.matrix_basis = mathutils.Matrix(matrix.tolist())
+        context.scene.cursor.location = self.cursor_location
+        instrument.view_layer_update(context.view_layer)
+
+
+def capture(arm: bpy.types.Object, context: Optional[bpy.types.Context] = None):
+    """Capture the state of arm and the Objects parented to it, see AvatarSnapshot"""
+    if context is None:
+        context = bpy.context
+    with span("capture snapshot"):
+        return AvatarSnapshot(arm, context)
+
+
+# The last snapshot remembered for each armature, by pointer, oldest first
+_LAST_SNAPSHOTS: Dict[int, AvatarSnapshot] = {}
+
+
+def remember(arm: bpy.types.Object, context: Optional[bpy.types.Context] = None):
+    """Capture a snapshot of arm and keep it as the snapshot RevertSnapshot restores, replacing the last one"""
+    avatar_snapshot = capture(arm, context)
+    key = arm.as_pointer()
+    # Removed first so that the most recently remembered snapshot is always last
+    _LAST_SNAPSHOTS.pop(key, None)
+    _LAST_SNAPSHOTS[key] = avatar_snapshot
+    log("Remembered snapshot of {}. {}", avatar_snapshot.describe(), storage_report())
+    return avatar_snapshot
+
+
+def get_last_snapshot(arm: Optional[bpy.types.Object]) -> Optional[AvatarSnapshot]:
+    """The last snapshot remembered for arm, or the last snapshot remembered for any armature if there isn't one"""
+    if arm is not None:
+        avatar_snapshot = _LAST_SNAPSHOTS.get(arm.as_pointer())
+        if avatar_snapshot is not None:
+            return avatar_snapshot
+    if _LAST_SNAPSHOTS:
+        return list(_LAST_SNAPSHOTS.values())[-1]
+    return None
+
+
+def _forget(avatar_snapshot: AvatarSnapshot):
+    for key, value in list(_LAST_SNAPSHOTS.items()):
+        if value is avatar_snapshot:
+            del _LAST_SNAPSHOTS[key]
+
+
+def forget_snapshots():
+    _LAST_SNAPSHOTS.clear()
+
+
+def storage_report() -> str:
+    """How many snapshots and origins are being kept and the memory they use"""
+    snapshots = list(_LAST_SNAPSHOTS.values())
+    snapshots += [o.snapshot for o in _ORIGINS.values() if o.snapshot is not None]
+    return "{} snapshots, {} origins using {}".format(
+        len(_LAST_SNAPSHOTS),
+        len(_ORIGINS),
+        instrument.format_bytes(sum(s.nbytes for s in snapshots)),
+    )
+
+
+@bpy.app.handlers.persistent
+def _snapshot_reset_handler(*_args):
+    # Loading a file or an undo step can free the data the snapshots refer to, and undo already does what reverting
+    # would
+    forget_snapshots()
+
+
+_SNAPSHOT_HANDLERS = (
+    ("load_post", _snapshot_reset_handler),
+    ("undo_post", _snapshot_reset_handler),
+    ("redo_post", _snapshot_reset_handler),
+)
+
+
+def fingerprint(arm: bpy.types.Object) -> bytes:
+    """Hash of the state of arm and the Objects parented to it, which changes whenever the avatar is rescaled or
+    edited: the Object names and transforms, the rest pose of the armature and the vertex positions, shape key names
+    and vertex group names of the meshes.
+
+    Only the basis vertex positions are read, with a single foreach_get per mesh, rather than those of every shape key.
+    Shape keys edited interactively are caught by _origin_depsgraph_handler() instead. Objects are identified by name
+    rather than by pointer, so the fingerprint of an avatar stays the same after an undo step has reloaded it."""
+    h = hashlib.blake2b(digest_size=16)
+    # Measurements are in worldspace, so a parent of the armature moving must change the fingerprint too
+    h.update(np.array(arm.matrix_world, dtype=np.single).tobytes())
+    objs = [arm, *children_recursive(arm)]
+    meshes = {}
+    for obj in objs:
+        h.update(obj.name.encode())
+        h.update(np.array(obj.matrix_basis, dtype=np.single).tobytes())
+        if obj.type == "MESH":
+            h.update(obj.data.name.encode())
+            for vg in obj.vertex_groups:
+                h.update(vg.name.encode())
+            meshes[obj.data.name] = obj.data
+    for mesh in meshes.values():
+        vertices = mesh.vertices
+        co = np.empty(len(vertices) * 3, dtype=np.single)
+        foreach_get(vertices, "co", co)
+        h.update(co.tobytes())
+        if mesh.shape_keys:
+            for key_block in mesh.shape_keys.key_blocks:
+                h.update(key_block.name.encode())
+    bones = arm.data.bones
+    for bone in bones:
+        h.update(bone.name.encode())
+        h.update(bone.inherit_scale.encode())
+    # Bone.matrix_local is a 4x4 matrix property, which foreach_get doesn't support in all the Blender versions
+    # supported, so it is read one bone at a time
+    h.update(np.array([b.matrix_local for b in bones], dtype=np.single).tobytes())
+    length = np.empty(len(bones), dtype=np.single)
+    foreach_get(bones, "length", length)
+    h.update(length.tobytes())
+    return h.digest()
+
+
+class AvatarOrigin:
+    """The state of an avatar before it was first rescaled, so that rescaling it again with different settings starts
+    from the same state instead of building on the result of the last rescale, which would make errors add up.
+
+    cache holds whatever the operator could reuse when starting from the origin again, e.g. measurements of the meshes
+    and vertex weights. It must only hold data without references to Blender data, because it's kept across undo
+    steps."""
+
+    __slots__ = ("snapshot", "fingerprint", "result_fingerprint", "cache")
+
+    def __init__(self, avatar_snapshot: AvatarSnapshot, origin_fingerprint: bytes):
+        self.snapshot: Optional[AvatarSnapshot] = avatar_snapshot
+        self.fingerprint = origin_fingerprint
+        # Fingerprint of the avatar after the last run, if the avatar hasn't been changed since, it can be put back to
+        # its origin
+        self.result_fingerprint: Optional[bytes] = None
+        self.cache: Dict[str, Any] = {}
+
+    def finish(self, arm: bpy.types.Object):
+        """Record that arm has been changed by a run started from this origin"""
+        self.result_fingerprint = fingerprint(arm)
+
+
+# Origin of each armature, by name
+_ORIGINS: Dict[str, AvatarOrigin] = {}
+
+
+def start_from_origin(
+    arm: bpy.types.Object, context: Optional[bpy.types.Context] = None
+) -> AvatarOrigin:
+    """Get the AvatarOrigin of arm, restoring arm to it when arm hasn't been changed since the last run.
+
+    When arm has been changed since, e.g. it's been edited, the current state becomes its new origin."""
+    if context is None:
+        context = bpy.context
+    with span("fingerprint"):
+        current = fingerprint(arm)
+    origin = _ORIGINS.get(arm.name)
+    if origin is not None:
+        if current == origin.fingerprint:
+            # E.g. after the last run was undone
+            log("{} is in its original state", arm.name)
+            if origin.snapshot is None or not origin.snapshot.is_valid():
+                origin.snapshot = capture(arm, context)
+            return origin
+        if (
+            current == origin.result_fingerprint
+            and origin.snapshot is not None
+            and origin.snapshot.is_valid()
+        ):
+            log("Restoring {} to its original state", arm.name)
+            with span("restore origin"):
+                origin.snapshot.restore(context)
+            return origin
+        log("{} has been changed since it was last run on", arm.name)
+    origin = AvatarOrigin(capture(arm, context), current)
+    _ORIGINS[arm.name] = origin
+    return origin
+
+
+def forget_origins():
+    _ORIGINS.clear()
+
+
+@bpy.app.handlers.persistent
+def _origin_load_handler(*_args):
+    forget_origins()
+
+
+@bpy.app.handlers.persistent
+def _origin_undo_handler(*_args):
+    # The undo step has replaced every ID, so the snapshots are pointed at the new IDs with the same names, rather than
+    # being captured again on the next run. The fingerprints and caches don't refer to Blender data, so they stay
+    # valid, e.g. rescaling again from the Redo panel still starts from the origin.
+    for origin in _ORIGINS.values():
+        if origin.snapshot is not None and not origin.snapshot.rebind():
+            origin.snapshot = None
+
+
+@bpy.app.handlers.persistent
+def _origin_depsgraph_handler(*_args):
+    # Painting weights doesn't move any vertices, so it doesn't change the fingerprint. Cached weights are dropped
+    # whenever anything is updated while in a mode that can change them.
+    mode = bpy.context.mode
+    if mode in _WEIGHT_EDITING_MODES:
+        for origin in _ORIGINS.values():
+            origin.cache.pop("weights", None)
+    if mode in _MESH_EDITING_MODES:
+        # Edits to shape keys aren't in the fingerprint, so the avatar must never be put back to its origin after it's
+        # been edited, which would throw the edits away. The next run starts from the edited avatar instead.
+        for origin in _ORIGINS.values():
+            origin.result_fingerprint = None
+
+
+_WEIGHT_EDITING_MODES = {"PAINT_WEIGHT", "EDIT_MESH"}
+_MESH_EDITING_MODES = {"EDIT_MESH", "SCULPT"}
+
+_ORIGIN_HANDLERS = (
+    ("load_post", _origin_load_handler),
+    ("undo_post", _origin_undo_handler),
+    ("redo_post", _origin_undo_handler),
+    ("depsgraph_update_post", _origin_depsgraph_handler),
+)
+
+
+def no_undo_variant(operator_class):
+    """Make a copy of an ArmatureOperator that doesn't push an undo step, remembering a snapshot of the avatar instead.
+
+    Blender's global undo saves the whole file in memory after every operator with "UNDO" in bl_options, which takes a
+    long time and a lot of memory on large files. The copy is called <bl_idname>_no_undo and RevertSnapshot goes back
+    to how the avatar was before it was last run."""
+
+    def execute(self, context):
+        arm = self.snapshot_armature(context)
+        if arm is not None:
+            remember(arm, context)
+        return operator_class.execute(self, context)
+
+    return type(
+        operator_class.__name__ + "NoUndo",
+        (operator_class,),
+        {
+            "__module__": operator_class.__module__,
+            "__doc__": "{} without an undo step. Revert Snapshot undoes it".format(
+                (operator_class.__doc__ or operator_class.bl_label).rstrip(". ")
+            ),
+            "bl_idname": operator_class.bl_idname + "_no_undo",
+            "bl_options": operator_class.bl_options - {"UNDO"},
+            "remember_snapshot": True,
+            "execute": execute,
+        },
+    )
+
+
+class RevertSnapshot(bpy.types.Operator):
+    """Restore the active avatar, or the last avatar changed, to how it was before the last operator run on it without
+    an undo step"""
+
+    bl_idname = "armature.imscale_revert"
+    bl_label = "Revert Snapshot"
+    # Reverting without an undo step is the point, the snapshot restores far faster than undo does
+    bl_options = {"REGISTER"}
+
+    @classmethod
+    def poll(cls, context: bpy.types.Context) -> bool:
+        return bool(_LAST_SNAPSHOTS)
+
+    def execute(self, context: bpy.types.Context):
+        avatar_snapshot = get_last_snapshot(get_armature())
+        if not avatar_snapshot.is_valid():
+            _forget(avatar_snapshot)
+            self.report({"ERROR"}, "Objects in the snapshot have been deleted")
+            return {"CANCELLED"}
+        start = time.perf_counter()
+        objs = [obj for obj, _matrix, _data in avatar_snapshot.objects]
+        with span("restore snapshot"), temp_ensure_enabled(*objs):
+            avatar_snapshot.restore(context)
+        self.report(
+            {"INFO"},
+            "Reverted {} in {:.2f}s".format(
+                avatar_snapshot.arm.name, time.perf_counter() - start
+            ),
+        )
+        return {"FINISHED"}
+
+
+_register, _unregister = bpy.utils.register_classes_factory([RevertSnapshot])
+
+
+def ops_register():
+    _register()
+    add_app_handlers(_SNAPSHOT_HANDLERS)
+    add_app_handlers(_ORIGIN_HANDLERS)
+
+
+def ops_unregister():
+    remove_app_handlers(_SNAPSHOT_HANDLERS)
+    remove_app_handlers(_ORIGIN_HANDLERS)
+    forget_snapshots()
+    forget_origins()
+    _unregister()
@@ -4,21 +4,28 @@ import numpy as np
 
 from . import common
 from . import bones
+from . import instrument
 from . import posemode
+from . import snapshot
 
 importlib.reload(common)
 importlib.reload(bones)
+importlib.reload(instrument)
 importlib.reload(posemode)
+importlib.reload(snapshot)
 
 from .common import (
     ArmatureOperator,
+    deselect_all,
     get_body_meshes,
     get_armature,
     obj_in_scene,
     temp_ensure_enabled,
 )
-from .posemode import start_pose_mode_with_reset, apply_pose_to_rest
+from .posemode import reset_pose, apply_pose_to_rest
 from .bones import get_bone
+from .instrument import mode_set
+from .snapshot import no_undo_variant
 
 
 def point_bone(bone, point, spread_factor):
@@ -57,15 +64,15 @@ def point_bone(bone, point, spread_factor):
 
 def spread_fingers(spare_thumb, spread_factor):
     obj = get_armature()
-    start_pose_mode_with_reset(obj)
+    reset_pose(obj)
     for hand in [get_bone("right_wrist", obj), get_bone("left_wrist", obj)]:
         for finger in hand.children:
             if "thumb" in finger.name.lower() and spare_thumb:
                 continue
             point_bone(finger, hand.head, spread_factor)
     apply_pose_to_rest()
-    bpy.ops.object.mode_set(mode="OBJECT")
-    bpy.ops.object.select_all(action="DESELECT")
+    mode_set(mode="OBJECT")
+    deselect_all()
 
 
 class ArmatureSpreadFingers(ArmatureOperator):
@@ -90,9 +97,13 @@ class ArmatureSpreadFingers(ArmatureOperator):
         return self.execute(context)
 
 
+ArmatureSpreadFingersNoUndo = no_undo_variant(ArmatureSpreadFingers)
+
+
 _register, _unregister = bpy.utils.register_classes_factory(
     [
         ArmatureSpreadFingers,
+        ArmatureSpreadFingersNoUndo,
     ]
 )
 
@@ -10,9 +10,10 @@ from bpy.props import (
 )
 from bpy.types import Scene, Bone
 
-from sys import intern
-
 from .common import get_armature, get_all_armatures
+from .bones import get_bone_enum_items, invalidate_bone_cache
+from .reference import get_scene_correspondence, invalidate_scene_correspondence
+from .snapshot import get_last_snapshot, storage_report
 
 
 # For bone mapping. Currently needs to match the dict keys in operations.py
@@ -73,10 +74,6 @@ BONE_LIST = [
     "right_thumb_distal",
 ]
 
-# Cache for enum property choices
-_ENUM_CACHE = None
-
-
 def set_properties():
     Scene.target_height = FloatProperty(
         name="Target Height",
@@ -208,6 +205,88 @@ def set_properties():
         default=False,
     )
 
+    Scene.imscale_deform_mode = EnumProperty(
+        name="Pose Bake Method",
+        description="How meshes are deformed when the pose is applied as the rest pose",
+        items=[
+            (
+                "MODIFIER",
+                "Armature Modifier",
+                "Apply a temporary Armature modifier to each mesh",
+            ),
+            (
+                "NUMPY",
+                "NumPy",
+                "Deform vertices directly, which is much faster on heavy meshes. Meshes that need preserve volume or"
+                " B-Bones still use an Armature modifier",
+            ),
+        ],
+        default="MODIFIER",
+    )
+
+    Scene.imscale_single_bake = BoolProperty(
+        name="Single Bake",
+        description="Apply the pose, move to the floor and scale to height in a single pass over the mesh data. Only"
+        " used when every mesh can be deformed by the NumPy pose bake method",
+        default=False,
+    )
+    Scene.imscale_align_single_bake = BoolProperty(
+        name="Single Bake When Aligning",
+        description="Bake the meshes only once when aligning armatures, instead of after each step. Faster, but"
+        " vertices weighted to several bones can end up in different places, most around joints where the bones are"
+        " scaled differently. Only used when every mesh can be deformed by the NumPy pose bake method",
+        default=False,
+    )
+    Scene.imscale_time_sliced = BoolProperty(
+        name="Responsive Rescale",
+        description="Rescale a little at a time between redraws, showing progress in the status bar. Esc cancels and"
+        " restores the avatar. Slightly slower overall",
+        default=False,
+    )
+    Scene.imscale_rerun_from_original = BoolProperty(
+        name="Rescale From Original",
+        description="When rescaling an avatar again without having edited it since, start from how it was before it was"
+        " first rescaled instead of rescaling the result again, reusing the measurements and weights read last time."
+        " Weights changed by scripts between rescales aren't noticed",
+        default=False,
+    )
+    Scene.imscale_skip_undo = BoolProperty(
+        name="Skip Undo",
+        description="Don't save an undo step after rescaling, spreading fingers, shrinking hips or matching scale,"
+        " which is slow and uses a lot of memory on large files. A snapshot of the avatar is kept in memory instead,"
+        " which Revert Snapshot restores",
+        default=False,
+    )
+
+    # Tracing and logging
+    Scene.imscale_trace = BoolProperty(
+        name="Trace",
+        description="Record how long each phase of an operation takes and save it as a Chrome trace file, which can be"
+        " opened in chrome://tracing or https://ui.perfetto.dev. Can also be enabled by setting the IMSCALE_TRACE"
+        " environment variable",
+        default=False,
+    )
+    Scene.imscale_trace_path = StringProperty(
+        name="Trace File",
+        description="File to save traces to. Leave empty to save each trace to a new file in the temporary directory",
+        default="",
+        subtype="FILE_PATH",
+    )
+    Scene.imscale_profile_memory = BoolProperty(
+        name="Profile Memory",
+        description="Record the Python allocation peak and process memory before and after each phase of an operation"
+        " and the NumPy buffers used for each mesh, then print the phases and meshes using the most memory to the"
+        " system console. Slows operations down. Can also be enabled by setting the IMSCALE_MEMORY environment"
+        " variable",
+        default=False,
+    )
+    Scene.imscale_verbose = BoolProperty(
+        name="Verbose Log",
+        description="Print details of each step to the system console. Can also be disabled by setting the"
+        " IMSCALE_VERBOSE environment variable to 0",
+        default=True,
+    )
+
     # Finger spreading
     Scene.spare_thumb = BoolProperty(
         name="Ignore thumb",
@@ -239,6 +318,14 @@ def set_properties():
         items=get_all_armatures,
     )
 
+    Scene.imscale_reference_template = StringProperty(
+        name="Reference Template",
+        description="Reference template file to align to instead of the reference armature, saved with Export"
+        " Reference Template. Leave empty to align to the reference armature",
+        default="",
+        subtype="FILE_PATH",
+    )
+
     # UI options
     bpy.types.Scene.imscale_scale_upper_body = bpy.props.BoolProperty(
         name="Scale by Upper Body",
@@ -264,16 +351,13 @@ def set_properties():
     )
 
     def getbones(self, context):
-        global _ENUM_CACHE
-        choices = [("_None",) * 3]
-        arm = get_armature()
-        if arm is not None:
-            # intern each string in the enum items to ensure Python has its own reference to it
-            choices = choices + list((intern(b.name),) * 3 for b in arm.data.bones)
-        # Storing the list of choices in bpy.types.Object.Enum doesn't seem to work properly for some reason, but we can
-        # use our own cache fine
-        _ENUM_CACHE = choices
-        return choices
+        # Cached, since each of the override_* properties calls this whenever it's drawn or read
+        return get_bone_enum_items(get_armature())
+
+    def override_update(self, context):
+        # Bones are resolved once per armature and then cached, the cache is out of date once an override changes
+        invalidate_bone_cache()
+        invalidate_scene_correspondence()
 
     # Bone Mapping
     for bone_name in BONE_LIST:
@@ -281,10 +365,32 @@ def set_properties():
             name=bone_name.replace("_", " "),
             description="Override for {} for when the bone is not automatically found.",
             items=getbones,
+            update=override_update,
         )
         setattr(Scene, "override_" + bone_name, prop)
 
 
+def _op_idname(scn, bl_idname):
+    """The no undo variant of the operator when Skip Undo is enabled, see snapshot.no_undo_variant()"""
+    if scn.imscale_skip_undo:
+        return bl_idname + "_no_undo"
+    return bl_idname
+
+
+# Most unmatched bones listed in the Scale Matching box
+_MAX_BONE_NAMES = 8
+
+
+def _draw_bone_names(layout, title, names):
+    if not names:
+        return
+    layout.label(text="{} ({}):".format(title, len(names)), icon="ERROR")
+    for name in names[:_MAX_BONE_NAMES]:
+        layout.label(text="    " + name)
+    if len(names) > _MAX_BONE_NAMES:
+        layout.label(text="    and {} more".format(len(names) - _MAX_BONE_NAMES))
+
+
 def draw_ui(context, layout):
     scn = context.scene
 
@@ -387,6 +493,27 @@ def draw_ui(context, layout):
         row.prop(scn, "imscale_scale_upper_body", text="Scale by Relative Proportions")
         row = col.row(align=False)
         row.prop(scn, "imscale_keep_head_size", text="Keep Head Size")
+        row = col.row(align=True)
+        row.prop(scn, "imscale_deform_mode", text="")
+        row = col.row(align=True)
+        row.prop(scn, "imscale_single_bake", expand=True)
+        row = col.row(align=True)
+        row.prop(scn, "imscale_align_single_bake", expand=True)
+        row = col.row(align=True)
+        row.prop(scn, "imscale_time_sliced", expand=True)
+        row = col.row(align=True)
+        row.prop(scn, "imscale_skip_undo", expand=True)
+        row = col.row(align=True)
+        row.prop(scn, "imscale_rerun_from_original", expand=True)
+        row = col.row(align=True)
+        row.prop(scn, "imscale_verbose", expand=True)
+        row = col.row(align=True)
+        row.prop(scn, "imscale_trace", expand=True)
+        if scn.imscale_trace:
+            row = col.row(align=True)
+            row.prop(scn, "imscale_trace_path", text="")
+        row = col.row(align=True)
+        row.prop(scn, "imscale_profile_memory", expand=True)
 
     row = col.row(align=True)
     row.label(text="-------------")
@@ -396,7 +523,13 @@ def draw_ui(context, layout):
 
     row = col.row(align=True)
     row.scale_y = 1.1
-    op = row.operator("armature.rescale", text="Rescale Armature")
+    op = row.operator(_op_idname(scn, "armature.rescale"), text="Rescale Armature")
+    row.operator("armature.rescale_preview", text="", icon="HIDE_OFF")
+    if scn.imscale_skip_undo or get_last_snapshot(None) is not None:
+        row.operator("armature.imscale_revert", text="", icon="LOOP_BACK")
+    if scn.imscale_show_debug:
+        row = col.row(align=True)
+        row.label(text=storage_report())
 
     # Spread Fingers
     box = layout.box()
@@ -424,7 +557,7 @@ def draw_ui(context, layout):
     row.label(text="-------------")
     row.scale_y = 1.1
     row = col.row(align=False)
-    row.operator("armature.spreadfingers", text="Spread Fingers")
+    row.operator(_op_idname(scn, "armature.spreadfingers"), text="Spread Fingers")
 
     # Shrink Hip
     box = layout.box()
@@ -432,7 +565,7 @@ def draw_ui(context, layout):
     col.label(text="Hip fix (beta)")
     row.scale_y = 1.1
     row = col.row(align=True)
-    row.operator("armature.shrink_hips", text="Shrink Hip bone")
+    row.operator(_op_idname(scn, "armature.shrink_hips"), text="Shrink Hip bone")
 
     # Bone mapping
     if scn.imscale_show_bone_map:
@@ -452,19 +585,32 @@ def draw_ui(context, layout):
             ).bone_name = bone_name
 
     # Scale matching
-    arm_count = len(get_all_armatures(None, bpy.context))
-    if arm_count > 1:
-        # Scale matching only shows if there are multiple armatures
+    # Cached in the scene index, so this doesn't scan the view layer on every redraw
+    arm_count = len(get_all_armatures(None, context))
+    if arm_count > 0:
+        # A single armature can only be aligned to a reference template
         box = layout.box()
         col = box.column(align=True)
         col.label(text="Scale Matching")
         row = col.row(align=True)
-        row.label(text="Reference Armature")
-        row.operator(
-            "scene.search_menu_scale_armature_ref",
-            text=context.scene.imscale_scale_armature_ref,
-            icon="ARMATURE_DATA",
-        )
+        row.prop(scn, "imscale_reference_template", text="Template")
+        if arm_count > 1:
+            row = col.row(align=True)
+            # The reference armature is only used when there's no template
+            row.enabled = not scn.imscale_reference_template
+            row.label(text="Reference Armature")
+            row.operator(
+                "scene.search_menu_scale_armature_ref",
+                text=context.scene.imscale_scale_armature_ref,
+                icon="ARMATURE_DATA",
+            )
+            # Exporting the reference is still possible while a template is used, e.g. to replace the template
+            row = col.row(align=True)
+            row.operator(
+                "armature.imscale_export_reference",
+                text="Export Reference Template",
+                icon="EXPORT",
+            )
 
         row = col.row(align=True)
         row.label(text="Scaling Armature")
@@ -475,7 +621,16 @@ def draw_ui(context, layout):
         )
 
         row = col.row(align=True)
-        row.operator("armature.imscale_align", text="Match Scale")
+        row.operator(_op_idname(scn, "armature.imscale_align"), text="Match Scale")
+        row = col.row(align=True)
+        row.operator("armature.imscale_align_batch", text="Match Scale of Selected")
+
+        # Humanoid bones that won't be aligned, so missing overrides can be fixed before aligning
+        correspondence = get_scene_correspondence(scn)
+        if correspondence is not None:
+            unmatched, ref_unmatched = correspondence.unmatched()
+            _draw_bone_names(col, "Not in reference", unmatched)
+            _draw_bone_names(col, "Not in scaling armature", ref_unmatched)
 
     return None
 
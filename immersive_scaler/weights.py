@@ -0,0 +1,133 @@
+import bpy
+import importlib
+import numpy as np
+
+from typing import Dict, Iterable, Optional
+
+from . import instrument
+
+importlib.reload(instrument)
+
+
+class VertexWeights:
+    """All vertex group weights of a mesh, stored as a compressed sparse row (CSR) vertex x group matrix.
+
+    The weights of vertex i are data[indptr[i]:indptr[i + 1]] and the vertex group index of each of those weights is
+    the element at the same position in indices. Group indices refer to the vertex_groups of the Object the weights
+    were read through."""
+
+    __slots__ = ("num_verts", "num_groups", "indptr", "indices", "data", "rows")
+
+    def __init__(
+        self,
+        num_verts: int,
+        num_groups: int,
+        counts: np.ndarray,
+        indices: np.ndarray,
+        data: np.ndarray,
+    ):
+        self.num_verts = num_verts
+        self.num_groups = num_groups
+        self.indptr = np.zeros(num_verts + 1, dtype=np.intp)
+        np.cumsum(counts, out=self.indptr[1:])
+        self.indices = indices
+        self.data = data
+        # The vertex index of each stored weight. Together with indices and data, this gives every (vertex, group,
+        # weight) triple as three flat arrays of the same length.
+        self.rows = np.repeat(np.arange(num_verts, dtype=np.intp), counts)
+
+    @property
+    def nnz(self) -> int:
+        """Number of stored weights"""
+        return len(self.data)
+
+    def triples(self):
+        """Get the (vertex, group, weight) triples as three flat arrays"""
+        return self.rows, self.indices, self.data
+
+    def vertex_mask(self, group_indices: Iterable[int]) -> np.ndarray:
+        """Get a boolean array that is True for every vertex with a non-zero weight in any of group_indices"""
+        group_indices = np.fromiter(group_indices, dtype=self.indices.dtype)
+        mask = np.zeros(self.num_verts, dtype=bool)
+        if len(group_indices) == 0 or self.nnz == 0:
+            return mask
+        # .weight is 'truthy' whenever it is not zero, so only non-zero weights count as being assigned to a group
+        in_groups = np.isin(self.indices, group_indices) & (self.data != 0)
+        mask[self.rows[in_groups]] = True
+        return mask
+
+
+def _read_vertex_weights(mesh_obj: bpy.types.Object) -> VertexWeights:
+    me = mesh_obj.data
+    vertices = me.vertices
+    num_verts = len(vertices)
+    # There are unfortunately no fast methods for getting all vertex weights, so we must resort to iteration. To
+    # keep that to a single pass, the groups collection of each vertex is only fetched once and every loop is a
+    # comprehension or generator consumed by numpy, which avoids the overhead of calling list.append for each weight.
+    vert_groups = [v.groups for v in vertices]
+    counts = np.fromiter(map(len, vert_groups), dtype=np.intp, count=num_verts)
+    elements = [g for groups in vert_groups for g in groups]
+    num_weights = len(elements)
+    # .group is the index of the vertex_group
+    indices = np.fromiter(
+        (g.group for g in elements), dtype=np.intc, count=num_weights
+    )
+    data = np.fromiter(
+        (g.weight for g in elements), dtype=np.single, count=num_weights
+    )
+
+    num_groups = len(mesh_obj.vertex_groups)
+    if num_weights:
+        # Weights can exist for vertex groups that have since been removed from the Object
+        num_groups = max(num_groups, int(indices.max()) + 1)
+    return VertexWeights(num_verts, num_groups, counts, indices, data)
+
+
+# Weights are stored in the mesh data, so meshes shared by multiple Objects share a cache entry
+_WEIGHTS_CACHE: Dict[int, VertexWeights] = {}
+
+
+def get_vertex_weights(mesh_obj: bpy.types.Object) -> VertexWeights:
+    """Get the weights of all vertices of mesh_obj, reading them from the mesh only if they are not already cached.
+
+    The cache is cleared at the start of every operator run, see clear_weights_cache()."""
+    me = mesh_obj.data
+    key = me.as_pointer()
+    weights = _WEIGHTS_CACHE.get(key)
+    if weights is None or weights.num_verts != len(me.vertices):
+        weights = _read_vertex_weights(mesh_obj)
+        _WEIGHTS_CACHE[key] = weights
+        instrument.record_arrays(
+            mesh_obj.name,
+            "weights",
+            weights.indptr,
+            weights.indices,
+            weights.data,
+            weights.rows,
+        )
+    return weights
+
+
+def get_cached_weights(mesh_obj: bpy.types.Object) -> Optional[VertexWeights]:
+    """Get the weights of mesh_obj if they have been read since the cache was last cleared"""
+    return _WEIGHTS_CACHE.get(mesh_obj.data.as_pointer())
+
+
+def set_cached_weights(mesh_obj: bpy.types.Object, weights: VertexWeights):
+    """Use weights as the weights of mesh_obj until the cache is next cleared, so they don't need to be read again.
+    weights must have been read from mesh_obj, or from an Object with the same vertex groups and mesh weights."""
+    _WEIGHTS_CACHE[mesh_obj.data.as_pointer()] = weights
+
+
+def clear_weights_cache():
+    """Forget all cached weights. Must be called whenever weights may have been changed outside the add-on, e.g. by
+    the user weight painting between operator runs."""
+    _WEIGHTS_CACHE.clear()
+
+
+def get_group_indices(mesh_obj: bpy.types.Object, group_names: Iterable[str]):
+    """Get the indices of the vertex groups of mesh_obj whose names are in group_names"""
+    group_names = set(group_names)
+    return {
+        idx for idx, vg in enumerate(mesh_obj.vertex_groups) if vg.name in group_names
+    }
@@ -0,0 +1,308 @@
+"""Run Immersive Scaler on many .blend files at once, spread over a pool of background Blender processes.
+
+Rescaling a single avatar only uses one core, so the way to use a machine with many cores is to run many Blender
+processes side by side. Each job is run by immersive_scaler/cli.py in its own process, so a crash or a hang only affects
+that one job. This script doesn't need Blender itself, run it with any Python 3.7+:
+
+    python tools/batch.py --input-dir avatars --output-dir rescaled --params params.json --summary summary.json
+
+or, with a different file, parameters or output for each job:
+
+    python tools/batch.py --manifest jobs.json --summary summary.json
+
+where jobs.json is a list of {"input": ..., "output": ..., "params": {...} or "params.json"}. Relative paths in the
+manifest are relative to the manifest. The parameters are the same as for cli.py, "steps" picks the job type out of
+"rescale", "spread_fingers", "shrink_hips", "align", "align_all" and "export_reference".
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Any, Dict, List, Optional
+
+CLI_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "immersive_scaler",
+    "cli.py",
+)
+
+# How much of a failed job's output to keep in the summary
+_OUTPUT_TAIL_CHARS = 4000
+
+
+def load_params(params) -> Dict[str, Any]:
+    if params is None:
+        return {}
+    if isinstance(params, dict):
+        return params
+    with open(params, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def jobs_from_dir(input_dir: str, output_dir: str, params: Dict[str, Any]):
+    jobs = []
+    for name in sorted(os.listdir(input_dir)):
+        if not name.lower().endswith(".blend"):
+            continue
+        jobs.append(
+            {
+                "input": os.path.abspath(os.path.join(input_dir, name)),
+                "output": os.path.abspath(os.path.join(output_dir, name)),
+                "params": params,
+            }
+        )
+    return jobs
+
+
+def jobs_from_manifest(manifest_path: str, params: Dict[str, Any]):
+    base_dir = os.path.dirname(os.path.abspath(manifest_path))
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        manifest = json.load(f)
+    if not isinstance(manifest, list):
+        raise ValueError("The manifest must contain a JSON list of jobs")
+
+    def resolve(path):
+        return os.path.normpath(os.path.join(base_dir, path))
+
+    jobs = []
+    for entry in manifest:
+        job_params = entry.get("params")
+        if isinstance(job_params, str):
+            job_params = load_params(resolve(job_params))
+        if job_params is None:
+            job_params = params
+        elif params:
+            # Settings given on the command line are the defaults for every job
+            job_params = dict(params, **job_params)
+        output = entry.get("output")
+        jobs.append(
+            {
+                "input": resolve(entry["input"]),
+                "output": resolve(output) if output else None,
+                "params": job_params,
+            }
+        )
+    return jobs
+
+
+def _output_tail(output) -> str:
+    if output is None:
+        return ""
+    if isinstance(output, bytes):
+        output = output.decode("utf-8", errors="replace")
+    return output[-_OUTPUT_TAIL_CHARS:]
+
+
+def run_job_once(job, args, work_dir: str, attempt: int) -> Dict[str, Any]:
+    """Run one attempt at job in a new Blender process"""
+    params_path = os.path.join(work_dir, "params.json")
+    result_path = os.path.join(work_dir, "result_{}.json".format(attempt))
+    with open(params_path, "w", encoding="utf-8") as f:
+        json.dump(job["params"], f)
+
+    command = [args.blender, "--background", "--factory-startup"]
+    if args.blender_threads:
+        command += ["--threads", str(args.blender_threads)]
+    command += ["--python-exit-code", "1", "--python", CLI_PATH, "--"]
+    command += ["--input", job["input"], "--params", params_path]
+    command += ["--result", result_path]
+    if job["output"]:
+        command += ["--output", job["output"]]
+
+    env = os.environ.copy()
+    if args.blender_threads:
+        # Stop numpy's BLAS starting a thread per core in every worker
+        for var in ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS"):
+            env[var] = str(args.blender_threads)
+
+    start = time.perf_counter()
+    attempt_result = {"attempt": attempt}
+    try:
+        proc = subprocess.run(
+            command,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            timeout=args.timeout,
+            env=env,
+        )
+    except subprocess.TimeoutExpired as e:
+        # subprocess.run kills the process when the timeout expires
+        attempt_result["status"] = "timeout"
+        attempt_result["output"] = _output_tail(e.output)
+    except OSError as e:
+        attempt_result["status"] = "error"
+        attempt_result["error"] = "Could not start Blender: {}".format(e)
+    else:
+        attempt_result["returncode"] = proc.returncode
+        if os.path.exists(result_path):
+            try:
+                with open(result_path, "r", encoding="utf-8") as f:
+                    attempt_result["result"] = json.load(f)
+                attempt_result["status"] = attempt_result["result"]["status"]
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                # Blender crashed while the result was being written
+                attempt_result["status"] = "crashed"
+                attempt_result["error"] = "Could not read the result: {}".format(e)
+        else:
+            # Blender crashed or exited before the result could be written
+            attempt_result["status"] = "crashed"
+        if attempt_result["status"] != "ok":
+            attempt_result["output"] = _output_tail(proc.stdout)
+    attempt_result["wall_time"] = time.perf_counter() - start
+    return attempt_result
+
+
+def run_job(job, args) -> Dict[str, Any]:
+    """Run job, trying again if Blender crashed or timed out, up to args.retries more times"""
+    if job["output"]:
+        os.makedirs(os.path.dirname(job["output"]) or ".", exist_ok=True)
+    attempts = []
+    with tempfile.TemporaryDirectory(prefix="imscale_job_") as work_dir:
+        for attempt in range(args.retries + 1):
+            attempt_result = run_job_once(job, args, work_dir, attempt)
+            attempts.append(attempt_result)
+            # An error reported by cli.py will happen again every time, so only crashes and timeouts are retried
+            if attempt_result["status"] not in ("timeout", "crashed"):
+                break
+    last = attempts[-1]
+    summary = {
+        "input": job["input"],
+        "output": job["output"],
+        "status": last["status"],
+        "attempts": len(attempts),
+        "wall_time": sum(a["wall_time"] for a in attempts),
+    }
+    result = last.get("result")
+    if result is not None:
+        for key in (
+            "armature",
+            "steps",
+            "before",
+            "after",
+            "timings",
+            "api_calls",
+            "memory",
+            "error",
+        ):
+            if key in result:
+                summary[key] = result[key]
+    elif "error" in last:
+        summary["error"] = last["error"]
+    if last["status"] != "ok":
+        summary["failed_attempts"] = attempts
+    return summary
+
+
+def run_jobs(jobs: List[Dict[str, Any]], args) -> List[Dict[str, Any]]:
+    results: List[Optional[Dict[str, Any]]] = [None] * len(jobs)
+    # The work is done by the Blender processes, so threads are enough to wait on them
+    with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        futures = {
+            executor.submit(run_job, job, args): i for i, job in enumerate(jobs)
+        }
+        for done, future in enumerate(as_completed(futures), 1):
+            i = futures[future]
+            results[i] = result = future.result()
+            print(
+                "[{}/{}] {}: {} ({:.1f}s)".format(
+                    done,
+                    len(jobs),
+                    os.path.basename(result["input"]),
+                    result["status"],
+                    result["wall_time"],
+                )
+            )
+    return results
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--input-dir", help="Directory of .blend files to process")
+    source.add_argument("--manifest", help="JSON list of jobs")
+    parser.add_argument(
+        "--output-dir", help="Directory to save the results of --input-dir to"
+    )
+    parser.add_argument("--params", help="JSON parameter file used for every job")
+    parser.add_argument(
+        "--summary", default="summary.json", help="File to write the summary to"
+    )
+    parser.add_argument(
+        "--blender",
+        default=os.environ.get("BLENDER", "blender"),
+        help="Blender executable, defaults to $BLENDER or blender",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="Blender processes to run at once, defaults to the number of cores",
+    )
+    parser.add_argument(
+        "--blender-threads",
+        type=int,
+        default=1,
+        help="Threads for each Blender process, 0 lets Blender decide",
+    )
+    parser.add_argument(
+        "--timeout", type=float, default=600, help="Seconds before a job is killed"
+    )
+    parser.add_argument(
+        "--retries",
+        type=int,
+        default=1,
+        help="Times to retry a job that crashed or timed out",
+    )
+    args = parser.parse_args(argv)
+    if args.input_dir and not args.output_dir:
+        parser.error("--input-dir needs --output-dir")
+    return args
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    params = load_params(args.params)
+    if args.manifest:
+        jobs = jobs_from_manifest(args.manifest, params)
+    else:
+        jobs = jobs_from_dir(args.input_dir, args.output_dir, params)
+    if not jobs:
+        print("Nothing to do")
+        return 0
+
+    print("Running {} jobs on {} workers".format(len(jobs), args.jobs))
+    start = time.perf_counter()
+    results = run_jobs(jobs, args)
+    wall_time = time.perf_counter() - start
+
+    statuses = {}
+    for result in results:
+        statuses[result["status"]] = statuses.get(result["status"], 0) + 1
+    summary = {
+        "num_jobs": len(jobs),
+        "workers": args.jobs,
+        "statuses": statuses,
+        "wall_time": wall_time,
+        "job_time": sum(r["wall_time"] for r in results),
+        "jobs": results,
+    }
+    with open(args.summary, "w", encoding="utf-8") as f:
+        json.dump(summary, f, indent=2)
+    print(
+        "Finished in {:.1f}s: {}. Summary written to {}".format(
+            wall_time,
+            ", ".join("{} {}".format(n, s) for s, n in sorted(statuses.items())),
+            args.summary,
+        )
+    )
+    return 0 if statuses.get("ok", 0) == len(jobs) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,623 @@
+"""Time the slow parts of Immersive Scaler on synthetic avatars of different sizes.
+
+Run with Blender in background mode, arguments for this script go after '--':
+
+    blender --background --factory-startup --python tools/benchmark.py -- \\
+        --verts 10000,100000,1000000 --shape-keys 0,100,400 --meshes 1 --bones 0 --repeat 3 --json bench.json
+
+A synthetic humanoid avatar is built for every combination of --verts, --meshes, --shape-keys and --bones. The
+armature uses the names from bones.bone_names, with --bones adding extra bones in chains off the head, like hair, to
+reach that total. Vertices are spread over the deforming bones, each weighted to its bone and, near the bone's head,
+blended with the bone's parent. Every timing is the best of --repeat runs on a freshly built avatar, so an operation
+that changes the avatar doesn't affect the next run. The results are printed as one table per operation.
+
+With --check, nothing is timed. Instead, each fast path is checked against the slower path it replaces on the same
+synthetic avatars, failing when the vertex positions, shape keys, bones or pose matrices differ by more than
+--tolerance:
+
+    blender --background --factory-startup --python tools/benchmark.py -- --check --verts 10000 --shape-keys 0,10
+"""
+import argparse
+import gc
+import json
+import os
+import sys
+import time
+
+import bpy
+import numpy as np
+
+from mathutils import Quaternion
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import immersive_scaler
+
+from immersive_scaler import align
+from immersive_scaler import bones
+from immersive_scaler import common
+from immersive_scaler import instrument
+from immersive_scaler import operations
+from immersive_scaler import posemode
+from immersive_scaler import skeleton
+from immersive_scaler import spread_fingers
+from immersive_scaler import weights
+
+# Humanoid bone -> (parent, head, tail) of the left side and centre of a ~1.75m tall avatar in T-pose, facing -Y. The
+# right side is mirrored from the left.
+_LEFT_SKELETON = {
+    "hips": (None, (0, 0, 0.95), (0, 0, 1.05)),
+    "spine": ("hips", (0, 0, 1.05), (0, 0, 1.2)),
+    "chest": ("spine", (0, 0, 1.2), (0, 0, 1.35)),
+    "upperchest": ("chest", (0, 0, 1.35), (0, 0, 1.45)),
+    "neck": ("upperchest", (0, 0, 1.45), (0, 0, 1.55)),
+    "head": ("neck", (0, 0, 1.55), (0, 0, 1.75)),
+    "left_eye": ("head", (0.03, -0.08, 1.64), (0.03, -0.08, 1.68)),
+    "left_leg": ("hips", (0.09, 0, 0.95), (0.09, 0, 0.5)),
+    "left_knee": ("left_leg", (0.09, 0, 0.5), (0.09, 0, 0.08)),
+    "left_ankle": ("left_knee", (0.09, 0, 0.08), (0.09, -0.12, 0.03)),
+    "left_toes": ("left_ankle", (0.09, -0.12, 0.03), (0.09, -0.2, 0.03)),
+    "left_shoulder": ("upperchest", (0.02, 0, 1.42), (0.15, 0, 1.42)),
+    "left_arm": ("left_shoulder", (0.15, 0, 1.42), (0.42, 0, 1.42)),
+    "left_elbow": ("left_arm", (0.42, 0, 1.42), (0.68, 0, 1.42)),
+    "left_wrist": ("left_elbow", (0.68, 0, 1.42), (0.76, 0, 1.42)),
+}
+# Finger -> (y offset of the finger from the wrist, direction of the finger in the XY plane)
+_FINGERS = {
+    "thumb": (-0.03, (0.6, -0.8)),
+    "index": (-0.025, (1, 0)),
+    "middle": (-0.008, (1, 0)),
+    "ring": (0.008, (1, 0)),
+    "little": (0.025, (1, 0)),
+}
+_FINGER_SEGMENTS = ("proximal", "intermediate", "distal")
+_FINGER_SEGMENT_LENGTH = 0.03
+
+# Radius of the synthetic mesh around each kind of bone
+_TORSO_RADIUS = 0.12
+_HEAD_RADIUS = 0.09
+_LIMB_RADIUS = 0.05
+_SMALL_RADIUS = 0.008
+
+
+def _humanoid_skeleton():
+    """Get humanoid bone -> (parent, head, tail, mesh radius) for both sides"""
+    skeleton = {}
+    for name, (parent, head, tail) in _LEFT_SKELETON.items():
+        if name in ("hips", "spine", "chest", "upperchest"):
+            radius = _TORSO_RADIUS
+        elif name == "head":
+            radius = _HEAD_RADIUS
+        elif name == "left_eye":
+            radius = _SMALL_RADIUS
+        else:
+            radius = _LIMB_RADIUS
+        skeleton[name] = (parent, head, tail, radius)
+
+    wrist_x, _, wrist_z = _LEFT_SKELETON["left_wrist"][2]
+    for finger, (y_offset, (dir_x, dir_y)) in _FINGERS.items():
+        parent = "left_wrist"
+        head = (wrist_x, y_offset, wrist_z)
+        for segment in _FINGER_SEGMENTS:
+            tail = (
+                head[0] + dir_x * _FINGER_SEGMENT_LENGTH,
+                head[1] + dir_y * _FINGER_SEGMENT_LENGTH,
+                head[2],
+            )
+            name = "left_{}_{}".format(finger, segment)
+            skeleton[name] = (parent, head, tail, _SMALL_RADIUS)
+            parent = name
+            head = tail
+
+    def mirror(name):
+        return "right" + name[4:] if name and name.startswith("left") else name
+
+    for name, (parent, head, tail, radius) in list(skeleton.items()):
+        if name.startswith("left"):
+            skeleton[mirror(name)] = (
+                mirror(parent),
+                (-head[0], head[1], head[2]),
+                (-tail[0], tail[1], tail[2]),
+                radius,
+            )
+    return skeleton
+
+
+def _bone_name(humanoid_name):
+    # The first name listed in bone_names is always found by bone lookups
+    return bones.bone_names[humanoid_name][0]
+
+
+def build_armature(name, num_bones=0, limb_scale=1.0):
+    """Build a humanoid armature, with extra bones added to reach num_bones bones in total. limb_scale scales the
+    length of arms and legs, to get an armature with different proportions."""
+    skeleton = _humanoid_skeleton()
+    arm_data = bpy.data.armatures.new(name)
+    arm = bpy.data.objects.new(name, arm_data)
+    bpy.context.scene.collection.objects.link(arm)
+    bpy.context.view_layer.objects.active = arm
+    bpy.ops.object.mode_set(mode="EDIT")
+    edit_bones = arm_data.edit_bones
+    # (bone name, parent bone name, head, tail, mesh radius)
+    bone_specs = []
+    for humanoid_name, (parent, head, tail, radius) in skeleton.items():
+        head = np.array(head, dtype=float)
+        tail = np.array(tail, dtype=float)
+        is_limb = humanoid_name.startswith(("left", "right"))
+        if limb_scale != 1.0 and is_limb and not humanoid_name.endswith("_eye"):
+            # Legs are scaled from the hips and arms from the shoulders
+            is_leg = humanoid_name.endswith(("_leg", "_knee", "_ankle", "_toes"))
+            origin = np.array([0, 0, 0.95 if is_leg else 1.42])
+            head = origin + (head - origin) * limb_scale
+            tail = origin + (tail - origin) * limb_scale
+        parent_name = _bone_name(parent) if parent else None
+        bone_specs.append((_bone_name(humanoid_name), parent_name, head, tail, radius))
+
+    head_name = _bone_name("head")
+    num_extra = max(0, num_bones - len(bone_specs))
+    chain_length = 4
+    for i in range(num_extra):
+        # Chains of short bones hanging off the back of the head
+        chain, link = divmod(i, chain_length)
+        angle = chain * 2.399963  # golden angle, to spread the chains around the head
+        base = np.array([np.cos(angle) * 0.08, 0.04 + np.sin(angle) * 0.04, 1.7])
+        head = base + np.array([0, 0.02, -0.05]) * link
+        tail = head + np.array([0, 0.02, -0.05])
+        parent_name = head_name if link == 0 else "Extra_{}".format(i - 1)
+        bone_name = "Extra_{}".format(i)
+        bone_specs.append((bone_name, parent_name, head, tail, _SMALL_RADIUS))
+
+    for bone_name, parent_name, head, tail, _radius in bone_specs:
+        eb = edit_bones.new(bone_name)
+        eb.head = head
+        eb.tail = tail
+        if parent_name:
+            eb.parent = edit_bones[parent_name]
+            eb.use_connect = False
+    bpy.ops.object.mode_set(mode="OBJECT")
+    return arm, bone_specs
+
+
+def _generate_vertices(bone_specs, num_verts, rng):
+    """Get (co, bone index, position along the bone) of num_verts vertices spread over the bones"""
+    bone_idx = np.arange(num_verts) % len(bone_specs)
+    t = rng.random(num_verts)
+    theta = rng.random(num_verts) * (2 * np.pi)
+    heads = np.array([spec[2] for spec in bone_specs])
+    tails = np.array([spec[3] for spec in bone_specs])
+    radii = np.array([spec[4] for spec in bone_specs])
+    axes = tails - heads
+    axes /= np.linalg.norm(axes, axis=1, keepdims=True)
+    # Two vectors perpendicular to each bone
+    helper = np.where(np.abs(axes[:, 2:3]) < 0.9, [[0, 0, 1]], [[1, 0, 0]])
+    u = np.cross(axes, helper)
+    u /= np.linalg.norm(u, axis=1, keepdims=True)
+    v = np.cross(axes, u)
+    co = (
+        heads[bone_idx]
+        + (tails - heads)[bone_idx] * t[:, None]
+        + radii[bone_idx, None]
+        * (u[bone_idx] * np.cos(theta)[:, None] + v[bone_idx] * np.sin(theta)[:, None])
+    )
+    # Sort by bone so that each mesh gets a contiguous part of the body
+    order = np.argsort(bone_idx, kind="stable")
+    return co[order], bone_idx[order], t[order]
+
+
+# The weight to a vertex's own bone is quantized to these values, so that vertex groups can be filled with one
+# VertexGroup.add call per weight instead of one per vertex
+_WEIGHT_LEVELS = np.array([0.5, 0.75, 1.0])
+
+
+def build_mesh(name, arm, bone_specs, co, bone_idx, t, num_shape_keys, rng):
+    me = bpy.data.meshes.new(name)
+    me.vertices.add(len(co))
+    me.vertices.foreach_set("co", co.astype(np.single).ravel())
+    me.update()
+    obj = bpy.data.objects.new(name, me)
+    bpy.context.scene.collection.objects.link(obj)
+    obj.parent = arm
+    obj.modifiers.new("Armature", "ARMATURE").object = arm
+
+    bone_index = {spec[0]: i for i, spec in enumerate(bone_specs)}
+    groups = {}
+
+    def group(i):
+        if i not in groups:
+            groups[i] = obj.vertex_groups.new(name=bone_specs[i][0])
+        return groups[i]
+
+    # Blend with the parent bone near the head of each bone
+    own_weight = _WEIGHT_LEVELS[np.minimum(t * 8, len(_WEIGHT_LEVELS) - 1).astype(int)]
+    for i in np.unique(bone_idx):
+        in_bone = bone_idx == i
+        parent_name = bone_specs[i][1]
+        for weight in _WEIGHT_LEVELS:
+            indices = np.flatnonzero(in_bone & (own_weight == weight)).tolist()
+            if not indices:
+                continue
+            group(i).add(indices, float(weight), "REPLACE")
+            if weight < 1 and parent_name:
+                group(bone_index[parent_name]).add(indices, float(1 - weight), "ADD")
+
+    if num_shape_keys:
+        obj.shape_key_add(name="Basis")
+        flat_co = co.astype(np.single).ravel()
+        for k in range(num_shape_keys):
+            key = obj.shape_key_add(name="Key_{}".format(k), from_mix=False)
+            offset = rng.normal(scale=0.002, size=flat_co.shape).astype(np.single)
+            key.data.foreach_set("co", flat_co + offset)
+    return obj
+
+
+def build_avatar(num_verts, num_meshes, num_shape_keys, num_bones, seed=0):
+    """Build a synthetic avatar in the current scene, returning the armature"""
+    rng = np.random.default_rng(seed)
+    arm, bone_specs = build_armature("Armature", num_bones)
+    co, bone_idx, t = _generate_vertices(bone_specs, num_verts, rng)
+    for m, part in enumerate(np.array_split(np.arange(num_verts), num_meshes)):
+        build_mesh(
+            "Body_{}".format(m),
+            arm,
+            bone_specs,
+            co[part],
+            bone_idx[part],
+            t[part],
+            num_shape_keys,
+            rng,
+        )
+    bpy.context.view_layer.objects.active = arm
+    arm.select_set(True)
+    return arm
+
+
+def pose_avatar(arm):
+    """Pose the arms down and the knees bent, so there is a pose to apply"""
+    posemode.reset_pose(arm)
+    for side, sign in (("left", 1), ("right", -1)):
+        arm_bone = bones.get_bone(side + "_arm", arm)
+        arm_bone.rotation_quaternion = Quaternion((0, 1, 0), sign * 0.7)
+        knee_bone = bones.get_bone(side + "_knee", arm)
+        knee_bone.rotation_quaternion = Quaternion((1, 0, 0), 0.3)
+    bpy.context.view_layer.update()
+
+
+def reset_scene():
+    for obj in list(bpy.data.objects):
+        bpy.data.objects.remove(obj)
+    for collection in (bpy.data.meshes, bpy.data.armatures, bpy.data.shape_keys):
+        for block in list(collection):
+            if block.users == 0 and hasattr(collection, "remove"):
+                collection.remove(block)
+    weights.clear_weights_cache()
+    bones.invalidate_bone_cache()
+    common.invalidate_scene_index()
+    gc.collect()
+
+
+# Benchmarks: name -> (setup, run). setup gets the freshly built armature and returns the arguments for run, which is
+# what gets timed.
+
+
+def _setup_measure(arm):
+    # Time with cold caches, the same as the first measurement of an operator run
+    weights.clear_weights_cache()
+    return (arm, operations.get_body_meshes(arm))
+
+
+def _setup_posed(deform_mode):
+    def setup(arm):
+        pose_avatar(arm)
+        return (arm, deform_mode)
+
+    return setup
+
+
+def _apply_pose(arm, deform_mode):
+    posemode.apply_pose_to_rest(arm=arm, deform_mode=deform_mode)
+
+
+def _setup_reset(arm):
+    pose_avatar(arm)
+    return (arm.pose.bones,)
+
+
+def _setup_align(arm):
+    ref_arm, _bone_specs = build_armature("Reference", limb_scale=1.15)
+    bpy.context.view_layer.objects.active = arm
+    return (arm.name, ref_arm.name)
+
+
+def _align(arm_name, ref_name):
+    align.align_armatures(bpy.context, ref_name, arm_name, 1.0, 1.0)
+
+
+def _setup_scene(single_bake):
+    def setup(arm):
+        bpy.context.scene.imscale_single_bake = single_bake
+        return (bpy.context.scene,)
+
+    return setup
+
+
+def _spread_fingers(scene):
+    spread_fingers.spread_fingers(scene.spare_thumb, scene.spread_factor)
+
+
+BENCHMARKS = {
+    "get_lowest_point": (_setup_measure, operations.get_lowest_point),
+    "get_highest_point": (_setup_measure, operations.get_highest_point),
+    "apply_pose_to_rest": (_setup_posed(posemode.DEFORM_MODIFIER), _apply_pose),
+    "apply_pose_to_rest[numpy]": (_setup_posed(posemode.DEFORM_NUMPY), _apply_pose),
+    "reset_current_pose": (_setup_reset, posemode.reset_current_pose),
+    "align_armatures": (_setup_align, _align),
+    "spread_fingers": (_setup_scene(False), _spread_fingers),
+    "rescale_main": (_setup_scene(False), operations.rescale_main_from_scene),
+    "rescale_main[single bake]": (
+        _setup_scene(True),
+        operations.rescale_main_from_scene,
+    ),
+}
+
+
+def time_benchmark(name, config, repeat):
+    """Get the best time of repeat runs, and the counts of expensive Blender API calls made by a run"""
+    setup, func = BENCHMARKS[name]
+    best = None
+    for _ in range(repeat):
+        reset_scene()
+        arm = build_avatar(**config)
+        # setup leaves the avatar in the mode func needs
+        args = setup(arm)
+        with immersive_scaler.common.temp_ensure_enabled(
+            arm, *operations.get_body_meshes(arm)
+        ), instrument.count_calls() as counts:
+            start = time.perf_counter()
+            func(*args)
+            elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, counts
+
+
+def read_avatar_state(arm):
+    """Get name -> array of everything about the avatar that the checks compare, in world space, so that a path that
+    applies a transform to the Objects instead of the data still compares equal"""
+    state = {}
+    matrix_world = np.array(arm.matrix_world)
+    data_bones = arm.data.bones
+    for prop in ("head_local", "tail_local"):
+        co = np.array([getattr(bone, prop) for bone in data_bones], dtype=np.double)
+        state["bones " + prop] = co @ matrix_world[:3, :3].T + matrix_world[:3, 3]
+    for mesh_obj in sorted(operations.get_body_meshes(arm), key=lambda o: o.name):
+        mesh = mesh_obj.data
+        matrix_world = np.array(mesh_obj.matrix_world)
+        blocks = [("vertices", mesh.vertices)]
+        if mesh.shape_keys:
+            blocks += [(kb.name, kb.data) for kb in mesh.shape_keys.key_blocks]
+        for block_name, data in blocks:
+            co = np.empty(len(data) * 3, dtype=np.single)
+            data.foreach_get("co", co)
+            co = co.reshape(-1, 3).astype(np.double)
+            state["{} {}".format(mesh_obj.name, block_name)] = (
+                co @ matrix_world[:3, :3].T + matrix_world[:3, 3]
+            )
+    return state
+
+
+def _compare_benchmarks(slow, fast):
+    """Make a check that runs the benchmarks slow and fast on two avatars built the same way, comparing the resulting
+    avatars"""
+
+    def check(config):
+        states = []
+        for name in (slow, fast):
+            setup, func = BENCHMARKS[name]
+            reset_scene()
+            arm = build_avatar(**config)
+            args = setup(arm)
+            with immersive_scaler.common.temp_ensure_enabled(
+                arm, *operations.get_body_meshes(arm)
+            ):
+                func(*args)
+            states.append(read_avatar_state(arm))
+        expected, actual = states
+        return {name: (expected[name], actual.get(name)) for name in expected}
+
+    return check
+
+
+def _check_skeleton_solve(config):
+    """Compare the pose matrices Skeleton.solve() computes to those Blender evaluates, with every bone rotated, scaled
+    and moved, and the knees and elbows not inheriting scale"""
+    reset_scene()
+    arm = build_avatar(**config)
+    for side in ("left", "right"):
+        for humanoid_name in ("_knee", "_elbow"):
+            bones.get_bone(side + humanoid_name, arm).bone.inherit_scale = "NONE"
+    bpy.context.view_layer.update()
+    rig = skeleton.Skeleton(arm)
+    reason = rig.unsupported_reason(range(len(rig)))
+    if reason is not None:
+        raise ValueError("The synthetic armature can't be solved: " + reason)
+    rng = np.random.default_rng(1)
+    num_bones = len(rig)
+    # Mostly small rotations, so that the limbs are posed but don't fold back on themselves
+    rotation = rng.normal(scale=0.3, size=(num_bones, 4))
+    rotation[:, 0] = 1
+    rig.rotation[:] = rotation
+    rig.scale[:] = rng.uniform(0.9, 1.1, size=(num_bones, 3))
+    rig.location[:] = rng.normal(scale=0.01, size=(num_bones, 3))
+    rig.write_pose(arm)
+    bpy.context.view_layer.update()
+    solved = np.empty((num_bones, 4, 4))
+    rig.solve(solved)
+    return {"pose matrices": (rig.read_pose_matrices(arm), solved)}
+
+
+# Checks: name -> function that gets the config of the avatar to build and returns name -> (expected array, actual
+# array) of what must match
+CHECKS = {
+    "apply_pose_to_rest[numpy]": _compare_benchmarks(
+        "apply_pose_to_rest", "apply_pose_to_rest[numpy]"
+    ),
+    # The single bake against applying the pose, moving to the floor and scaling to the height one after another
+    "rescale_main[single bake]": _compare_benchmarks(
+        "rescale_main", "rescale_main[single bake]"
+    ),
+    "Skeleton.solve": _check_skeleton_solve,
+}
+
+
+def run_check(name, config, tolerance):
+    """Get the names of what differs by more than tolerance, and the largest difference found"""
+    mismatched = []
+    max_error = 0.0
+    for array_name, (expected, actual) in CHECKS[name](config).items():
+        if actual is None or np.shape(actual) != np.shape(expected):
+            mismatched.append(array_name)
+            continue
+        if len(expected) == 0:
+            continue
+        error = float(np.max(np.abs(np.asarray(actual) - np.asarray(expected))))
+        max_error = max(max_error, error)
+        if not error <= tolerance:
+            mismatched.append(array_name)
+    return mismatched, max_error
+
+
+def _int_list(value):
+    return [int(v) for v in value.split(",")]
+
+
+def parse_args(argv=None):
+    if argv is None:
+        argv = sys.argv[sys.argv.index("--") + 1 :] if "--" in sys.argv else []
+    parser = argparse.ArgumentParser(
+        prog="blender --background --python benchmark.py --",
+        description="Time Immersive Scaler on synthetic avatars",
+    )
+    parser.add_argument("--verts", type=_int_list, default=[10000, 100000])
+    parser.add_argument("--meshes", type=_int_list, default=[1])
+    parser.add_argument("--shape-keys", type=_int_list, default=[0, 50])
+    parser.add_argument(
+        "--bones",
+        type=_int_list,
+        default=[0],
+        help="Total bones, extra bones are added when more than the humanoid bones",
+    )
+    parser.add_argument(
+        "--only",
+        help="Comma separated benchmarks to run, out of "
+        + ", ".join(BENCHMARKS)
+        + ", or checks to run with --check, out of "
+        + ", ".join(CHECKS),
+    )
+    parser.add_argument(
+        "--check",
+        action="store_true",
+        help="Check that the fast paths give the same results as the paths they"
+        " replace, instead of timing",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=1e-5,
+        help="Largest difference allowed by --check, in metres for positions",
+    )
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--json", help="File to write the timings to")
+    return parser.parse_args(argv)
+
+
+def print_table(name, results):
+    print()
+    print(name)
+    header = "{:>10} {:>6} {:>10} {:>6} {:>12}".format(
+        "verts", "meshes", "shape keys", "bones", "time (ms)"
+    )
+    print(header)
+    print("-" * len(header))
+    for result in results:
+        config = result["config"]
+        print(
+            "{:>10} {:>6} {:>10} {:>6} {:>12.1f}".format(
+                config["num_verts"],
+                config["num_meshes"],
+                config["num_shape_keys"],
+                config["num_bones"],
+                result["times"][name] * 1000,
+            )
+        )
+
+
+def _configs(args):
+    for num_verts in args.verts:
+        for num_meshes in args.meshes:
+            for num_shape_keys in args.shape_keys:
+                for num_bones in args.bones:
+                    yield {
+                        "num_verts": num_verts,
+                        "num_meshes": num_meshes,
+                        "num_shape_keys": num_shape_keys,
+                        "num_bones": num_bones,
+                    }
+
+
+def main_check(args):
+    names = args.only.split(",") if args.only else list(CHECKS)
+    for name in names:
+        if name not in CHECKS:
+            raise KeyError("Unknown check '{}'".format(name))
+
+    failed = 0
+    for config in _configs(args):
+        for name in names:
+            mismatched, max_error = run_check(name, config, args.tolerance)
+            print(
+                "{} {} {}: largest difference {:.3g}".format(
+                    "FAIL" if mismatched else "ok", name, config, max_error
+                )
+            )
+            for array_name in mismatched:
+                print("    {} differs".format(array_name))
+            failed += bool(mismatched)
+    return 1 if failed else 0
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if not hasattr(bpy.types.Scene, "target_height"):
+        immersive_scaler.register()
+    if args.check:
+        return main_check(args)
+    names = args.only.split(",") if args.only else list(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            raise KeyError("Unknown benchmark '{}'".format(name))
+
+    results = []
+    for config in _configs(args):
+        times = {}
+        api_calls = {}
+        for name in names:
+            times[name], api_calls[name] = time_benchmark(name, config, args.repeat)
+            print(
+                "{} {}: {:.1f}ms, {}".format(
+                    name,
+                    config,
+                    times[name] * 1000,
+                    instrument.format_counts(api_calls[name]),
+                )
+            )
+        results.append({"config": config, "times": times, "api_calls": api_calls})
+
+    for name in names:
+        print_table(name, results)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())